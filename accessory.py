@@ -165,6 +165,8 @@ class Lock(Accessory):
     def set_lock_target_state(self, value):
         # value = 1 if (self.service.is_door_closed()) else 0
         log.info(f"set_lock_target_state {value}")
+        # Person who locked or unlocked the door is likely to tap right after
+        self.service.notify_activity()
         self._lock_target_state = self._lock_current_state = value
         self.lock_current_state.set_value(self._lock_current_state, should_notify=True)
         return self._lock_target_state
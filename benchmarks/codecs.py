@@ -0,0 +1,317 @@
+"""Measures encoding and decoding speed of the protocol codecs on realistic payloads.
+
+Reports operations per second and peak memory allocated by a single operation,
+optionally comparing them with a previously saved baseline.
+
+Run from the project root:
+    python -m benchmarks.codecs --save benchmarks/baseline/codecs.json
+    python -m benchmarks.codecs --baseline benchmarks/baseline/codecs.json
+"""
+
+import argparse
+import json
+import random
+import statistics
+import sys
+import timeit
+import tracemalloc
+
+import cbor2
+
+from entity import (
+    ControlPointRequest,
+    ControlPointResponse,
+    DeviceCredentialRequest,
+    DeviceCredentialResponse,
+    Interface,
+    KeyState,
+    KeyType,
+    Operation,
+    OperationStatus,
+)
+from util.ecp import ECP
+from util.iso18013 import ISO18013SecureContext, parse_issuer_auth
+from util.iso7816 import ISO7816Command, ISO7816Response
+from util.ndef import NDEFMessage, NDEFRecord
+from util.structable import pack
+from util.tlv import BERTLV as TLV
+
+# Payloads have fixed contents so that runs are comparable with each other
+rng = random.Random(0x5E)
+
+
+def randbytes(size):
+    return bytes(rng.getrandbits(8) for _ in range(size))
+
+
+def response(data):
+    return pack(ISO7816Response(sw1=0x90, sw2=0x00, data=data))
+
+
+def attestation_package():
+    device_key = {1: 2, -1: 1, -2: randbytes(32), -3: randbytes(32)}
+    value_digests = {"org.iso.18013.5.1": {index: randbytes(32) for index in range(32)}}
+    mobile_security_object = {
+        "version": "1.0",
+        "digestAlgorithm": "SHA-256",
+        "valueDigests": value_digests,
+        "deviceKeyInfo": {"deviceKey": device_key},
+        "docType": "com.apple.HomeKit.1.credential",
+    }
+    issuer_auth = [
+        b"\xa1\x01\x27",
+        {4: randbytes(8)},
+        cbor2.dumps(cbor2.CBORTag(24, cbor2.dumps(mobile_security_object))),
+        randbytes(64),
+    ]
+    return cbor2.dumps(
+        {
+            "version": "1.0",
+            "documents": [
+                {
+                    "docType": "com.apple.HomeKit.1.credential",
+                    "issuerSigned": {"issuerAuth": issuer_auth},
+                }
+            ],
+            "status": 0,
+        }
+    )
+
+
+def generate_payloads():
+    reader_identifier = randbytes(16)
+    transaction_identifier = randbytes(16)
+    reader_ephemeral_public_key = b"\x04" + randbytes(64)
+    endpoint_ephemeral_public_key = b"\x04" + randbytes(64)
+
+    engagement = NDEFMessage(
+        [
+            NDEFRecord(
+                tnf=0x01,
+                type=b"Hs",
+                payload=bytes.fromhex("15d1020b6163010301646e6663"),
+            ),
+            NDEFRecord(tnf=0x04, type=b"iso.org:18013:nfc", id=b"nfc", payload=0x01),
+            NDEFRecord(
+                tnf=0x04,
+                type=b"iso.org:18013:deviceengagement",
+                id=b"mdoc",
+                payload=randbytes(96),
+            ),
+        ]
+    )
+    control_point_request = ControlPointRequest(
+        operation=Operation.ADD,
+        device_credential_request=DeviceCredentialRequest(
+            key_type=KeyType.SECP256R1,
+            credential_public_key=b"\x04" + randbytes(64),
+            issuer_key_identifier=randbytes(8),
+            key_state=KeyState.ACTIVE,
+        ),
+    )
+    control_point_response = ControlPointResponse(
+        device_credential_response=DeviceCredentialResponse(
+            key_identifier=randbytes(8),
+            issuer_key_identifier=randbytes(8),
+            status=OperationStatus.SUCCESS,
+        )
+    )
+    auth0_command_tlv = [
+        TLV(0x5C, value=b"\x02\x00"),
+        TLV(0x87, value=reader_ephemeral_public_key),
+        TLV(0x4C, value=transaction_identifier),
+        TLV(0x4D, value=reader_identifier),
+    ]
+    return {
+        "select_response": response(TLV(0x5C, value=b"\x02\x00\x01\x00")),
+        "auth0_command_tlv": auth0_command_tlv,
+        "auth0_command": ISO7816Command(
+            cla=0x80, ins=0x80, p1=0x01, p2=0x01, data=pack(auth0_command_tlv)
+        ),
+        "auth0_response": response(
+            [
+                TLV(0x86, value=endpoint_ephemeral_public_key),
+                TLV(0x9D, value=randbytes(16)),
+            ]
+        ),
+        # AUTH1 response after secure messaging has been removed
+        "auth1_response": response(
+            [TLV(0x4E, value=randbytes(32)), TLV(0x9E, value=randbytes(64))]
+        ),
+        "envelope_response": response(TLV(0x53, value=engagement)),
+        "engagement": engagement,
+        # Attestation package is a CBOR document of several kilobytes
+        "attestation_response": pack(TLV(0x53, value=randbytes(4096))),
+        "attestation_package": attestation_package(),
+        # Mailbox request of the attestation flow is about a hundred bytes long
+        "iso18013_message": randbytes(128),
+        "iso18013_secure": ISO18013SecureContext(
+            None, randbytes(32), randbytes(32), 32
+        ),
+        "control_point_request": control_point_request,
+        "control_point_request_data": control_point_request.pack(),
+        "control_point_response": control_point_response,
+        "fast_info": (
+            randbytes(32),
+            0x01,
+            reader_identifier,
+            randbytes(32),
+            Interface.CONTACTLESS,
+            TLV(0x5C, value=[b"\x02\x00", b"\x01\x00"]),
+            TLV(0x5C, value=b"\x02\x00"),
+            reader_ephemeral_public_key[1:33],
+            transaction_identifier,
+            b"\x01\x01",
+            endpoint_ephemeral_public_key[1:33],
+        ),
+    }
+
+
+def walk(tlv_array):
+    # Touch every nested value so that lazily parsed data is accounted for
+    for tlv in tlv_array:
+        if tlv.tag.is_constructed:
+            walk(tlv.value)
+
+
+def generate_cases(payloads):
+    p = payloads
+    return {
+        "tlv.unpack.select": lambda: walk(
+            TLV.unpack_array(ISO7816Response.unpack(p["select_response"]).data)
+        ),
+        "tlv.unpack.auth0": lambda: walk(
+            TLV.unpack_array(ISO7816Response.unpack(p["auth0_response"]).data)
+        ),
+        "tlv.unpack.auth1": lambda: walk(
+            TLV.unpack_array(ISO7816Response.unpack(p["auth1_response"]).data)
+        ),
+        "tlv.unpack.attestation": lambda: TLV.unpack(p["attestation_response"]).value,
+        "tlv.pack.auth0": lambda: pack(
+            [TLV(tlv.tag, value=tlv.value) for tlv in p["auth0_command_tlv"]]
+        ),
+        "tlv8.unpack.control_point": lambda: ControlPointRequest.unpack(
+            p["control_point_request_data"]
+        ),
+        "tlv8.pack.control_point": lambda: p["control_point_response"].pack(),
+        "ndef.unpack.envelope": lambda: NDEFMessage.unpack(
+            TLV.unpack(ISO7816Response.unpack(p["envelope_response"]).data).value
+        ),
+        "ndef.pack.engagement": lambda: p["engagement"].pack(),
+        # Built inside the call, a command packed once keeps its bytes cached
+        "iso7816.pack.auth0": lambda: ISO7816Command(
+            cla=0x80, ins=0x80, p1=0x01, p2=0x01, data=pack(p["auth0_command_tlv"])
+        ).pack(),
+        "iso7816.pack.command": lambda: ISO7816Command(
+            cla=0x80, ins=0x81, p1=0x00, p2=0x00, data=p["auth0_command"].data
+        ).pack(),
+        "iso7816.unpack.attestation": lambda: ISO7816Response.unpack(
+            p["attestation_response"]
+        ),
+        "cbor.unpack.issuer_auth": lambda: parse_issuer_auth(p["attestation_package"]),
+        "iso18013.encrypt.request": lambda: p[
+            "iso18013_secure"
+        ].encrypt_message_to_endpoint(p["iso18013_message"]),
+        "ecp.pack.home": lambda: ECP.home(identifier=b"\x01" * 8).pack(),
+        "structable.pack.fast_info": lambda: pack(p["fast_info"]),
+    }
+
+
+def measure_speed(function, repeat):
+    timer = timeit.Timer(function)
+    number, _ = timer.autorange()
+    timings = timer.repeat(repeat=repeat, number=number)
+    return number / statistics.median(timings)
+
+
+def measure_allocations(function):
+    function()
+    tracemalloc.start()
+    try:
+        before, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        function()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak - before
+
+
+def run(cases, repeat):
+    return {
+        name: {
+            "ops_per_sec": round(measure_speed(function, repeat), 1),
+            "peak_bytes": measure_allocations(function),
+        }
+        for name, function in cases.items()
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Prints results next to the baseline, returns names of regressed cases"""
+    regressions = []
+    print(
+        f"{'case':<30} {'ops/sec':>12} {'baseline':>12} {'change':>8}"
+        f" {'peak B':>8} {'baseline':>8}"
+    )
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            print(
+                f"{name:<30} {result['ops_per_sec']:>12.1f} {'-':>12} {'-':>8}"
+                f" {result['peak_bytes']:>8} {'-':>8}"
+            )
+            continue
+        change = result["ops_per_sec"] / base["ops_per_sec"] - 1
+        regressed = change < -tolerance or result["peak_bytes"] > base["peak_bytes"] * (
+            1 + tolerance
+        )
+        if regressed:
+            regressions.append(name)
+        print(
+            f"{name:<30} {result['ops_per_sec']:>12.1f} {base['ops_per_sec']:>12.1f}"
+            f" {change:>+8.1%} {result['peak_bytes']:>8} {base['peak_bytes']:>8}"
+            + (" REGRESSION" if regressed else "")
+        )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--baseline", help="JSON file with results to compare with")
+    parser.add_argument("--save", help="JSON file to store results into")
+    parser.add_argument("--filter", default="", help="Only run cases with this prefix")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.1,
+        help="Relative slowdown or allocation increase counted as regression",
+    )
+    args = parser.parse_args()
+
+    cases = {
+        name: function
+        for name, function in generate_cases(generate_payloads()).items()
+        if name.startswith(args.filter)
+    }
+    results = run(cases, args.repeat)
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+    regressions = compare(results, baseline, args.tolerance)
+
+    if args.save:
+        with open(args.save, "w") as file:
+            json.dump(results, file, indent=2, sort_keys=True)
+            file.write("\n")
+
+    if regressions:
+        print(f"Regressed: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
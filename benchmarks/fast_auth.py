@@ -0,0 +1,114 @@
+"""Measures how FAST cryptogram search latency scales with endpoint and worker count.
+
+Sequential search is what the reader uses by default. Run this on the target board
+before enabling search_workers, a pool only pays off if it beats sequential search there.
+
+Run from the project root:
+    python -m benchmarks.fast_auth --endpoints 16 64 256 1024 --workers 1 2 4
+"""
+
+import argparse
+import os
+import statistics
+import time
+
+from cryptography.hazmat.primitives.asymmetric import ec
+
+from cache import endpoint_key_material_cache
+from entity import Context, Endpoint, Enrollments, Interface, KeyType
+from homekey import CryptogramSearchPool, find_endpoint_by_cryptogram
+from util.crypto import get_ec_key_public_points
+from util.structable import pack
+from util.tlv import BERTLV as TLV
+
+
+def generate_endpoints(count):
+    endpoints = []
+    for _ in range(count):
+        x, y = get_ec_key_public_points(
+            ec.generate_private_key(ec.SECP256R1()).public_key()
+        )
+        endpoints.append(
+            Endpoint(
+                last_used_at=0,
+                counter=0,
+                key_type=KeyType.SECP256R1,
+                public_key=b"\x04" + x + y,
+                persistent_key=os.urandom(32),
+                enrollments=Enrollments(hap=None, attestation=None),
+            )
+        )
+    return endpoints
+
+
+def generate_transaction():
+    reader_info = pack((os.urandom(32), Context.VOLATILE_FAST, os.urandom(16)))
+    info_suffix = pack(
+        (
+            TLV(0x5C, value=[b"\x02\x00", b"\x01\x00"]),
+            TLV(0x5C, value=b"\x02\x00"),
+            os.urandom(32),
+            os.urandom(16),
+            b"\x01\x01",
+            os.urandom(32),
+        )
+    )
+    return reader_info, info_suffix
+
+
+def measure(endpoints, search_pool, repeat):
+    reader_info, info_suffix = generate_transaction()
+    # Worst case, matching endpoint is the last one to be checked
+    key_material = endpoint_key_material_cache.get(endpoints[-1])
+    cryptogram = key_material.hkdf.expand(
+        key_material.get_fast_info_prefix(reader_info, Interface.CONTACTLESS)
+        + info_suffix,
+        16,
+    )
+    timings = []
+    for _ in range(repeat + 1):
+        start = time.perf_counter()
+        endpoint, _ = find_endpoint_by_cryptogram(
+            endpoints,
+            cryptogram=cryptogram,
+            reader_info=reader_info,
+            interface=Interface.CONTACTLESS,
+            info_suffix=info_suffix,
+            search_pool=search_pool,
+        )
+        timings.append(time.perf_counter() - start)
+        assert endpoint is endpoints[-1]
+    # First run warms up caches of the pool workers
+    return statistics.median(timings[1:]) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--endpoints", type=int, nargs="+", default=[16, 64, 256, 1024])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--kinds", nargs="+", default=["thread", "process"])
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+
+    pools = {(1, "sequential"): None}
+    for kind in args.kinds:
+        for workers in args.workers:
+            if workers > 1:
+                pools[(workers, kind)] = CryptogramSearchPool(
+                    workers, kind=kind, min_candidates=0
+                )
+
+    print(f"{'endpoints':>10} {'pool':>12} {'workers':>8} {'median ms':>10}")
+    for count in args.endpoints:
+        endpoints = generate_endpoints(count)
+        for (workers, kind), search_pool in pools.items():
+            latency = measure(endpoints, search_pool, args.repeat)
+            print(f"{count:>10} {kind:>12} {workers:>8} {latency:>10.3f}")
+
+    for search_pool in pools.values():
+        if search_pool is not None:
+            search_pool.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""Measures CPU time spent on preparing the ECP broadcast frame of a single polling iteration.
+
+Compares building the frame on every poll, as done before frames were cached,
+with the cached frame, and CRC_A computed per byte with the table driven one.
+
+Run from the project root:
+    python -m benchmarks.polling --repeat 5
+"""
+
+import argparse
+import os
+import statistics
+import timeit
+
+from util.ecp import ECP, get_home_frame
+from util.nfc import crc16a, with_crc16a_cached
+
+
+def crc16a_without_table(data):
+    # Implementation that was used before the lookup table was introduced
+    w_crc = 0x6363
+    for byte in data:
+        byte = byte ^ (w_crc & 0x00FF)
+        byte = (byte ^ (byte << 4)) & 0xFF
+        w_crc = ((w_crc >> 8) ^ (byte << 8) ^ (byte << 3) ^ (byte >> 4)) & 0xFFFF
+    return bytearray([w_crc & 0xFF, (w_crc >> 8) & 0xFF])
+
+
+def generate_cases(identifier, express):
+    frame = get_home_frame(identifier, express)
+
+    def build_every_poll():
+        broadcast = ECP.home(identifier=identifier, flag_2=express).pack()
+        return bytes(broadcast) + crc16a_without_table(broadcast)
+
+    def cached():
+        return with_crc16a_cached(get_home_frame(identifier, express))
+
+    return {
+        "poll.build_every_time": build_every_poll,
+        "poll.cached": cached,
+        "crc16a.without_table": lambda: crc16a_without_table(frame),
+        "crc16a.table": lambda: crc16a(frame),
+    }
+
+
+def measure(function, repeat):
+    timer = timeit.Timer(function)
+    number, _ = timer.autorange()
+    return statistics.median(timer.repeat(repeat=repeat, number=number)) / number
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    cases = generate_cases(os.urandom(8), express=True)
+    print(f"{'case':<24} {'us per call':>12}")
+    for name, function in cases.items():
+        print(f"{name:<24} {measure(function, args.repeat) * 1e6:>12.3f}")
+
+
+if __name__ == "__main__":
+    main()
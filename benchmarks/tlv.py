@@ -0,0 +1,58 @@
+"""Measures BER-TLV parsing time for responses of attestation-like size and nesting.
+
+Run from the project root:
+    python -m benchmarks.tlv --sizes 256 1024 4096 16384 --depths 1 4 16
+"""
+
+import argparse
+import os
+import statistics
+import time
+
+from util.tlv import BERTLV as TLV
+
+
+def generate_response(size, depth):
+    # Attestation package is a single large primitive value,
+    # nested constructed tags stress out parsing of children
+    value = TLV(0x53, value=os.urandom(size))
+    for level in range(depth - 1):
+        value = TLV(0xA0 + level % 16, value=[TLV(0x80, value=os.urandom(16)), value])
+    return value.pack() + TLV(0x90, value=b"\x01\x00").pack()
+
+
+def walk(tlv_array):
+    # Access every child so that lazily parsed elements are counted in as well
+    for tlv in tlv_array:
+        if tlv.tag.is_constructed:
+            walk(tlv.value)
+
+
+def measure(data, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        walk(TLV.unpack_array(data))
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[256, 1024, 4096, 16384]
+    )
+    parser.add_argument("--depths", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    print(f"{'size':>8} {'depth':>6} {'bytes':>8} {'median ms':>10}")
+    for size in args.sizes:
+        for depth in args.depths:
+            data = generate_response(size, depth)
+            latency = measure(data, args.repeat)
+            print(f"{size:>8} {depth:>6} {len(data):>8} {latency:>10.4f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+import hashlib
+import logging
+from collections import OrderedDict
+from threading import Lock
+from typing import Dict, Optional, Tuple
+
+from cryptography.hazmat.primitives.asymmetric import ec, ed25519
+
+from entity import Endpoint
+from util.crypto import (
+    PrecomputedHKDF,
+    get_ec_key_public_points,
+    load_ec_public_key_from_bytes,
+)
+from util.iso18013 import IssuerAuth
+from util.metrics import metrics
+from util.structable import pack
+
+log = logging.getLogger()
+
+
+class EndpointKeyMaterial:
+    """Parsed key material of an endpoint that is needed on every transaction"""
+
+    public_key: ec.EllipticCurvePublicKey
+    public_key_x: bytes
+    persistent_key: bytes
+    hkdf: PrecomputedHKDF
+
+    def __init__(self, endpoint: Endpoint):
+        self.public_key = load_ec_public_key_from_bytes(endpoint.public_key)
+        self.public_key_x, _ = get_ec_key_public_points(self.public_key)
+        self.persistent_key = bytes(endpoint.persistent_key)
+        self.hkdf = PrecomputedHKDF(self.persistent_key)
+        self._fast_info: Optional[Tuple[bytes, int, bytes]] = None
+
+    def get_fast_info_prefix(self, reader_info: bytes, interface: int) -> bytes:
+        """Returns packed part of FAST info that stays the same for this reader and endpoint"""
+        fast_info = self._fast_info
+        if fast_info is None or fast_info[:2] != (reader_info, interface):
+            fast_info = (
+                reader_info,
+                interface,
+                pack((reader_info, self.public_key_x, interface)),
+            )
+            self._fast_info = fast_info
+        return fast_info[2]
+
+
+class EndpointKeyMaterialCache:
+    """Keeps EndpointKeyMaterial by endpoint id until the endpoint is changed"""
+
+    _entries: Dict[bytes, EndpointKeyMaterial]
+
+    def __init__(self):
+        self._entries = dict()
+        self._lock = Lock()
+
+    def get(self, endpoint: Endpoint) -> EndpointKeyMaterial:
+        endpoint_id = endpoint.id
+        entry = self._entries.get(endpoint_id)
+        if entry is not None and entry.persistent_key == endpoint.persistent_key:
+            return entry
+        entry = EndpointKeyMaterial(endpoint)
+        with self._lock:
+            self._entries[endpoint_id] = entry
+        return entry
+
+    def invalidate(self, endpoint_id: bytes):
+        with self._lock:
+            if self._entries.pop(bytes(endpoint_id), None) is not None:
+                log.debug(f"Invalidated key material of Endpoint({endpoint_id.hex()})")
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class AttestationCache:
+    """Remembers attestation packages with a verified issuer signature and parsed issuer keys.
+
+    Packages are keyed by their SHA-256 digest and stored along with the public key
+    of the issuer that signed them, so an entry is only trusted for that issuer
+    """
+
+    _verified: "OrderedDict[bytes, Tuple[bytes, IssuerAuth]]"
+    _issuer_keys: Dict[bytes, ed25519.Ed25519PublicKey]
+
+    def __init__(self, maxsize=64):
+        self.maxsize = maxsize
+        self._verified = OrderedDict()
+        self._issuer_keys = dict()
+        self._lock = Lock()
+
+    @staticmethod
+    def digest(attestation_package: bytes) -> bytes:
+        return hashlib.sha256(attestation_package).digest()
+
+    def get_verified(self, digest: bytes) -> Optional[Tuple[bytes, IssuerAuth]]:
+        """Returns issuer public key and parsed issuer auth of a verified package"""
+        with self._lock:
+            entry = self._verified.get(digest)
+            if entry is not None:
+                self._verified.move_to_end(digest)
+        if entry is not None:
+            metrics.increment("attestation_cache.hits")
+        else:
+            metrics.increment("attestation_cache.misses")
+        return entry
+
+    def add_verified(
+        self, digest: bytes, issuer_public_key: bytes, issuer_auth: IssuerAuth
+    ):
+        with self._lock:
+            self._verified[digest] = (bytes(issuer_public_key), issuer_auth)
+            self._verified.move_to_end(digest)
+            while len(self._verified) > self.maxsize:
+                self._verified.popitem(last=False)
+
+    def get_issuer_key(self, issuer_public_key: bytes) -> ed25519.Ed25519PublicKey:
+        issuer_public_key = bytes(issuer_public_key)
+        key = self._issuer_keys.get(issuer_public_key)
+        if key is None:
+            key = ed25519.Ed25519PublicKey.from_public_bytes(issuer_public_key)
+            with self._lock:
+                self._issuer_keys[issuer_public_key] = key
+        return key
+
+    def invalidate_issuer(self, issuer_public_key: bytes):
+        issuer_public_key = bytes(issuer_public_key)
+        with self._lock:
+            self._issuer_keys.pop(issuer_public_key, None)
+            for digest in [
+                digest
+                for digest, (public_key, _) in self._verified.items()
+                if public_key == issuer_public_key
+            ]:
+                del self._verified[digest]
+        log.debug(f"Invalidated attestations of Issuer({issuer_public_key.hex()})")
+
+    def clear(self):
+        with self._lock:
+            self._verified.clear()
+            self._issuer_keys.clear()
+
+    def __len__(self):
+        return len(self._verified)
+
+
+endpoint_key_material_cache = EndpointKeyMaterialCache()
+attestation_cache = AttestationCache()
@@ -4,6 +4,9 @@ from dataclasses import dataclass
 from enum import Enum, IntEnum
 from typing import List, Optional, Union
 
+from cryptography.hazmat.primitives.asymmetric import ec
+
+from util.crypto import get_ec_key_public_points
 from util.structable import represent
 from util.tlv import TLV8Field, TLV8Object
 
@@ -129,6 +132,45 @@ class Issuer:
         return f"Issuer(public_key={self.public_key.hex()}, endpoints={self.endpoints})"
 
 
+@dataclass
+class ReaderIdentity:
+    private_key: bytes
+    unique_identifier: bytes
+    group_identifier: bytes
+    # Group identifier followed by unique identifier, as sent to the endpoints
+    identifier: bytes
+    # Key and its public points are not set if the private key is not a valid scalar,
+    # e.g. when the reader is not configured yet
+    key: Optional[ec.EllipticCurvePrivateKey]
+    public_key_x: Optional[bytes]
+    public_key_y: Optional[bytes]
+
+    @classmethod
+    def from_private_key(cls, private_key: bytes, unique_identifier: bytes):
+        group_identifier = hashlib.sha256(
+            "key-identifier".encode() + private_key
+        ).digest()[:8]
+        try:
+            key = ec.derive_private_key(
+                int.from_bytes(private_key, "big"), ec.SECP256R1()
+            )
+            public_key_x, public_key_y = get_ec_key_public_points(key.public_key())
+        except ValueError:
+            key, public_key_x, public_key_y = None, None, None
+        return ReaderIdentity(
+            private_key=private_key,
+            unique_identifier=unique_identifier,
+            group_identifier=group_identifier,
+            identifier=group_identifier + unique_identifier,
+            key=key,
+            public_key_x=public_key_x,
+            public_key_y=public_key_y,
+        )
+
+    def __repr__(self) -> str:
+        return f"ReaderIdentity(identifier={self.identifier.hex()}, public_key_x={self.public_key_x.hex() if self.public_key_x else None})"
+
+
 class HardwareFinishColor(Enum):
     TAN = bytes.fromhex("CED5DA00")
     GOLD = bytes.fromhex("AAD6EC00")
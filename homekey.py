@@ -1,14 +1,25 @@
 import base64
+import functools
 import hashlib
+import hmac
 import logging
+import multiprocessing
 import os
+import threading
 import time
-from typing import Collection, List, Optional, Tuple
+from concurrent.futures import (
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    as_completed,
+)
+from dataclasses import dataclass
+from typing import Callable, Collection, Dict, Iterable, List, Optional, Tuple
 
 import cbor2
 from cryptography.exceptions import InvalidSignature
 from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.asymmetric import ec, ed25519
+from cryptography.hazmat.primitives.asymmetric import ec
 from cryptography.hazmat.primitives.asymmetric.utils import (
     decode_dss_signature,
     encode_dss_signature,
@@ -16,6 +27,7 @@ from cryptography.hazmat.primitives.asymmetric.utils import (
 from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from cryptography.hazmat.primitives.kdf.x963kdf import X963KDF
 
+from cache import attestation_cache, endpoint_key_material_cache
 from entity import (
     Context,
     Endpoint,
@@ -24,17 +36,23 @@ from entity import (
     Interface,
     Issuer,
     KeyType,
+    ReaderIdentity,
+)
+from util.crypto import (
+    PrecomputedHKDF,
+    get_ec_key_public_points,
+    load_ec_public_key_from_bytes,
 )
-from util.crypto import get_ec_key_public_points, load_ec_public_key_from_bytes
 from util.digital_key import (
     DigitalKeyFlow,
     DigitalKeySecureContext,
     DigitalKeyTransactionFlags,
     DigitalKeyTransactionType,
 )
-from util.generic import chunked, get_tlv_tag
-from util.iso18013 import ISO18013SecureContext
+from util.generic import chunked
+from util.iso18013 import ISO18013SecureContext, parse_issuer_auth
 from util.iso7816 import ISO7816, ISO7816Application, ISO7816Command, ISO7816Tag
+from util.metrics import metrics
 from util.ndef import NDEFMessage, NDEFRecord
 from util.structable import pack
 from util.tlv import BERTLV as TLV
@@ -50,6 +68,23 @@ COSE_CONTEXT = "Signature1"
 COSE_AAD = b""
 
 
+# Endpoints used within this period are searched first, most recently used one on top
+HOT_ENDPOINT_PERIOD = 7 * 24 * 60 * 60
+# Endpoints that were not used within this period are searched last
+COLD_ENDPOINT_PERIOD = 90 * 24 * 60 * 60
+
+
+SUPPORTED_PROTOCOL_VERSION = b"\x02\x00"
+
+# Runs cryptographic work that can overlap with NFC communication
+background_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="homekey")
+# Speculative work can't be stopped once started, so it is kept apart
+# from the work a tap waits for and can only hold up further speculation
+speculation_executor = ThreadPoolExecutor(
+    max_workers=1, thread_name_prefix="speculation"
+)
+
+
 # Random numbers presumably used to provide entropy.
 # Coincidentally, they're valid UNIX epochs
 READER_CONTEXT = int(1096652137).to_bytes(4, "big")
@@ -68,6 +103,303 @@ def get_endpoints_from_issuers(issuers: List[Issuer]):
     return (e for i in issuers for e in i.endpoints)
 
 
+def order_endpoints_for_search(
+    endpoints: Iterable[Endpoint],
+    now: Optional[float] = None,
+    hot_period=HOT_ENDPOINT_PERIOD,
+    cold_period=COLD_ENDPOINT_PERIOD,
+) -> List[Endpoint]:
+    """Orders endpoints by how likely they are to be the one at the reader.
+    Hot tier goes first ordered by recency, then warm and cold tiers ordered by use count
+    """
+    now = time.time() if now is None else now
+    hot, warm, cold = [], [], []
+    for endpoint in endpoints:
+        age = now - endpoint.last_used_at
+        if endpoint.last_used_at and age <= hot_period:
+            hot.append(endpoint)
+        elif endpoint.last_used_at and age <= cold_period:
+            warm.append(endpoint)
+        else:
+            cold.append(endpoint)
+    hot.sort(key=lambda e: (e.last_used_at, e.counter), reverse=True)
+    warm.sort(key=lambda e: (e.counter, e.last_used_at), reverse=True)
+    cold.sort(key=lambda e: (e.counter, e.last_used_at), reverse=True)
+    return hot + warm + cold
+
+
+def _search_cryptogram(
+    endpoints: Iterable[Endpoint],
+    cryptogram: bytes,
+    reader_info: bytes,
+    interface: int,
+    info_suffix: bytes,
+    key_size=16,
+    cancelled: Optional[threading.Event] = None,
+) -> Tuple[Optional[Endpoint], Optional[bytes], int]:
+    tried = 0
+    for endpoint in endpoints:
+        if cancelled is not None and cancelled.is_set():
+            break
+        tried += 1
+        key_material = endpoint_key_material_cache.get(endpoint)
+        info = key_material.get_fast_info_prefix(reader_info, interface) + info_suffix
+        hkdf = key_material.hkdf
+        kcmac = hkdf.expand(info, key_size)
+        log.info(
+            f"Endpoint({endpoint.id.hex()}):"
+            f" returned_cryptogram={cryptogram.hex()}"
+            f" ? calculated_cryptogram={kcmac.hex()}"
+        )
+        if hmac.compare_digest(kcmac, cryptogram):
+            if cancelled is not None:
+                cancelled.set()
+            return endpoint, hkdf.expand(info, key_size * 4), tried
+    return None, None, tried
+
+
+@functools.lru_cache(maxsize=1024)
+def _get_persistent_key_hkdf(persistent_key: bytes) -> PrecomputedHKDF:
+    # Worker processes have no access to endpoint_key_material_cache, so they keep their own
+    return PrecomputedHKDF(persistent_key)
+
+
+def _match_cryptogram_candidates(
+    candidates: List[Tuple[int, bytes, bytes]],
+    cryptogram: bytes,
+    info_suffix: bytes,
+    key_size=16,
+) -> Tuple[Optional[int], Optional[bytes], int]:
+    """Process pool worker. Candidates are (index, persistent_key, info_prefix) tuples"""
+    for tried, (index, persistent_key, info_prefix) in enumerate(candidates, start=1):
+        hkdf = _get_persistent_key_hkdf(persistent_key)
+        info = info_prefix + info_suffix
+        if hmac.compare_digest(hkdf.expand(info, key_size), cryptogram):
+            return index, hkdf.expand(info, key_size * 4), tried
+    return None, None, len(candidates)
+
+
+class CryptogramSearchPool:
+    """Splits FAST cryptogram search over endpoints between workers of a thread or process pool.
+
+    Candidates are split into consecutive chunks that are submitted in search order,
+    so the most likely endpoints are still checked first. Once a match is found,
+    chunks that have not started yet are cancelled and running thread workers stop.
+
+    Sequential search is faster on a typical reader, see benchmarks/fast_auth.py.
+    Hashing inputs are too small for hashlib to release the GIL, so only the process
+    pool can gain anything, and only with many endpoints on a multi-core board
+    """
+
+    KINDS = ("process", "thread")
+
+    def __init__(self, workers: int, kind: str = "process", min_candidates=32):
+        if kind not in self.KINDS:
+            raise ValueError(f"Unknown cryptogram search pool kind {kind}")
+        self.workers = workers
+        self.kind = kind
+        # Below this amount of candidates, dispatching work costs more than the search itself
+        self.min_candidates = min_candidates
+        self._executor = (
+            ThreadPoolExecutor(max_workers=workers, thread_name_prefix="cryptogram")
+            if kind == "thread"
+            else ProcessPoolExecutor(
+                max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+            )
+        )
+
+    @classmethod
+    def from_config(cls, workers: int, kind: str) -> Optional["CryptogramSearchPool"]:
+        """Returns a pool if more than one worker is configured, None to search sequentially"""
+        if workers <= 1:
+            return None
+        if kind not in cls.KINDS:
+            log.warning(
+                f"Cryptogram search pool {kind} is not supported. Falling back to {cls.KINDS[0]}"
+            )
+            kind = cls.KINDS[0]
+        return cls(workers, kind=kind)
+
+    def _chunks(self, candidates: list):
+        size = max(1, -(-len(candidates) // (self.workers * 4)))
+        return [candidates[i : i + size] for i in range(0, len(candidates), size)]
+
+    def search(
+        self,
+        endpoints: List[Endpoint],
+        cryptogram: bytes,
+        reader_info: bytes,
+        interface: int,
+        info_suffix: bytes,
+        key_size=16,
+    ) -> Tuple[Optional[Endpoint], Optional[bytes], int]:
+        if len(endpoints) < max(self.min_candidates, 2):
+            return _search_cryptogram(
+                endpoints, cryptogram, reader_info, interface, info_suffix, key_size
+            )
+
+        cancelled = threading.Event()
+        if self.kind == "thread":
+            futures = [
+                self._executor.submit(
+                    _search_cryptogram,
+                    chunk,
+                    cryptogram,
+                    reader_info,
+                    interface,
+                    info_suffix,
+                    key_size,
+                    cancelled,
+                )
+                for chunk in self._chunks(endpoints)
+            ]
+        else:
+            candidates = [
+                (
+                    index,
+                    key_material.persistent_key,
+                    key_material.get_fast_info_prefix(reader_info, interface),
+                )
+                for index, key_material in enumerate(
+                    endpoint_key_material_cache.get(e) for e in endpoints
+                )
+            ]
+            futures = [
+                self._executor.submit(
+                    _match_cryptogram_candidates,
+                    chunk,
+                    cryptogram,
+                    info_suffix,
+                    key_size,
+                )
+                for chunk in self._chunks(candidates)
+            ]
+
+        endpoint, material, tried = None, None, 0
+        for future in as_completed(futures):
+            if future.cancelled():
+                continue
+            found, found_material, found_tried = future.result()
+            tried += found_tried
+            if found is not None and endpoint is None:
+                endpoint = found if self.kind == "thread" else endpoints[found]
+                material = found_material
+                cancelled.set()
+                for pending in futures:
+                    pending.cancel()
+        return endpoint, material, tried
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+def find_endpoint_by_cryptogram(
+    endpoints: Iterable[Endpoint],
+    cryptogram: bytes,
+    reader_info: bytes,
+    interface: int,
+    info_suffix: bytes,
+    key_size=16,
+    search_pool: Optional[CryptogramSearchPool] = None,
+) -> Tuple[Optional[Endpoint], Optional[bytes]]:
+    """Returns an endpoint whose FAST kcmac equals the cryptogram and its full key material.
+    Candidates are checked by expanding only as much key material as kcmac needs
+    """
+    if search_pool is not None:
+        endpoint, material, tried = search_pool.search(
+            list(endpoints), cryptogram, reader_info, interface, info_suffix, key_size
+        )
+    else:
+        endpoint, material, tried = _search_cryptogram(
+            endpoints, cryptogram, reader_info, interface, info_suffix, key_size
+        )
+    if endpoint is None:
+        metrics.increment("fast.misses")
+        return None, None
+    metrics.increment("fast.matches")
+    metrics.observe("fast.candidates_per_match", tried)
+    return endpoint, material
+
+
+@dataclass
+class PreparedTransaction:
+    """Per-transaction values generated before a device enters the field"""
+
+    reader_identifier: bytes
+    flags: bytes
+    protocol_version: bytes
+    reader_ephemeral_private_key: ec.EllipticCurvePrivateKey
+    reader_ephemeral_public_key_bytes: bytes
+    transaction_identifier: bytes
+    attestation_exchange_common_secret: bytes
+    auth0_command: bytes
+
+    def matches(self, reader_identifier: bytes, flags: bytes, protocol_version: bytes):
+        return (self.reader_identifier, self.flags, self.protocol_version) == (
+            reader_identifier,
+            flags,
+            protocol_version,
+        )
+
+
+def get_transaction_flags(
+    flow: DigitalKeyFlow, transaction_code: DigitalKeyTransactionType
+) -> bytes:
+    transaction_flags = {
+        DigitalKeyTransactionFlags.FAST
+        if flow <= DigitalKeyFlow.FAST
+        else DigitalKeyTransactionFlags.STANDARD
+    }
+    return bytes([sum(transaction_flags), transaction_code])
+
+
+def build_auth0_command(
+    protocol_version: bytes,
+    flags: bytes,
+    reader_identifier: bytes,
+    reader_ephemeral_public_key_bytes: bytes,
+    transaction_identifier: bytes,
+) -> ISO7816Command:
+    command_tlv = [
+        TLV(0x5C, value=protocol_version),
+        TLV(0x87, value=reader_ephemeral_public_key_bytes),
+        TLV(0x4C, value=transaction_identifier),
+        TLV(0x4D, value=reader_identifier),
+    ]
+    command_data = pack(command_tlv)
+
+    return ISO7816Command(
+        cla=0x80, ins=0x80, p1=flags[0], p2=flags[1], data=command_data, le=None
+    )
+
+
+def prepare_transaction(
+    reader_identifier: bytes,
+    flags: bytes,
+    protocol_version: bytes = SUPPORTED_PROTOCOL_VERSION,
+) -> PreparedTransaction:
+    reader_ephemeral_private_key = ec.generate_private_key(ec.SECP256R1())
+    x, y = get_ec_key_public_points(reader_ephemeral_private_key.public_key())
+    reader_ephemeral_public_key_bytes = b"\x04" + x + y
+    transaction_identifier = os.urandom(16)
+    return PreparedTransaction(
+        reader_identifier=reader_identifier,
+        flags=flags,
+        protocol_version=protocol_version,
+        reader_ephemeral_private_key=reader_ephemeral_private_key,
+        reader_ephemeral_public_key_bytes=reader_ephemeral_public_key_bytes,
+        transaction_identifier=transaction_identifier,
+        attestation_exchange_common_secret=os.urandom(32),
+        auth0_command=build_auth0_command(
+            protocol_version=protocol_version,
+            flags=flags,
+            reader_identifier=reader_identifier,
+            reader_ephemeral_public_key_bytes=reader_ephemeral_public_key_bytes,
+            transaction_identifier=transaction_identifier,
+        ).pack(),
+    )
+
+
 def generate_ec_key_if_provided_is_none(
     private_key: Optional[ec.EllipticCurvePrivateKey],
 ):
@@ -134,6 +466,61 @@ def get_key_material_generator(
     return generate_keying_material
 
 
+def derive_session_keys(
+    reader_ephemeral_private_key: ec.EllipticCurvePrivateKey,
+    endpoint_ephemeral_public_key: ec.EllipticCurvePublicKey,
+    transaction_identifier: bytes,
+    interface: int,
+    flags: bytes,
+    protocol_version: bytes,
+    device_protocol_versions: List[bytes],
+    key_size=16,
+) -> Tuple[bytes, bytes]:
+    """Returns persistent key and volatile key material of a STANDARD transaction"""
+    get_key_material = get_key_material_generator(
+        reader_ephemeral_private_key=reader_ephemeral_private_key,
+        endpoint_ephemeral_public_key=endpoint_ephemeral_public_key,
+        transaction_identifier=transaction_identifier,
+        interface=interface,
+        flags=flags,
+        protocol_version=protocol_version,
+        device_protocol_versions=device_protocol_versions,
+    )
+    k_persistent = get_key_material(context=Context.PERSISTENT, key_size=key_size * 2)
+    hkdf = get_key_material(context=Context.VOLATILE, key_size=key_size * 3)
+    return k_persistent, hkdf
+
+
+def sign_authentication_hash_input(
+    reader_private_key: ec.EllipticCurvePrivateKey,
+    reader_identifier: bytes,
+    endpoint_ephemeral_public_key_x: bytes,
+    reader_ephemeral_public_key_x: bytes,
+    transaction_identifier: bytes,
+) -> bytes:
+    """Returns AUTH1 reader signature in point form"""
+    authentication_hash_input_material = [
+        TLV(0x4D, value=reader_identifier),
+        TLV(0x86, value=endpoint_ephemeral_public_key_x),
+        TLV(0x87, value=reader_ephemeral_public_key_x),
+        TLV(0x4C, value=transaction_identifier),
+        TLV(0x93, value=READER_CONTEXT),
+    ]
+    authentication_hash_input = pack(authentication_hash_input_material)
+    log.info(f"authentication_hash_input={authentication_hash_input.hex()}")
+
+    signature = reader_private_key.sign(
+        authentication_hash_input, ec.ECDSA(hashes.SHA256())
+    )
+    log.info(f"signature={signature.hex()} ({hex(len(signature))})")
+    x, y = decode_dss_signature(signature)
+    signature_point_form = bytes([*x.to_bytes(32, "big"), *y.to_bytes(32, "big")])
+    log.info(
+        f"signature_point_form={signature_point_form.hex()} ({hex(len(signature_point_form))})"
+    )
+    return signature_point_form
+
+
 def fast_auth(
     tag: ISO7816Tag,
     device_protocol_versions: List[bytes],
@@ -146,41 +533,50 @@ def fast_auth(
     transaction_identifier: bytes,
     issuers: List[Issuer],
     key_size=16,
+    search_pool: Optional[CryptogramSearchPool] = None,
+    prepared_transaction: Optional["PreparedTransaction"] = None,
+    # Calculated from reader_public_key if not provided
+    reader_public_key_x: Optional[bytes] = None,
+    # Called with endpoint ephemeral public key as soon as AUTH0 response is parsed
+    on_auth0: Optional[Callable[[ec.EllipticCurvePublicKey], None]] = None,
 ) -> Tuple[
     ec.EllipticCurvePublicKey, Optional[Endpoint], Optional[DigitalKeySecureContext]
 ]:
-    (
-        reader_ephemeral_public_key_x,
-        reader_ephemeral_public_key_y,
-    ) = get_ec_key_public_points(reader_ephemeral_public_key)
-    reader_ephemeral_public_key_bytes = bytes(
-        [0x04, *reader_ephemeral_public_key_x, *reader_ephemeral_public_key_y]
-    )
-    reader_public_key_x, _ = get_ec_key_public_points(reader_public_key)
-
-    command_tlv = [
-        TLV(0x5C, value=protocol_version),
-        TLV(0x87, value=reader_ephemeral_public_key_bytes),
-        TLV(0x4C, value=transaction_identifier),
-        TLV(0x4D, value=reader_identifier),
-    ]
-    command_data = pack(command_tlv)
+    if prepared_transaction is not None:
+        reader_ephemeral_public_key_x = (
+            prepared_transaction.reader_ephemeral_public_key_bytes[1:33]
+        )
+        command = prepared_transaction.auth0_command
+        log.info(f"AUTH0 CMD (PREPARED) = {command.hex()}")
+    else:
+        (
+            reader_ephemeral_public_key_x,
+            reader_ephemeral_public_key_y,
+        ) = get_ec_key_public_points(reader_ephemeral_public_key)
+        command = build_auth0_command(
+            protocol_version=protocol_version,
+            flags=flags,
+            reader_identifier=reader_identifier,
+            reader_ephemeral_public_key_bytes=bytes(
+                [0x04, *reader_ephemeral_public_key_x, *reader_ephemeral_public_key_y]
+            ),
+            transaction_identifier=transaction_identifier,
+        )
+        log.info(f"AUTH0 CMD = {command}")
+    if reader_public_key_x is None:
+        reader_public_key_x, _ = get_ec_key_public_points(reader_public_key)
 
-    command = ISO7816Command(
-        cla=0x80, ins=0x80, p1=flags[0], p2=flags[1], data=command_data, le=None
-    )
-    log.info(f"AUTH0 CMD = {command}")
     response = tag.transceive(command)
     if response.sw != (0x90, 0x00):
         raise ProtocolError(f"AUTH0 INVALID STATUS {response.sw}")
     log.info(f"AUTH0 RES = {response}")
     tlv_array = TLV.unpack_array(response.data)
 
-    endpoint_ephemeral_public_key_tag = get_tlv_tag(tlv_array, 0x86)
-    if endpoint_ephemeral_public_key_tag is None:
-        raise ProtocolError(
-            "Response does not contain endpoint_ephemeral_public_key_tag 0x86"
-        )
+    endpoint_ephemeral_public_key_tag = tlv_array.require(
+        0x86,
+        "Response does not contain endpoint_ephemeral_public_key_tag 0x86",
+        error=ProtocolError,
+    )
 
     endpoint_ephemeral_public_key = load_ec_public_key_from_bytes(
         endpoint_ephemeral_public_key_tag
@@ -188,30 +584,25 @@ def fast_auth(
     endpoint_ephemeral_public_key_x, _ = get_ec_key_public_points(
         endpoint_ephemeral_public_key
     )
+    if on_auth0 is not None:
+        on_auth0(endpoint_ephemeral_public_key)
 
-    returned_cryptogram = get_tlv_tag(tlv_array, 0x9D)
+    returned_cryptogram = tlv_array.get(0x9D)
     if returned_cryptogram is None:
         return endpoint_ephemeral_public_key, None, None
 
-    endpoint = None
-    # FAST gives us no way to find out the identity of endpoint from the data for security reasons,
-    # so we have to iterate over all provisioned endpoints and hope that it's there
-    log.info("Searching for an endpoint with matching cryptogram...")
-    for endpoint in get_endpoints_from_issuers(issuers):
-        k_persistent = endpoint.persistent_key
-        endpoint_public_key_bytes = endpoint.public_key
-        endpoint_public_key: ec.EllipticCurvePublicKey = load_ec_public_key_from_bytes(
-            endpoint_public_key_bytes
-        )
-        endpoint_public_key_x, _ = get_ec_key_public_points(endpoint_public_key)
-
-        # Whoever did this. Did that help? ;)
-        info_material = (
+    # Whoever did this. Did that help? ;)
+    # Everything but the endpoint public key is the same for every candidate,
+    # so the info is packed once around the place where the endpoint key goes
+    reader_info = pack(
+        (
             reader_public_key_x,
             Context.VOLATILE_FAST,
             reader_identifier,
-            endpoint_public_key_x,
-            interface,
+        )
+    )
+    info_suffix = pack(
+        (
             TLV(0x5C, value=device_protocol_versions),
             TLV(0x5C, value=protocol_version),
             reader_ephemeral_public_key_x,
@@ -219,38 +610,36 @@ def fast_auth(
             flags,
             endpoint_ephemeral_public_key_x,
         )
+    )
 
-        info = pack(info_material)
+    # FAST gives us no way to find out the identity of endpoint from the data for security reasons,
+    # so we have to iterate over all provisioned endpoints and hope that it's there
+    log.info("Searching for an endpoint with matching cryptogram...")
+    endpoint, hkdf = find_endpoint_by_cryptogram(
+        order_endpoints_for_search(get_endpoints_from_issuers(issuers)),
+        cryptogram=bytes(returned_cryptogram),
+        reader_info=reader_info,
+        interface=interface,
+        info_suffix=info_suffix,
+        key_size=key_size,
+        search_pool=search_pool,
+    )
+    if endpoint is None:
+        return endpoint_ephemeral_public_key, None, None
 
-        hkdf = HKDF(
-            algorithm=hashes.SHA256(),
-            length=key_size * 4,
-            salt=None,
-            info=info,
-        ).derive(k_persistent)
-        kcmac = hkdf[: key_size * 1]
-        kenc = hkdf[key_size * 1 : key_size * 2]
-        kmac = hkdf[key_size * 2 : key_size * 3]
-        krmac = hkdf[key_size * 3 :]
-        calculated_cryptogram = kcmac
-        log.info(
-            f"Endpoint({endpoint.id.hex()}):"
-            f" returned_cryptogram={returned_cryptogram.hex()}"
-            f" ? calculated_cryptogram={calculated_cryptogram.hex()}"
-        )
-        if returned_cryptogram == calculated_cryptogram:
-            log.info(
-                f"Cryptograms match for Endpoint({endpoint.id.hex()}):"
-                f" kcmac={kcmac.hex()} kenc={kenc.hex()} kmac={kmac.hex()} krmac={krmac.hex()};"
-            )
-            return (
-                endpoint_ephemeral_public_key,
-                endpoint,
-                DigitalKeySecureContext(tag, kenc, kmac, krmac),
-            )
-        else:
-            endpoint = None
-    return endpoint_ephemeral_public_key, endpoint, None
+    kcmac = hkdf[: key_size * 1]
+    kenc = hkdf[key_size * 1 : key_size * 2]
+    kmac = hkdf[key_size * 2 : key_size * 3]
+    krmac = hkdf[key_size * 3 :]
+    log.info(
+        f"Cryptograms match for Endpoint({endpoint.id.hex()}):"
+        f" kcmac={kcmac.hex()} kenc={kenc.hex()} kmac={kmac.hex()} krmac={krmac.hex()};"
+    )
+    return (
+        endpoint_ephemeral_public_key,
+        endpoint,
+        DigitalKeySecureContext(tag, kenc, kmac, krmac),
+    )
 
 
 def standard_auth(
@@ -266,6 +655,10 @@ def standard_auth(
     endpoint_ephemeral_public_key: ec.EllipticCurvePublicKey,
     issuers: List[Issuer],
     key_size=16,
+    # Started in the background by this function if not provided
+    session_keys: Optional["Future[Tuple[bytes, bytes]]"] = None,
+    # Calculated by this function if not provided
+    reader_signature: Optional["Future[bytes]"] = None,
 ) -> Tuple[Optional[bytes], Optional[Endpoint], Optional[DigitalKeySecureContext]]:
     reader_ephemeral_public_key = reader_ephemeral_private_key.public_key()
 
@@ -280,23 +673,31 @@ def standard_auth(
         f" reader_ephemeral_public_key_x={reader_ephemeral_public_key_x.hex()}"
     )
 
-    authentication_hash_input_material = [
-        TLV(0x4D, value=reader_identifier),
-        TLV(0x86, value=endpoint_ephemeral_public_key_x),
-        TLV(0x87, value=reader_ephemeral_public_key_x),
-        TLV(0x4C, value=transaction_identifier),
-        TLV(0x93, value=READER_CONTEXT),
-    ]
-    authentication_hash_input = pack(authentication_hash_input_material)
-    log.info(f"authentication_hash_input={authentication_hash_input.hex()}")
+    # Session keys depend only on AUTH0 data, so they are derived while AUTH1 is in flight
+    if session_keys is None:
+        session_keys = background_executor.submit(
+            derive_session_keys,
+            reader_ephemeral_private_key=reader_ephemeral_private_key,
+            endpoint_ephemeral_public_key=endpoint_ephemeral_public_key,
+            transaction_identifier=transaction_identifier,
+            interface=interface,
+            flags=flags,
+            protocol_version=protocol_version,
+            device_protocol_versions=device_protocol_versions,
+            key_size=key_size,
+        )
 
-    signature = reader_private_key.sign(
-        authentication_hash_input, ec.ECDSA(hashes.SHA256())
+    signature_point_form = (
+        reader_signature.result()
+        if reader_signature is not None
+        else sign_authentication_hash_input(
+            reader_private_key=reader_private_key,
+            reader_identifier=reader_identifier,
+            endpoint_ephemeral_public_key_x=endpoint_ephemeral_public_key_x,
+            reader_ephemeral_public_key_x=reader_ephemeral_public_key_x,
+            transaction_identifier=transaction_identifier,
+        )
     )
-    log.info(f"signature={signature.hex()} ({hex(len(signature))})")
-    x, y = decode_dss_signature(signature)
-    signature_point_form = bytes([*x.to_bytes(32, "big"), *y.to_bytes(32, "big")])
-    log.info(f"signature_point_form={signature_point_form.hex()} ({hex(len(signature_point_form))})")
 
     data = TLV(0x9E, value=signature_point_form)
     command = ISO7816Command(cla=0x80, ins=0x81, p1=0x00, p2=0x00, data=data)
@@ -307,20 +708,8 @@ def standard_auth(
     if response.sw != (0x90, 0x00):
         raise ProtocolError(f"AUTH1 INVALID STATUS {response.sw}")
 
-    get_key_material = get_key_material_generator(
-        reader_ephemeral_private_key=reader_ephemeral_private_key,
-        endpoint_ephemeral_public_key=endpoint_ephemeral_public_key,
-        transaction_identifier=transaction_identifier,
-        interface=interface,
-        flags=flags,
-        protocol_version=protocol_version,
-        device_protocol_versions=device_protocol_versions,
-    )
-
-    k_persistent = get_key_material(context=Context.PERSISTENT, key_size=key_size * 2)
+    k_persistent, hkdf = session_keys.result()
     log.info(f"k_persistent={k_persistent.hex()}")
-
-    hkdf = get_key_material(context=Context.VOLATILE, key_size=key_size * 3)
     log.info(f"hkdf={hkdf.hex()}")
     kenc = hkdf[: key_size * 1]
     kmac = hkdf[key_size * 1 : key_size * 2]
@@ -339,13 +728,12 @@ def standard_auth(
 
     tlv_array = TLV.unpack_array(response.data)
 
-    signature = get_tlv_tag(tlv_array, 0x9E)
-    if signature is None:
-        raise ProtocolError("No device signature in response at tag 0x9E")
-
-    device_identifier = get_tlv_tag(tlv_array, 0x4E)
-    if device_identifier is None:
-        raise ProtocolError("No device identifier in response at tag 0x4E")
+    signature = tlv_array.require(
+        0x9E, "No device signature in response at tag 0x9E", error=ProtocolError
+    )
+    device_identifier = tlv_array.require(
+        0x4E, "No device identifier in response at tag 0x4E", error=ProtocolError
+    )
 
     log.info(f"device_identifier={device_identifier.hex()}")
 
@@ -354,9 +742,7 @@ def standard_auth(
         log.warning("Could not find matching endpoint")
         return k_persistent, None, secure
 
-    endpoint_public_key: ec.EllipticCurvePublicKey = load_ec_public_key_from_bytes(
-        endpoint.public_key
-    )
+    endpoint_public_key = endpoint_key_material_cache.get(endpoint).public_key
 
     log.info(f"signature={signature.hex()}")
     signature = encode_dss_signature(
@@ -406,29 +792,25 @@ def exchange_attestation(tag: ISO7816Tag, shared_secret: bytes):
             ),
         ]
     )
+    envelope1_engagement_data = envelope1_engagement_message.pack()
     envelope1_command = ISO7816Command(
         cla=0x00,
         ins=0xC3,
         p1=0x00,
         p2=0x01,
         le=0x00,
-        data=pack(TLV(0x53, value=envelope1_engagement_message)),
+        data=pack(TLV(0x53, value=envelope1_engagement_data)),
     )
     log.info(f"ENVELOPE1 CMD = {envelope1_command}")
     envelope1_response = tag.transceive(envelope1_command)
     log.info(f"ENVELOPE1 RES = {envelope1_response}")
 
-    envelope1_command_ndef = NDEFMessage.unpack(
-        TLV.unpack(envelope1_command.data).value
-    )
-    envelope1_response_ndef = NDEFMessage.unpack(
-        TLV.unpack(envelope1_response.data).value
-    )
-
+    # Handover messages go into the session transcript exactly as they were sent
+    envelope1_response_data = TLV.unpack(envelope1_response.data).value
     response_engagement = next(
         (
             r
-            for r in envelope1_response_ndef.records
+            for r in NDEFMessage.iter_records(envelope1_response_data)
             if r.type == b"iso.org:18013:deviceengagement"
         ),
         None,
@@ -442,8 +824,8 @@ def exchange_attestation(tag: ISO7816Tag, shared_secret: bytes):
                 [
                     cbor2.CBORTag(24, cbor2.dumps(response_engagement_cbor)),
                     [
-                        envelope1_response_ndef.pack(),
-                        envelope1_command_ndef.pack(),
+                        bytes(envelope1_response_data),
+                        envelope1_engagement_data,
                     ],
                 ]
             ),
@@ -487,20 +869,16 @@ def exchange_attestation(tag: ISO7816Tag, shared_secret: bytes):
         cla=0x00, ins=0xC3, p1=0x00, p2=0x00, data=envelope2_command_data, le=0x00
     )
     log.info(f"ENVELOPE2 CMD = {command}")
-    response = tag.transceive(command)
-    log.info(f"ENVELOPE2 RES = {response}")
-
+    round_trips = tag.round_trips
+    try:
+        response = tag.transceive_chained(command)
+    except ValueError as e:
+        raise ProtocolError(f"ENVELOPE2 {e}")
+    log.info(
+        f"ENVELOPE2 RES = {response} in {tag.round_trips - round_trips} round trips"
+    )
     data = response.data
 
-    while response.sw1 == 0x61:
-        command = ISO7816Command(
-            cla=0x00, ins=0xC0, p1=0x00, p2=0x00, data=None, le=response.sw2
-        )
-        log.info(f"GET DATA CMD = {command}")
-        response = tag.transceive(command)
-        log.info(f"GET DATA RES = {response}")
-        data += response.data
-
     endpoint_cbor_plaintext = iso18013secure.decrypt_message_from_endpoint(
         TLV.unpack(data).value
     )
@@ -540,8 +918,14 @@ def select_applet(tag: ISO7816Tag, applet=ISO7816Application.HOME_KEY):
     return response.data
 
 
+@functools.lru_cache(maxsize=8)
+def get_control_flow_command(p1: int, p2: int) -> ISO7816Command:
+    # There are only a few distinct control flow commands, each is packed once
+    return ISO7816Command(cla=0x80, ins=0x3C, p1=p1, p2=p2, data=None, le=None)
+
+
 def control_flow(tag: ISO7816Tag, p1=0x01, p2=0x00):
-    command = ISO7816Command(cla=0x80, ins=0x3C, p1=p1, p2=p2, data=None, le=None)
+    command = get_control_flow_command(p1, p2)
     log.info(f"OP_CONTROL_FLOW CMD = {command}")
     response = tag.transceive(command)
     log.info(f"OP_CONTROL_FLOW RES = {response}")
@@ -562,13 +946,20 @@ def perform_authentication_flow(
     interface: int,
     issuers: List[Issuer],
     key_size=16,
+    search_pool: Optional[CryptogramSearchPool] = None,
+    prepared_transaction: Optional[PreparedTransaction] = None,
+    # Calculated from reader_private_key if not provided
+    reader_public_key_points: Optional[Tuple[bytes, bytes]] = None,
+    # Prepare STANDARD flow in the background while FAST search is running.
+    # Always done if the flow requires going beyond FAST
+    speculative: bool = False,
 ) -> Tuple[DigitalKeyFlow, Optional[Issuer], Optional[Endpoint]]:
     """Returns an Endpoint if one was found and successfully authenticated.
     Returns an Issuer if endpoint was authenticated via Attestation
     """
     reader_public_key = reader_private_key.public_key()
-    reader_public_key_x, reader_public_key_y = get_ec_key_public_points(
-        reader_public_key
+    reader_public_key_x, reader_public_key_y = (
+        reader_public_key_points or get_ec_key_public_points(reader_public_key)
     )
     log.info(
         f"Reader public key: x={reader_public_key_x.hex()} y={reader_public_key_y.hex()}"
@@ -578,6 +969,40 @@ def perform_authentication_flow(
 
     log.info(f"protocol_version={protocol_version.hex()}")
 
+    speculation: Dict[str, Future] = dict()
+
+    # STANDARD is certain if it is the minimum flow, otherwise the work may be thrown away
+    executor = (
+        background_executor if flow > DigitalKeyFlow.FAST else speculation_executor
+    )
+
+    def prepare_standard_auth(endpoint_ephemeral_public_key):
+        endpoint_ephemeral_public_key_x, _ = get_ec_key_public_points(
+            endpoint_ephemeral_public_key
+        )
+        reader_ephemeral_public_key_x, _ = get_ec_key_public_points(
+            reader_ephemeral_public_key
+        )
+        speculation["signature"] = executor.submit(
+            sign_authentication_hash_input,
+            reader_private_key=reader_private_key,
+            reader_identifier=reader_identifier,
+            endpoint_ephemeral_public_key_x=endpoint_ephemeral_public_key_x,
+            reader_ephemeral_public_key_x=reader_ephemeral_public_key_x,
+            transaction_identifier=transaction_identifier,
+        )
+        speculation["session_keys"] = executor.submit(
+            derive_session_keys,
+            reader_ephemeral_private_key=reader_ephemeral_private_key,
+            endpoint_ephemeral_public_key=endpoint_ephemeral_public_key,
+            transaction_identifier=transaction_identifier,
+            interface=interface,
+            flags=flags,
+            protocol_version=protocol_version,
+            device_protocol_versions=device_protocol_versions,
+            key_size=key_size,
+        )
+
     endpoint_ephemeral_public_key, endpoint, secure = fast_auth(
         tag=tag,
         device_protocol_versions=device_protocol_versions,
@@ -590,11 +1015,26 @@ def perform_authentication_flow(
         transaction_identifier=transaction_identifier,
         issuers=issuers,
         key_size=key_size,
+        search_pool=search_pool,
+        prepared_transaction=prepared_transaction,
+        reader_public_key_x=reader_public_key_x,
+        on_auth0=(
+            prepare_standard_auth if speculative or flow > DigitalKeyFlow.FAST else None
+        ),
     )
 
     if endpoint is not None and flow <= DigitalKeyFlow.FAST:
+        if speculation:
+            log.info("Discarding speculative STANDARD preparation")
+            metrics.increment("speculation.discarded")
+        # Only work that hasn't started yet can be cancelled, the rest runs to completion
+        for future in speculation.values():
+            future.cancel()
         return DigitalKeyFlow.FAST, None, endpoint
 
+    if speculation:
+        metrics.increment("speculation.used")
+
     k_persistent, endpoint, secure = standard_auth(
         tag=tag,
         device_protocol_versions=device_protocol_versions,
@@ -608,6 +1048,8 @@ def perform_authentication_flow(
         issuers=issuers,
         endpoint_ephemeral_public_key=endpoint_ephemeral_public_key,
         key_size=key_size,
+        session_keys=speculation.get("session_keys"),
+        reader_signature=speculation.get("signature"),
     )
 
     if endpoint is not None and k_persistent is not None:
@@ -626,17 +1068,20 @@ def perform_authentication_flow(
     attestation_package = exchange_attestation(tag, attestation_exchange_common_secret)
     log.info(f"attestation_package={attestation_package}")
 
-    attestation_package_cbor = cbor2.loads(attestation_package)
-    issuer_signed_cbor = attestation_package_cbor["documents"][0]["issuerSigned"][
-        "issuerAuth"
-    ]
-    protected_headers, unprotected_headers, data, signature = issuer_signed_cbor
-    issuer_id = unprotected_headers[4]
-    data_cbor = cbor2.loads(cbor2.loads(data).value)
-    device_key_info = data_cbor["deviceKeyInfo"]["deviceKey"]
+    digest = attestation_cache.digest(attestation_package)
+    verified = attestation_cache.get_verified(digest)
+    if verified is not None:
+        verified_issuer_public_key, issuer_auth = verified
+    else:
+        verified_issuer_public_key = None
+        try:
+            issuer_auth = parse_issuer_auth(attestation_package)
+        except (KeyError, IndexError, TypeError, ValueError) as e:
+            raise ProtocolError(f"Malformed attestation package: {e!r}") from e
+    issuer_id = issuer_auth.issuer_id
     device_public_key_x, device_public_key_y = (
-        device_key_info[-2],
-        device_key_info[-3],
+        issuer_auth.device_key[-2],
+        issuer_auth.device_key[-3],
     )
     device_public_key_bytes = (
         bytes.fromhex("04") + device_public_key_x + device_public_key_y
@@ -646,15 +1091,21 @@ def perform_authentication_flow(
     if issuer is None:
         raise ProtocolError(f"Could not find issuer {issuer_id}")
 
-    public_key = ed25519.Ed25519PublicKey.from_public_bytes(issuer.public_key)
+    if verified_issuer_public_key != issuer.public_key:
+        public_key = attestation_cache.get_issuer_key(issuer.public_key)
 
-    data_to_sign = cbor2.dumps([COSE_CONTEXT, protected_headers, COSE_AAD, data])
+        data_to_sign = cbor2.dumps(
+            [COSE_CONTEXT, issuer_auth.protected_headers, COSE_AAD, issuer_auth.payload]
+        )
 
-    try:
-        public_key.verify(signature, data_to_sign)
-    except InvalidSignature:
-        log.info("Attestation signature is invalid ")
-        return DigitalKeyFlow.ATTESTATION, None, None
+        try:
+            public_key.verify(issuer_auth.signature, data_to_sign)
+        except InvalidSignature:
+            log.info("Attestation signature is invalid ")
+            return DigitalKeyFlow.ATTESTATION, None, None
+        attestation_cache.add_verified(digest, issuer.public_key, issuer_auth)
+    else:
+        log.info("Attestation package has already been verified")
 
     log.info(f"Attestation signature is valid {endpoint}")
 
@@ -681,8 +1132,8 @@ def perform_authentication_flow(
 
 def read_homekey(
     tag: ISO7816Tag,
-    reader_identifier: bytes,
-    reader_private_key: bytes,
+    reader_identifier: Optional[bytes],
+    reader_private_key: Optional[bytes],
     issuers: List[Issuer],
     preferred_versions: Collection[bytes] = None,
     flow=DigitalKeyFlow.FAST,
@@ -695,29 +1146,34 @@ def read_homekey(
     attestation_exchange_common_secret: Optional[bytes] = None,
     interface=Interface.CONTACTLESS,
     key_size=16,
+    # Cryptogram search is done on the calling thread if not provided
+    search_pool: Optional[CryptogramSearchPool] = None,
+    # Takes priority over ephemeral key, transaction identifier and common secret if provided
+    prepared_transaction: Optional[PreparedTransaction] = None,
+    # Takes priority over reader_identifier and reader_private_key if provided
+    reader_identity: Optional[ReaderIdentity] = None,
+    # Prepare STANDARD flow in the background while FAST search is running
+    speculative: bool = False,
 ) -> Tuple[DigitalKeyFlow, List[Issuer], Optional[Endpoint]]:
     """
     Returns a list representing new configured issuer state
     and an optional endpoint in case authentication has been successful
     """
-    transaction_flags = {
-        DigitalKeyTransactionFlags.FAST
-        if flow <= DigitalKeyFlow.FAST
-        else DigitalKeyTransactionFlags.STANDARD
-    }
-    flags = bytes([sum(transaction_flags), transaction_code])
+    flags = get_transaction_flags(flow, transaction_code)
+    if reader_identity is not None:
+        reader_identifier = reader_identity.identifier
 
     response = select_applet(tag, applet=ISO7816Application.HOME_KEY)
     tlv_array = TLV.unpack_array(response)
     log.info(f"reader_identifier={reader_identifier.hex()}")
 
-    versions_tag = get_tlv_tag(tlv_array, 0x5C)
-    if versions_tag is None:
-        raise ProtocolError(
-            "Response does not contain supported version list at tag 0x5C"
-        )
+    versions_tag = tlv_array.require(
+        0x5C,
+        "Response does not contain supported version list at tag 0x5C",
+        error=ProtocolError,
+    )
 
-    device_protocol_versions = [ver for ver in chunked(versions_tag, 2)]
+    device_protocol_versions = [bytes(ver) for ver in chunked(versions_tag, 2)]
     preferred_versions = preferred_versions or []
     for preferred_version in preferred_versions:
         if preferred_version in device_protocol_versions:
@@ -727,30 +1183,63 @@ def read_homekey(
     else:
         protocol_version = device_protocol_versions[0]
         log.info(f"Defaulting to the newest available version {protocol_version}")
-    if protocol_version != b"\x02\x00":
+    if protocol_version != SUPPORTED_PROTOCOL_VERSION:
         raise ProtocolError("Only officially supported protocol version is 0200")
 
-    reader_private_key = ec.derive_private_key(
-        int.from_bytes(reader_private_key, "big"), ec.SECP256R1()
-    )
+    if reader_identity is not None:
+        if reader_identity.key is None:
+            # Already reported when the repository was loaded
+            raise ProtocolError("Reader private key is not a valid SECP256R1 key")
+        reader_private_key = reader_identity.key
+        reader_public_key_points = (
+            reader_identity.public_key_x,
+            reader_identity.public_key_y,
+        )
+    else:
+        reader_private_key = ec.derive_private_key(
+            int.from_bytes(reader_private_key, "big"), ec.SECP256R1()
+        )
+        reader_public_key_points = None
+
+    if prepared_transaction is not None and not prepared_transaction.matches(
+        reader_identifier, flags, protocol_version
+    ):
+        log.info("Prepared transaction does not match current parameters, ignoring")
+        prepared_transaction = None
+
+    if prepared_transaction is not None:
+        reader_ephemeral_private_key = prepared_transaction.reader_ephemeral_private_key
+        transaction_identifier = prepared_transaction.transaction_identifier
+        attestation_exchange_common_secret = (
+            prepared_transaction.attestation_exchange_common_secret
+        )
+    else:
+        reader_ephemeral_private_key = generate_ec_key_if_provided_is_none(
+            reader_ephemeral_private_key
+        )
+        transaction_identifier = transaction_identifier or os.urandom(16)
+        attestation_exchange_common_secret = (
+            attestation_exchange_common_secret or os.urandom(32)
+        )
 
     result_flow, issuer, endpoint = perform_authentication_flow(
         tag=tag,
         flow=flow,
         reader_identifier=reader_identifier,
         reader_private_key=reader_private_key,
-        reader_ephemeral_private_key=generate_ec_key_if_provided_is_none(
-            reader_ephemeral_private_key
-        ),
-        attestation_exchange_common_secret=attestation_exchange_common_secret
-        or os.urandom(32),
+        reader_ephemeral_private_key=reader_ephemeral_private_key,
+        attestation_exchange_common_secret=attestation_exchange_common_secret,
         protocol_version=protocol_version,
         device_protocol_versions=device_protocol_versions,
-        transaction_identifier=transaction_identifier or os.urandom(16),
+        transaction_identifier=transaction_identifier,
         flags=flags,
         interface=interface,
         issuers=issuers,
         key_size=key_size,
+        search_pool=search_pool,
+        prepared_transaction=prepared_transaction,
+        reader_public_key_points=reader_public_key_points,
+        speculative=speculative,
     )
     if endpoint is not None:
         endpoint.last_used_at = int(time.time())
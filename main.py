@@ -48,6 +48,8 @@ def configure_nfc_device(config: dict):
     clf = BroadcastFrameContactlessFrontend(
         path=config.get("path", None) or f"tty:{config.get('port')}:{config.get('driver')}",
         broadcast_enabled=config.get("broadcast", True),
+        auto_poll=config.get("auto_poll", False) in (True, "True", "true", "1"),
+        baudrate=int(config.get("baudrate") or 0) or None,
     )
     return clf
 
@@ -61,8 +63,17 @@ def configure_homekey_service(config: dict, nfc_device, repository=None, webhook
         flow=config.get("flow"),
         webhook_config=webhook_config,
         door_status_config=door_status_config,
-        # Poll no more than ~6 times a second by default
+        # Poll no more than ~6 times a second when idle by default
         throttle_polling=float(config.get("throttle_polling") or 0.15),
+        polling_min_interval=float(config.get("polling_min_interval") or 0.02),
+        polling_burst=float(config.get("polling_burst", 10)),
+        polling_duty_cycle=float(config.get("polling_duty_cycle") or 0.5),
+        cooldown=float(config.get("cooldown", 2)),
+        search_workers=int(config.get("search_workers") or 0),
+        search_pool=config.get("search_pool") or "process",
+        prepared_transactions=int(config.get("prepared_transactions", 2)),
+        speculative=config.get("speculative", False),
+        extended_length=config.get("extended_length", False),
     )
     return service
 
@@ -1,11 +1,11 @@
 import copy
-import hashlib
 import json
 import logging
 from threading import Lock
 from typing import List, Optional
 
-from entity import Endpoint, Issuer
+from cache import attestation_cache, endpoint_key_material_cache
+from entity import Endpoint, Issuer, ReaderIdentity
 
 log = logging.getLogger()
 
@@ -20,6 +20,7 @@ class Repository:
         self._reader_private_key = bytes.fromhex("00" * 32)
         self._reader_identifier = bytes.fromhex("00" * 8)
         self._issuers = list()
+        self._reader_identity = None
         self._transaction_lock = Lock()
         self._state_lock = Lock()
         self._load_state_from_file()
@@ -43,6 +44,22 @@ class Repository:
                 f"Could not load Home Key configuration. Assuming that device is not yet configured..."
             )
             pass
+        self._update_reader_identity()
+
+    def _update_reader_identity(self):
+        identity = self._reader_identity
+        if identity is not None and (
+            identity.private_key,
+            identity.unique_identifier,
+        ) == (self._reader_private_key, self._reader_identifier):
+            return
+        self._reader_identity = ReaderIdentity.from_private_key(
+            self._reader_private_key, self._reader_identifier
+        )
+        if self._reader_identity.key is None:
+            log.warning(
+                "Reader private key is not a valid SECP256R1 key. Assuming that device is not yet configured..."
+            )
 
     def _save_state_to_file(self):
         with self._state_lock:
@@ -78,10 +95,11 @@ class Repository:
             self._reader_identifier = reader_identifier
             self._refresh_state()
 
+    def get_reader_identity(self) -> ReaderIdentity:
+        return self._reader_identity
+
     def get_reader_group_identifier(self):
-        return (
-            hashlib.sha256("key-identifier".encode() + self.get_reader_private_key())
-        ).digest()[:8]
+        return self._reader_identity.group_identifier
 
     def get_all_issuers(self):
         return copy.deepcopy([i for i in self._issuers])
@@ -124,6 +142,10 @@ class Repository:
 
     def remove_issuer(self, issuer: Issuer):
         with self._transaction_lock:
+            for removed in (i for i in self._issuers if i.id == issuer.id):
+                for endpoint in removed.endpoints:
+                    endpoint_key_material_cache.invalidate(endpoint.id)
+                attestation_cache.invalidate_issuer(removed.public_key)
             issuers = [i for i in copy.deepcopy(self._issuers) if i.id != issuer.id]
             self._issuers = issuers
             self._refresh_state()
@@ -151,6 +173,7 @@ class Repository:
             if endpoint not in endpoints:
                 endpoints.append(endpoint)
             issuer.endpoints = endpoints
+            endpoint_key_material_cache.invalidate(endpoint.id)
             self._refresh_state()
 
     def upsert_issuers(self, issuers: List[Issuer]):
@@ -1,4 +1,5 @@
 import base64
+import functools
 import logging
 import time
 import os
@@ -8,6 +9,7 @@ import requests
 from entity import (
     Issuer,
     Operation,
+    ReaderIdentity,
     ReaderKeyResponse,
     ReaderKeyRequest,
     HardwareFinishResponse,
@@ -22,7 +24,13 @@ from entity import (
     ControlPointRequest,
     ControlPointResponse,
 )
-from homekey import read_homekey, ProtocolError
+from homekey import (
+    CryptogramSearchPool,
+    get_transaction_flags,
+    prepare_transaction,
+    read_homekey,
+    ProtocolError,
+)
 from repository import Repository
 from util.bfclf import (
     BroadcastFrameContactlessFrontend,
@@ -31,8 +39,12 @@ from util.bfclf import (
     ISODEPTag,
 )
 from util.digital_key import DigitalKeyFlow, DigitalKeyTransactionType
-from util.ecp import ECP
+from util.ecp import get_home_frame
 from util.iso7816 import ISO7816Tag
+from util.metrics import metrics
+from util.polling import PollingScheduler
+from util.presence import PresenceDetector
+from util.pool import PrefilledPool
 from util.threads import create_runner
 from util.structable import pack_into_base64_string, unpack_from_base64_string
 
@@ -49,11 +61,29 @@ class Service:
         flow: str = "fast",
         webhook_config=None,
         door_status_config=None,
-        throttle_polling = 0.1
+        throttle_polling = 0.1,
+        polling_min_interval: float = 0.02,
+        polling_burst: float = 10.0,
+        polling_duty_cycle: float = 0.5,
+        cooldown: float = 2.0,
+        search_workers: int = 0,
+        search_pool: str = "process",
+        prepared_transactions: int = 2,
+        speculative: bool = False,
+        extended_length: bool = False,
     ) -> None:
         self.repository = repository
         self.clf = clf
         self.throttle_polling = throttle_polling
+        self.polling = PollingScheduler(
+            min_interval=polling_min_interval,
+            max_interval=throttle_polling,
+            burst=polling_burst,
+            duty_cycle=polling_duty_cycle,
+        )
+        self.presence = PresenceDetector(cooldown=cooldown)
+        # Sequential search unless configured otherwise
+        self.search_pool = CryptogramSearchPool.from_config(search_workers, search_pool)
         self.express = express in (True, "True", "true", "1")
         self.webhook_config = webhook_config
         self.door_status_config = door_status_config
@@ -72,9 +102,19 @@ class Service:
                 f"Digital Key flow {flow} is not supported. Falling back to {self.flow}"
             )
 
+        self.prepared_transactions = prepared_transactions
+        self.speculative = speculative in (True, "True", "true", "1")
+        self.extended_length = extended_length in (True, "True", "true", "1")
+        self._transaction_pool = None
+        self._transaction_pool_reader_identifier = None
+
         self._run_flag = True
         self._runner = None
 
+    def notify_activity(self):
+        """Makes reader poll faster for a while, e.g. when someone is expected to tap soon"""
+        self.polling.notify_activity()
+
     def on_endpoint_authenticated(self, endpoint):
         """This method will be called when an endpoint is authenticated"""
         # Currently overwritten by accessory.py
@@ -175,6 +215,10 @@ class Service:
         self._run_flag = False
         if self._runner is not None:
             self._runner.join()
+        if self.search_pool is not None:
+            self.search_pool.shutdown()
+        if self._transaction_pool is not None:
+            self._transaction_pool.stop()
 
     def update_hap_pairings(self, issuer_public_keys):
         issuers = {
@@ -193,22 +237,47 @@ class Service:
             log.info(f"Adding issuer {issuer} based on paired clients")
             self.repository.upsert_issuer(issuer)
 
+    def _refresh_transaction_pool(self, reader_identity: ReaderIdentity):
+        """(Re)starts preparing transactions in the background when reader identity changes"""
+        reader_identifier = reader_identity.identifier
+        if (
+            self.prepared_transactions <= 0
+            or self._transaction_pool_reader_identifier == reader_identifier
+        ):
+            return
+        factory = functools.partial(
+            prepare_transaction,
+            reader_identifier=reader_identifier,
+            flags=get_transaction_flags(self.flow, DigitalKeyTransactionType.UNLOCK),
+        )
+        if self._transaction_pool is None:
+            self._transaction_pool = PrefilledPool(
+                factory, size=self.prepared_transactions, name="transaction_pool"
+            )
+        else:
+            log.info("Reader identity has changed, discarding prepared transactions")
+            self._transaction_pool.reset(factory)
+        self._transaction_pool_reader_identifier = reader_identifier
+
     def _read_homekey(self):
         start = time.monotonic()
 
+        reader_identity = self.repository.get_reader_identity()
+        self._refresh_transaction_pool(reader_identity)
+
         remote_target = self.clf.sense(
             RemoteTarget("106A"),
-            broadcast=ECP.home(
-                identifier=self.repository.get_reader_group_identifier(),
-                flag_2=self.express,
-            ).pack(),
+            broadcast=get_home_frame(reader_identity.group_identifier, self.express),
         )
 
-        if remote_target is None:
+        uid = bytes(remote_target.sdd_res or b"") if remote_target is not None else b""
+        if remote_target is None or self.presence.is_suppressed(uid):
             # Throttle polling attempts to prevent overheating & RF performance degradation
-            time.sleep(max(0, self.throttle_polling - time.monotonic() + start))
+            self.polling.wait(start)
             return
 
+        self.polling.notify_activity()
+
         target = activate(self.clf, remote_target)
         if target is None:
             return
@@ -217,14 +286,17 @@ class Service:
             log.info(
                 f"Found non-ISODEP Tag with UID: {target.identifier.hex().upper()}"
             )
-            while self.clf.sense(RemoteTarget("106A")) is not None:
-                log.info("Waiting for target to leave the field...")
-                time.sleep(0.5)
+            log.info("Waiting for target to leave the field...")
+            self.presence.served(
+                uid,
+                time.monotonic(),
+                is_present=lambda: self.clf.sense(RemoteTarget("106A")) is not None,
+            )
             return
 
         log.info(f"Got NFC tag {target}")
 
-        tag = ISO7816Tag(target)
+        tag = ISO7816Tag(target, extended_length=self.extended_length)
         try:
             result_flow, new_issuers_state, endpoint = read_homekey(
                 tag,
@@ -232,10 +304,15 @@ class Service:
                 preferred_versions=[b"\x02\x00"],
                 flow=self.flow,
                 transaction_code=DigitalKeyTransactionType.UNLOCK,
-                reader_identifier=self.repository.get_reader_group_identifier()
-                + self.repository.get_reader_identifier(),
-                reader_private_key=self.repository.get_reader_private_key(),
+                reader_identifier=None,
+                reader_private_key=None,
+                reader_identity=reader_identity,
+                speculative=self.speculative,
                 key_size=16,
+                search_pool=self.search_pool,
+                prepared_transaction=self._transaction_pool.take()
+                if self._transaction_pool is not None
+                else None,
             )
 
             if new_issuers_state is not None and len(new_issuers_state):
@@ -245,19 +322,33 @@ class Service:
 
             end = time.monotonic()
             log.info(f"Transaction took {(end - start) * 1000} ms")
+            log.info(f"FAST search {metrics.to_dict(prefix='fast.')}")
+            metrics.observe(f"round_trips.{result_flow.name.lower()}", tag.round_trips)
+            log.info(f"APDU round trips {metrics.to_dict(prefix='round_trips.')}")
+            metrics.observe(
+                f"apdu_time.{result_flow.name.lower()}", tag.transceive_time * 1000
+            )
+            log.info(
+                f"APDU exchange took {tag.transceive_time * 1000:.1f} ms, "
+                f"per command {metrics.to_dict(prefix='apdu.')}"
+            )
+            log.info(f"Chipset traffic {metrics.to_dict(prefix='chipset.')}")
+            if result_flow == DigitalKeyFlow.ATTESTATION:
+                log.info(
+                    f"Attestation cache {metrics.to_dict(prefix='attestation_cache.')}"
+                )
 
             if endpoint is not None:
                 self.on_endpoint_authenticated(endpoint)
         except ProtocolError as e:
             log.info(f'Could not authenticate device due to protocol error "{e}"')
 
-        # Let device cool down, wait for ISODEP to drop to consider comms finished
-        while target.is_present:
-            log.info("Waiting for device to leave the field...")
-            time.sleep(0.5)
-        log.info("Device left the field. Continuing in 2 seconds...")
-        time.sleep(2)
-        log.info("Waiting for next device...")
+        # Wait for ISODEP to drop to consider comms finished, then ignore this device for a while
+        log.info("Waiting for device to leave the field...")
+        self.presence.served(
+            uid, time.monotonic(), is_present=lambda: target.is_present
+        )
+        log.info("Device left the field. Waiting for next device...")
 
     def run(self):
         if (self.clf is None) or (self.repository is None):
@@ -0,0 +1,8 @@
+import pytest
+
+from tests.helpers import SimulatedClock
+
+
+@pytest.fixture()
+def clock():
+    return SimulatedClock()
@@ -0,0 +1,33 @@
+import os
+
+from cryptography.hazmat.primitives.asymmetric import ec
+
+from entity import Endpoint, Enrollments, KeyType
+from util.crypto import get_ec_key_public_points
+
+
+class SimulatedClock:
+    """Monotonic clock that only moves when slept on"""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def generate_endpoint(private_key=None):
+    public_key_x, public_key_y = get_ec_key_public_points(
+        (private_key or ec.generate_private_key(ec.SECP256R1())).public_key()
+    )
+    return Endpoint(
+        last_used_at=0,
+        counter=0,
+        key_type=KeyType.SECP256R1,
+        public_key=b"\x04" + public_key_x + public_key_y,
+        persistent_key=os.urandom(32),
+        enrollments=Enrollments(hap=None, attestation=None),
+    )
@@ -0,0 +1,143 @@
+import copy
+import os
+
+import pytest
+from cryptography.hazmat.primitives.asymmetric import ed25519
+from cryptography.hazmat.primitives.serialization import Encoding, PublicFormat
+
+from cache import (
+    AttestationCache,
+    EndpointKeyMaterialCache,
+    endpoint_key_material_cache,
+)
+from entity import Issuer
+from repository import Repository
+from tests.helpers import generate_endpoint
+from util.iso18013 import IssuerAuth
+from util.metrics import metrics
+
+
+def issuer_auth():
+    return IssuerAuth(
+        protected_headers=b"",
+        issuer_id=os.urandom(8),
+        payload=os.urandom(32),
+        signature=os.urandom(64),
+        device_key={},
+    )
+
+
+def test_attestation_cache_evicts_least_recently_used():
+    cache = AttestationCache(maxsize=2)
+    first, second, third = (cache.digest(os.urandom(64)) for _ in range(3))
+    issuer_public_key = os.urandom(32)
+
+    cache.add_verified(first, issuer_public_key, issuer_auth())
+    cache.add_verified(second, issuer_public_key, issuer_auth())
+    assert cache.get_verified(first) is not None
+    cache.add_verified(third, issuer_public_key, issuer_auth())
+
+    assert len(cache) == 2
+    assert cache.get_verified(second) is None
+    assert cache.get_verified(first) is not None
+
+
+def test_attestation_cache_counts_hits_and_misses():
+    metrics.reset("attestation_cache.")
+    cache = AttestationCache()
+    digest = cache.digest(b"package")
+
+    assert cache.get_verified(digest) is None
+    cache.add_verified(digest, os.urandom(32), issuer_auth())
+    assert cache.get_verified(digest) is not None
+    assert cache.get_verified(digest) is not None
+
+    assert metrics.to_dict(prefix="attestation_cache.") == {
+        "attestation_cache.hits": 2,
+        "attestation_cache.misses": 1,
+    }
+
+
+def test_attestation_cache_invalidates_issuer():
+    cache = AttestationCache()
+    issuer_public_key = (
+        ed25519.Ed25519PrivateKey.generate()
+        .public_key()
+        .public_bytes(Encoding.Raw, PublicFormat.Raw)
+    )
+    other_issuer_public_key = os.urandom(32)
+    digest, other_digest = cache.digest(b"first"), cache.digest(b"second")
+    cache.add_verified(digest, issuer_public_key, issuer_auth())
+    cache.add_verified(other_digest, other_issuer_public_key, issuer_auth())
+    key = cache.get_issuer_key(issuer_public_key)
+    assert cache.get_issuer_key(issuer_public_key) is key
+
+    cache.invalidate_issuer(issuer_public_key)
+
+    assert cache.get_verified(digest) is None
+    assert cache.get_verified(other_digest) is not None
+    assert cache.get_issuer_key(issuer_public_key) is not key
+
+
+def test_endpoint_key_material_cache_returns_same_entry_on_hit():
+    cache = EndpointKeyMaterialCache()
+    endpoint = generate_endpoint()
+
+    key_material = cache.get(endpoint)
+
+    assert cache.get(endpoint) is key_material
+    assert cache.get(copy.deepcopy(endpoint)) is key_material
+    assert len(cache) == 1
+
+
+def test_endpoint_key_material_cache_rebuilds_entry_on_persistent_key_change():
+    cache = EndpointKeyMaterialCache()
+    endpoint = generate_endpoint()
+    key_material = cache.get(endpoint)
+
+    endpoint.persistent_key = os.urandom(32)
+    rebuilt = cache.get(endpoint)
+
+    assert rebuilt is not key_material
+    assert rebuilt.persistent_key == endpoint.persistent_key
+    assert cache.get(endpoint) is rebuilt
+
+
+@pytest.fixture()
+def repository(tmp_path):
+    repository = Repository(str(tmp_path / "homekey.json"))
+    issuer = Issuer(
+        public_key=os.urandom(32), endpoints=[generate_endpoint() for _ in range(2)]
+    )
+    other_issuer = Issuer(public_key=os.urandom(32), endpoints=[generate_endpoint()])
+    repository.upsert_issuers([issuer, other_issuer])
+    endpoint_key_material_cache.clear()
+    yield repository
+    endpoint_key_material_cache.clear()
+
+
+def test_upsert_endpoint_invalidates_key_material(repository):
+    issuer, other_issuer = repository.get_all_issuers()
+    endpoint, other_endpoint = issuer.endpoints
+    key_material = endpoint_key_material_cache.get(endpoint)
+    other_key_material = endpoint_key_material_cache.get(other_endpoint)
+
+    endpoint.counter += 1
+    repository.upsert_endpoint(issuer.id, endpoint)
+
+    assert endpoint_key_material_cache.get(endpoint) is not key_material
+    assert endpoint_key_material_cache.get(other_endpoint) is other_key_material
+
+
+def test_remove_issuer_drops_key_material_of_its_endpoints(repository):
+    issuer, other_issuer = repository.get_all_issuers()
+    (other_endpoint,) = other_issuer.endpoints
+    for endpoint in issuer.endpoints:
+        endpoint_key_material_cache.get(endpoint)
+    other_key_material = endpoint_key_material_cache.get(other_endpoint)
+    assert len(endpoint_key_material_cache) == 3
+
+    repository.remove_issuer(issuer)
+
+    assert len(endpoint_key_material_cache) == 1
+    assert endpoint_key_material_cache.get(other_endpoint) is other_key_material
@@ -0,0 +1,46 @@
+import os
+
+import pytest
+
+from util.crypto import aes_cmac
+from util.digital_key import (
+    COMMAND_PCB,
+    RESPONSE_PCB,
+    SecureMessagingSession,
+    decrypt,
+    encrypt,
+)
+
+
+@pytest.mark.parametrize("size", [0, 1, 15, 16, 17, 100, 200, 1000])
+def test_session_matches_one_shot_encryption(size):
+    kenc, kmac, krmac = os.urandom(16), os.urandom(16), os.urandom(16)
+    session = SecureMessagingSession(kenc, kmac, krmac)
+    plaintext = os.urandom(size)
+
+    for counter in (0, 1, 300):
+        ciphertext = session.encrypt(plaintext, pcb=COMMAND_PCB, counter=counter)
+
+        assert ciphertext == encrypt(plaintext, COMMAND_PCB, kenc, counter)
+        assert session.decrypt(ciphertext, pcb=COMMAND_PCB, counter=counter) == (
+            decrypt(ciphertext, COMMAND_PCB, kenc, counter)
+        )
+        assert session.decrypt(ciphertext, pcb=COMMAND_PCB, counter=counter) == (
+            plaintext
+        )
+
+    mac_chaining_value = os.urandom(16)
+    assert session.mac(mac_chaining_value, plaintext) == aes_cmac(
+        kmac, mac_chaining_value + plaintext
+    )
+    assert session.rmac(mac_chaining_value, plaintext) == aes_cmac(
+        krmac, mac_chaining_value + plaintext
+    )
+
+
+def test_session_decrypt_rejects_partial_blocks():
+    session = SecureMessagingSession(os.urandom(16), os.urandom(16), os.urandom(16))
+    ciphertext = session.encrypt(b"\x01" * 20, pcb=RESPONSE_PCB, counter=1)
+
+    with pytest.raises(ValueError):
+        session.decrypt(ciphertext[:-1], pcb=RESPONSE_PCB, counter=1)
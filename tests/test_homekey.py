@@ -1,18 +1,45 @@
 import os
+import threading
 
 import pytest
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives.asymmetric.utils import decode_dss_signature
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 
+from entity import (
+    Context,
+    Interface,
+    Issuer,
+    ReaderIdentity,
+)
+from util.crypto import get_ec_key_public_points
+from util.digital_key import DigitalKeyFlow, DigitalKeySecureContext
 from util.structable import pack
 from util.tlv import BERTLV as TLV
-from util.iso7816 import ISO7816Response, ISO7816Tag
-from homekey import read_homekey, ProtocolError
+from util.iso7816 import ISO7816Command, ISO7816Response, ISO7816Tag
+from util.metrics import metrics
+import homekey
+from homekey import (
+    DEVICE_CONTEXT,
+    CryptogramSearchPool,
+    derive_session_keys,
+    find_endpoint_by_cryptogram,
+    order_endpoints_for_search,
+    prepare_transaction,
+    read_homekey,
+    ProtocolError,
+)
+from tests.helpers import generate_endpoint
 
 
 class FakeTag:
     def __init__(self, generator):
         self.generator = generator
+        self.commands = []
 
-    def transceive(self, _):
+    def transceive(self, command):
+        self.commands.append(command)
         return pack(next(self.generator))
 
 
@@ -72,3 +99,440 @@ class TestHomekey:
             _ = read_homekey(
                 tag=endpoint_without_v2_support_on_select, **read_homekey_params
             )
+
+
+class TestFastAuth:
+    reader_private_key = os.urandom(32)
+    reader_ephemeral_private_key = os.urandom(32)
+    reader_identifier = os.urandom(16)
+    transaction_identifier = os.urandom(16)
+
+    def calculate_cryptogram(
+        self,
+        endpoint,
+        endpoint_ephemeral_public_key_x,
+        reader_ephemeral_public_key_x=None,
+        transaction_identifier=None,
+    ):
+        reader_public_key_x, _ = get_ec_key_public_points(
+            ec.derive_private_key(
+                int.from_bytes(self.reader_private_key, "big"), ec.SECP256R1()
+            ).public_key()
+        )
+        if reader_ephemeral_public_key_x is None:
+            reader_ephemeral_public_key_x, _ = get_ec_key_public_points(
+                ec.derive_private_key(
+                    int.from_bytes(self.reader_ephemeral_private_key, "big"),
+                    ec.SECP256R1(),
+                ).public_key()
+            )
+        info = pack(
+            (
+                reader_public_key_x,
+                Context.VOLATILE_FAST,
+                self.reader_identifier,
+                endpoint.public_key[1:33],
+                Interface.CONTACTLESS,
+                TLV(0x5C, value=[b"\x02\x00"]),
+                TLV(0x5C, value=b"\x02\x00"),
+                reader_ephemeral_public_key_x,
+                transaction_identifier or self.transaction_identifier,
+                bytes([0x01, 0x01]),
+                endpoint_ephemeral_public_key_x,
+            )
+        )
+        return HKDF(algorithm=hashes.SHA256(), length=64, salt=None, info=info).derive(
+            endpoint.persistent_key
+        )[:16]
+
+    def endpoint_tag(self, endpoint, **kwargs):
+        endpoint_ephemeral_x, endpoint_ephemeral_y = get_ec_key_public_points(
+            ec.generate_private_key(ec.SECP256R1()).public_key()
+        )
+        cryptogram = self.calculate_cryptogram(endpoint, endpoint_ephemeral_x, **kwargs)
+
+        def generator():
+            yield ISO7816Response(
+                sw1=0x90, sw2=0x00, data=TLV(0x5C, value=bytes.fromhex("0200"))
+            )
+            yield ISO7816Response(
+                sw1=0x90,
+                sw2=0x00,
+                data=pack(
+                    [
+                        TLV(
+                            0x86,
+                            value=b"\x04" + endpoint_ephemeral_x + endpoint_ephemeral_y,
+                        ),
+                        TLV(0x9D, value=cryptogram),
+                    ]
+                ),
+            )
+            yield ISO7816Response(sw1=0x90, sw2=0x00)
+
+        return ISO7816Tag(FakeTag(generator()))
+
+    def test_fast_auth_finds_endpoint_by_cryptogram(self):
+        endpoints = [generate_endpoint() for _ in range(5)]
+        issuers = [Issuer(public_key=os.urandom(32), endpoints=endpoints)]
+
+        result_flow, _, endpoint = read_homekey(
+            self.endpoint_tag(endpoints[3]),
+            reader_identifier=self.reader_identifier,
+            reader_private_key=self.reader_private_key,
+            issuers=issuers,
+            reader_ephemeral_private_key=self.reader_ephemeral_private_key,
+            transaction_identifier=self.transaction_identifier,
+        )
+
+        assert result_flow == DigitalKeyFlow.FAST
+        assert endpoint is endpoints[3]
+        assert endpoint.counter == 1
+
+    def test_fast_auth_discards_speculation_on_match(self):
+        endpoints = [generate_endpoint() for _ in range(2)]
+        issuers = [Issuer(public_key=os.urandom(32), endpoints=endpoints)]
+        metrics.reset("speculation.")
+
+        result_flow, _, endpoint = read_homekey(
+            self.endpoint_tag(endpoints[1]),
+            reader_identifier=self.reader_identifier,
+            reader_private_key=self.reader_private_key,
+            issuers=issuers,
+            reader_ephemeral_private_key=self.reader_ephemeral_private_key,
+            transaction_identifier=self.transaction_identifier,
+            speculative=True,
+        )
+
+        assert result_flow == DigitalKeyFlow.FAST
+        assert endpoint is endpoints[1]
+        assert metrics.to_dict(prefix="speculation.") == {"speculation.discarded": 1}
+
+    def test_read_fails_with_protocol_error_on_invalid_reader_key(self):
+        endpoints = [generate_endpoint()]
+        issuers = [Issuer(public_key=os.urandom(32), endpoints=endpoints)]
+
+        with pytest.raises(ProtocolError):
+            read_homekey(
+                self.endpoint_tag(endpoints[0]),
+                reader_identifier=None,
+                reader_private_key=None,
+                issuers=issuers,
+                reader_identity=ReaderIdentity.from_private_key(bytes(32), bytes(8)),
+            )
+
+    def test_fast_auth_sends_prepared_auth0_command(self):
+        endpoints = [generate_endpoint() for _ in range(5)]
+        issuers = [Issuer(public_key=os.urandom(32), endpoints=endpoints)]
+        prepared_transaction = prepare_transaction(
+            reader_identifier=self.reader_identifier, flags=bytes([0x01, 0x01])
+        )
+        tag = self.endpoint_tag(
+            endpoints[1],
+            reader_ephemeral_public_key_x=prepared_transaction.reader_ephemeral_public_key_bytes[
+                1:33
+            ],
+            transaction_identifier=prepared_transaction.transaction_identifier,
+        )
+
+        result_flow, _, endpoint = read_homekey(
+            tag,
+            reader_identifier=self.reader_identifier,
+            reader_private_key=self.reader_private_key,
+            issuers=issuers,
+            prepared_transaction=prepared_transaction,
+        )
+
+        assert result_flow == DigitalKeyFlow.FAST
+        assert endpoint is endpoints[1]
+        assert tag._implementation.commands[1] == prepared_transaction.auth0_command
+
+
+def reference_search(endpoints, cryptogram, reader_info, interface, info_suffix):
+    """Derives full FAST key material of every endpoint the way it was done per tap"""
+    for endpoint in endpoints:
+        info = pack((reader_info, endpoint.public_key[1:33], interface, info_suffix))
+        material = HKDF(
+            algorithm=hashes.SHA256(), length=64, salt=None, info=info
+        ).derive(endpoint.persistent_key)
+        if material[:16] == cryptogram:
+            return endpoint, material
+    return None, None
+
+
+def search_transaction():
+    reader_info = pack((os.urandom(32), Context.VOLATILE_FAST, os.urandom(16)))
+    return reader_info, os.urandom(64)
+
+
+def fast_cryptogram(endpoint, reader_info, info_suffix):
+    info = pack(
+        (reader_info, endpoint.public_key[1:33], Interface.CONTACTLESS, info_suffix)
+    )
+    return HKDF(algorithm=hashes.SHA256(), length=16, salt=None, info=info).derive(
+        endpoint.persistent_key
+    )
+
+
+def test_find_endpoint_by_cryptogram_matches_reference_search():
+    endpoints = [generate_endpoint() for _ in range(8)]
+    reader_info, info_suffix = search_transaction()
+
+    for expected in (*endpoints, None):
+        cryptogram = fast_cryptogram(
+            expected or generate_endpoint(), reader_info, info_suffix
+        )
+
+        result = find_endpoint_by_cryptogram(
+            endpoints,
+            cryptogram=cryptogram,
+            reader_info=reader_info,
+            interface=Interface.CONTACTLESS,
+            info_suffix=info_suffix,
+        )
+
+        assert result == reference_search(
+            endpoints, cryptogram, reader_info, Interface.CONTACTLESS, info_suffix
+        )
+        assert result[0] is expected
+
+
+@pytest.mark.parametrize("kind", CryptogramSearchPool.KINDS)
+def test_search_pool_finds_same_endpoint_as_sequential_search(kind):
+    endpoints = [generate_endpoint() for _ in range(12)]
+    reader_info, info_suffix = search_transaction()
+    search_pool = CryptogramSearchPool(2, kind=kind, min_candidates=0)
+
+    try:
+        for expected in (endpoints[0], endpoints[5], endpoints[-1], None):
+            kwargs = dict(
+                cryptogram=fast_cryptogram(
+                    expected or generate_endpoint(), reader_info, info_suffix
+                ),
+                reader_info=reader_info,
+                interface=Interface.CONTACTLESS,
+                info_suffix=info_suffix,
+            )
+
+            result = find_endpoint_by_cryptogram(
+                endpoints, search_pool=search_pool, **kwargs
+            )
+
+            assert result == find_endpoint_by_cryptogram(endpoints, **kwargs)
+            assert result[0] is expected
+    finally:
+        search_pool.shutdown()
+
+
+def test_search_pool_searches_few_candidates_on_calling_thread():
+    endpoints = [generate_endpoint() for _ in range(4)]
+    reader_info, info_suffix = search_transaction()
+    search_pool = CryptogramSearchPool(2, kind="thread", min_candidates=8)
+    # Pool that has been shut down can't run anything
+    search_pool.shutdown()
+
+    endpoint, _ = find_endpoint_by_cryptogram(
+        endpoints,
+        cryptogram=fast_cryptogram(endpoints[2], reader_info, info_suffix),
+        reader_info=reader_info,
+        interface=Interface.CONTACTLESS,
+        info_suffix=info_suffix,
+        search_pool=search_pool,
+    )
+
+    assert endpoint is endpoints[2]
+    with pytest.raises(RuntimeError):
+        search_pool.search(
+            endpoints * 2, b"", reader_info, Interface.CONTACTLESS, info_suffix
+        )
+
+
+def test_search_pool_is_only_created_for_several_workers(caplog):
+    assert CryptogramSearchPool.from_config(0, "process") is None
+    assert CryptogramSearchPool.from_config(1, "thread") is None
+
+    search_pool = CryptogramSearchPool.from_config(2, "fiber")
+    search_pool.shutdown()
+
+    assert (search_pool.workers, search_pool.kind) == (2, "process")
+    assert "not supported" in caplog.text
+    with pytest.raises(ValueError):
+        CryptogramSearchPool(2, kind="fiber")
+
+
+def test_order_endpoints_for_search_puts_recent_endpoints_first():
+    now = 1_700_000_000
+    never_used, cold, warm, hot, hottest = (generate_endpoint() for _ in range(5))
+    never_used.counter, never_used.last_used_at = 0, 0
+    cold.counter, cold.last_used_at = 50, now - 365 * 24 * 60 * 60
+    warm.counter, warm.last_used_at = 20, now - 30 * 24 * 60 * 60
+    hot.counter, hot.last_used_at = 1, now - 60 * 60
+    hottest.counter, hottest.last_used_at = 1, now - 60
+
+    ordered = order_endpoints_for_search(
+        [never_used, cold, warm, hot, hottest], now=now
+    )
+
+    assert ordered == [hottest, hot, warm, cold, never_used]
+
+
+class FakeStandardDevice:
+    """Answers SELECT, AUTH0 and AUTH1 on behalf of an enrolled endpoint.
+    AUTH0 response contains the cryptogram only if one is given
+    """
+
+    def __init__(
+        self, endpoint_private_key, reader_ephemeral_private_key, cryptogram=None
+    ):
+        self.endpoint_private_key = endpoint_private_key
+        self.cryptogram = cryptogram
+        self.endpoint = generate_endpoint(endpoint_private_key)
+        self.endpoint_ephemeral_private_key = ec.generate_private_key(ec.SECP256R1())
+        self.reader_ephemeral_private_key = reader_ephemeral_private_key
+        self.auth0 = None
+
+    def transceive(self, data):
+        command = ISO7816Command.unpack(data)
+        if command.ins == 0xA4:
+            response = ISO7816Response(
+                sw1=0x90, sw2=0x00, data=TLV(0x5C, value=bytes.fromhex("0200"))
+            )
+        elif command.ins == 0x80:
+            self.auth0 = command
+            x, y = get_ec_key_public_points(
+                self.endpoint_ephemeral_private_key.public_key()
+            )
+            data = [TLV(0x86, value=b"\x04" + x + y)]
+            if self.cryptogram is not None:
+                data.append(TLV(0x9D, value=self.cryptogram))
+            response = ISO7816Response(sw1=0x90, sw2=0x00, data=pack(data))
+        elif command.ins == 0x81:
+            response = self.auth1_response()
+        else:
+            response = ISO7816Response(sw1=0x90, sw2=0x00)
+        return pack(response)
+
+    def auth1_response(self):
+        auth0 = {
+            tlv.tag.data[0]: tlv.value for tlv in TLV.unpack_array(self.auth0.data)
+        }
+        _, hkdf = derive_session_keys(
+            reader_ephemeral_private_key=self.reader_ephemeral_private_key,
+            endpoint_ephemeral_public_key=self.endpoint_ephemeral_private_key.public_key(),
+            transaction_identifier=bytes(auth0[0x4C]),
+            interface=Interface.CONTACTLESS,
+            flags=bytes([self.auth0.p1, self.auth0.p2]),
+            protocol_version=b"\x02\x00",
+            device_protocol_versions=[b"\x02\x00"],
+        )
+        endpoint_ephemeral_x, _ = get_ec_key_public_points(
+            self.endpoint_ephemeral_private_key.public_key()
+        )
+        signature = self.endpoint_private_key.sign(
+            pack(
+                [
+                    TLV(0x4D, value=bytes(auth0[0x4D])),
+                    TLV(0x86, value=endpoint_ephemeral_x),
+                    TLV(0x87, value=bytes(auth0[0x87][1:33])),
+                    TLV(0x4C, value=bytes(auth0[0x4C])),
+                    TLV(0x93, value=DEVICE_CONTEXT),
+                ]
+            ),
+            ec.ECDSA(hashes.SHA256()),
+        )
+        r, s = decode_dss_signature(signature)
+        secure = DigitalKeySecureContext(None, hkdf[:16], hkdf[16:32], hkdf[32:])
+        response, _ = secure.encrypt_response(
+            ISO7816Response(
+                sw1=0x90,
+                sw2=0x00,
+                data=pack(
+                    [
+                        TLV(0x4E, value=self.endpoint.id),
+                        TLV(0x9E, value=r.to_bytes(32, "big") + s.to_bytes(32, "big")),
+                    ]
+                ),
+            )
+        )
+        return response
+
+
+@pytest.mark.parametrize("speculative", [False, True])
+def test_standard_auth_authenticates_endpoint_by_signature(speculative):
+    reader_ephemeral_private_key = os.urandom(32)
+    device = FakeStandardDevice(
+        ec.generate_private_key(ec.SECP256R1()),
+        ec.derive_private_key(
+            int.from_bytes(reader_ephemeral_private_key, "big"), ec.SECP256R1()
+        ),
+    )
+    persistent_key = device.endpoint.persistent_key
+    issuers = [Issuer(public_key=os.urandom(32), endpoints=[device.endpoint])]
+    metrics.reset("speculation.")
+
+    result_flow, _, endpoint = read_homekey(
+        ISO7816Tag(device),
+        reader_identifier=os.urandom(16),
+        reader_private_key=os.urandom(32),
+        issuers=issuers,
+        reader_ephemeral_private_key=reader_ephemeral_private_key,
+        speculative=speculative,
+    )
+
+    assert result_flow == DigitalKeyFlow.STANDARD
+    assert endpoint is device.endpoint
+    assert endpoint.persistent_key != persistent_key
+    assert metrics.to_dict(prefix="speculation.") == (
+        {"speculation.used": 1} if speculative else {}
+    )
+
+
+def test_speculative_signature_is_used_when_cryptogram_matches_no_endpoint(
+    monkeypatch,
+):
+    signed_on = []
+    sign_authentication_hash_input = homekey.sign_authentication_hash_input
+
+    def recording_sign_authentication_hash_input(**kwargs):
+        signed_on.append(threading.current_thread().name)
+        return sign_authentication_hash_input(**kwargs)
+
+    monkeypatch.setattr(
+        homekey,
+        "sign_authentication_hash_input",
+        recording_sign_authentication_hash_input,
+    )
+
+    reader_ephemeral_private_key = os.urandom(32)
+    # Device has lost its persistent key, so cryptogram is made with a different one
+    device = FakeStandardDevice(
+        ec.generate_private_key(ec.SECP256R1()),
+        ec.derive_private_key(
+            int.from_bytes(reader_ephemeral_private_key, "big"), ec.SECP256R1()
+        ),
+        cryptogram=os.urandom(16),
+    )
+    issuers = [
+        Issuer(
+            public_key=os.urandom(32),
+            endpoints=[generate_endpoint(), device.endpoint],
+        )
+    ]
+    metrics.reset("speculation.")
+    metrics.reset("fast.")
+
+    result_flow, _, endpoint = read_homekey(
+        ISO7816Tag(device),
+        reader_identifier=os.urandom(16),
+        reader_private_key=os.urandom(32),
+        issuers=issuers,
+        reader_ephemeral_private_key=reader_ephemeral_private_key,
+        speculative=True,
+    )
+
+    assert result_flow == DigitalKeyFlow.STANDARD
+    assert endpoint is device.endpoint
+    assert metrics.to_dict(prefix="fast.") == {"fast.misses": 1}
+    assert metrics.to_dict(prefix="speculation.") == {"speculation.used": 1}
+    # Signed once, in the background while FAST search was running
+    assert len(signed_on) == 1 and signed_on[0].startswith("speculation")
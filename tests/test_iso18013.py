@@ -0,0 +1,64 @@
+import os
+
+import cbor2
+import pytest
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+from util.iso18013 import ISO18013SecureContext, parse_issuer_auth
+
+
+def test_secure_context_increments_iv_per_message():
+    secure = ISO18013SecureContext(None, os.urandom(32), os.urandom(32), 32)
+
+    for counter in (1, 2, 3):
+        ciphertext = cbor2.loads(secure.encrypt_message_to_endpoint(b"message"))
+        iv = bytes(4) + bytes.fromhex("00000000") + counter.to_bytes(4, "big")
+        assert AESGCM(secure.reader_key).decrypt(iv, ciphertext["data"], None) == (
+            b"message"
+        )
+
+    for counter in (1, 2):
+        iv = bytes(4) + bytes.fromhex("00000001") + counter.to_bytes(4, "big")
+        message = cbor2.dumps(
+            {"data": AESGCM(secure.endpoint_key).encrypt(iv, b"response", None)}
+        )
+        assert secure.decrypt_message_from_endpoint(message) == b"response"
+
+
+def test_secure_context_iv_does_not_change_under_caller():
+    secure = ISO18013SecureContext(None, os.urandom(32), os.urandom(32), 32)
+    reader_iv, endpoint_iv = secure.reader_iv, secure.endpoint_iv
+
+    secure.encrypt_message_to_endpoint(b"message")
+    secure.endpoint_counter += 1
+
+    assert reader_iv == bytes(4) + bytes.fromhex("00000000") + b"\x00\x00\x00\x01"
+    assert endpoint_iv == bytes(4) + bytes.fromhex("00000001") + b"\x00\x00\x00\x01"
+    assert secure.reader_iv[8:] == secure.endpoint_iv[8:] == b"\x00\x00\x00\x02"
+
+
+def attestation_package(device_key):
+    mobile_security_object = cbor2.dumps(
+        cbor2.CBORTag(24, cbor2.dumps({"deviceKeyInfo": {"deviceKey": device_key}}))
+    )
+    issuer_auth = [b"\xa1\x01\x27", {4: b"issuer"}, mobile_security_object, b"sig"]
+    return cbor2.dumps({"documents": [{"issuerSigned": {"issuerAuth": issuer_auth}}]})
+
+
+def test_parse_issuer_auth_extracts_fields():
+    device_key = {1: 2, -1: 1, -2: b"x" * 32, -3: b"y" * 32}
+
+    issuer_auth = parse_issuer_auth(attestation_package(device_key))
+
+    assert issuer_auth.protected_headers == b"\xa1\x01\x27"
+    assert issuer_auth.issuer_id == b"issuer"
+    assert issuer_auth.signature == b"sig"
+    assert issuer_auth.device_key == device_key
+    assert cbor2.loads(cbor2.loads(issuer_auth.payload).value) == {
+        "deviceKeyInfo": {"deviceKey": device_key}
+    }
+
+
+def test_parse_issuer_auth_rejects_missing_document():
+    with pytest.raises(IndexError):
+        parse_issuer_auth(cbor2.dumps({"documents": []}))
@@ -0,0 +1,121 @@
+import pytest
+
+from util.iso7816 import (
+    ISO7816Command,
+    ISO7816Response,
+    ISO7816StatusGroup,
+    ISO7816Tag,
+)
+from util.metrics import metrics
+
+
+@pytest.mark.parametrize(
+    "data,le,expected",
+    [
+        (b"", None, "80810000"),
+        (b"", 0x00, "8081000000"),
+        (b"\x01\x02", None, "80810000020102"),
+        (b"\x01\x02", 0x00, "8081000002010200"),
+        (b"\xaa" * 256, None, "80810000000100" + "aa" * 256),
+    ],
+)
+def test_command_pack(data, le, expected):
+    command = ISO7816Command(cla=0x80, ins=0x81, p1=0x00, p2=0x00, data=data, le=le)
+
+    assert command.pack() == bytes.fromhex(expected)
+
+
+def test_command_is_packed_again_after_change():
+    command = ISO7816Command(cla=0x80, ins=0x3C, p1=0x01, p2=0x00)
+    assert command.pack() == bytes.fromhex("803c0100")
+
+    command.p1 = 0x02
+
+    assert command.pack() == bytes.fromhex("803c0200")
+
+
+def test_response_unpack_slices_data():
+    buffer = bytearray.fromhex("0102039000")
+
+    response = ISO7816Response.unpack(buffer)
+
+    assert response.sw == (ISO7816StatusGroup.SUCCESS, 0x00)
+    assert response.data == b"\x01\x02\x03"
+    assert response.data.obj is buffer
+
+
+@pytest.mark.parametrize(
+    "data,le,expected",
+    [
+        (b"", 0x00, "80c30000000000"),
+        (b"\x01\x02", 0x00, "80c3000000000201020000"),
+    ],
+)
+def test_command_pack_extended(data, le, expected):
+    command = ISO7816Command(
+        cla=0x80, ins=0xC3, p1=0x00, p2=0x00, data=data, le=le, extended=True
+    )
+
+    assert command.pack() == bytes.fromhex(expected)
+
+
+class FakeChainingCard:
+    def __init__(self, data, chunk_size=4, extended_length=True):
+        self.data = data
+        self.chunk_size = chunk_size
+        self.extended_length = extended_length
+        self.commands = []
+
+    def transceive(self, command):
+        self.commands.append(command)
+        extended = len(command) > 5 and command[4] == 0x00
+        if extended and not self.extended_length:
+            return bytes.fromhex("6700")
+        if extended:
+            data, self.data = self.data, b""
+        else:
+            data, self.data = (
+                self.data[: self.chunk_size],
+                self.data[self.chunk_size :],
+            )
+        if self.data:
+            return data + bytes([0x61, min(len(self.data), 0xFF)])
+        return data + bytes.fromhex("9000")
+
+
+@pytest.mark.parametrize(
+    "extended_length,card_supports_extended,round_trips",
+    [(False, True, 3), (True, True, 1), (True, False, 4)],
+)
+def test_transceive_chained_collects_response(
+    extended_length, card_supports_extended, round_trips
+):
+    card = FakeChainingCard(bytes(range(10)), extended_length=card_supports_extended)
+    tag = ISO7816Tag(card, extended_length=extended_length)
+
+    response = tag.transceive_chained(
+        ISO7816Command(cla=0x00, ins=0xC3, data=b"\x01", le=0x00)
+    )
+
+    assert response.sw == (ISO7816StatusGroup.SUCCESS, 0x00)
+    assert response.data == bytes(range(10))
+    assert tag.round_trips == round_trips
+    assert tag.extended_length == (extended_length and card_supports_extended)
+
+
+def test_transceive_chained_limits_response_size():
+    tag = ISO7816Tag(FakeChainingCard(bytes(100)), max_response_size=50)
+
+    with pytest.raises(ValueError):
+        tag.transceive_chained(ISO7816Command(cla=0x00, ins=0xC3, le=0x00))
+
+
+def test_transceive_times_each_command():
+    metrics.reset("apdu.")
+    tag = ISO7816Tag(FakeChainingCard(bytes(range(10))))
+
+    tag.transceive_chained(ISO7816Command(cla=0x00, ins=0xC3, le=0x00))
+
+    assert tag.transceive_time > 0
+    assert metrics.get("apdu.c3.ms").count == 1
+    assert metrics.get("apdu.c0.ms").count == 2
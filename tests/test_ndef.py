@@ -0,0 +1,49 @@
+import os
+
+import pytest
+
+from util.ndef import NDEFMessage, NDEFRecord, NDEFRecordType
+
+
+def generate_message(payload):
+    return NDEFMessage(
+        [
+            NDEFRecord(tnf=NDEFRecordType.WELL_KNOWN, type=b"Hs", payload=b"\x15"),
+            NDEFRecord(
+                tnf=NDEFRecordType.EXTERNAL,
+                type=b"iso.org:18013:deviceengagement",
+                id=b"mdoc",
+                payload=payload,
+            ),
+        ]
+    )
+
+
+def test_unpack_reads_short_and_long_records():
+    payload = os.urandom(300)
+
+    records = NDEFMessage.unpack(generate_message(payload).pack()).records
+
+    assert [record.type for record in records] == [
+        b"Hs",
+        b"iso.org:18013:deviceengagement",
+    ]
+    assert records[0].tnf == NDEFRecordType.WELL_KNOWN
+    assert records[1].id == b"mdoc"
+    assert records[1].payload == payload
+
+
+def test_chunked_records_are_joined_on_unpack():
+    message = generate_message(os.urandom(1000))
+
+    chunked = message.pack(chunk_size=64)
+
+    assert len(chunked) > len(message.pack())
+    assert NDEFMessage.unpack(chunked).pack() == message.pack()
+
+
+def test_unpack_fails_on_unterminated_chunk():
+    chunked = generate_message(os.urandom(200)).pack(chunk_size=64)
+
+    with pytest.raises(ValueError):
+        NDEFMessage.unpack(chunked[:-70])
@@ -0,0 +1,31 @@
+import pytest
+
+from util.ecp import ECP, get_home_frame
+from util.nfc import crc16a, with_crc16a, with_crc16a_cached
+
+
+@pytest.mark.parametrize(
+    "data, crc",
+    [
+        # Examples from ISO/IEC 14443-3 Annex B
+        (b"\x00\x00", b"\xa0\x1e"),
+        (b"\x12\x34", b"\x26\xcf"),
+    ],
+)
+def test_crc16a(data, crc):
+    assert crc16a(data) == crc
+    assert with_crc16a(data) == data + crc
+    assert with_crc16a_cached(data) == data + crc
+
+
+def test_home_frame_is_cached_per_identifier_and_express():
+    identifier = bytes.fromhex("0102030405060708")
+
+    frame = get_home_frame(identifier, True)
+
+    assert frame == ECP.home(identifier=identifier, flag_2=True).pack()
+    assert get_home_frame(identifier, True) is frame
+    assert get_home_frame(identifier, False) == (
+        ECP.home(identifier=identifier, flag_2=False).pack()
+    )
+    assert get_home_frame(bytes(8), True) != frame
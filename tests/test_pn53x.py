@@ -0,0 +1,332 @@
+import errno
+import logging
+import threading
+
+import nfc.clf.pn53x
+import pytest
+from nfc.clf import RemoteTarget
+
+from util.metrics import metrics
+from util.pn53x import (
+    AutoPoller,
+    AutoPollingFrontendMixin,
+    ChipsetShadow,
+    negotiate_baudrate,
+)
+
+
+class FakeTransport:
+    def __init__(self):
+        self.frames = []
+
+    def write(self, frame, timeout=0):
+        self.frames.append(bytes(frame))
+
+    def read(self, timeout=0):
+        return b"\x00\x00\xff\x00\xff\x00"
+
+
+class FakeChipset(nfc.clf.pn53x.Chipset):
+    """Chipset that sends each command as a single transport frame and records it"""
+
+    def __init__(self):
+        super().__init__(FakeTransport(), logging.getLogger())
+        self.commands = []
+
+    def command(self, cmd_code, cmd_data, timeout):
+        self.commands.append((cmd_code, bytes(cmd_data)))
+        self.transport.write(bytes([0xD4, cmd_code]) + bytes(cmd_data))
+        return bytearray(self.transport.read())
+
+    def _write_register(self, data):
+        self.command(0x08, data, timeout=0.25)
+
+    def in_communicate_thru(self, data, timeout):
+        return self.command(0x42, data, timeout)
+
+
+def poll(shadow):
+    """Same commands as a poll cycle with an ECP broadcast that finds no target"""
+    shadow.start_poll()
+    shadow.chipset.rf_configuration(0x01, [0x00])
+    shadow.rf_configuration(0x05, [0xFF, 0x01, 0x00])
+    shadow.rf_configuration(0x02, [0x0A, 0x0B, 0x08])
+    shadow.write_register("CIU_BitFraming", 0x00)
+    shadow.chipset.in_communicate_thru(b"\x6a\x02", timeout=0.25)
+    shadow.chipset.command(0x4A, b"\x01\x00", timeout=1.0)
+    return shadow.end_poll()
+
+
+def test_shadow_skips_unchanged_configuration_on_next_poll():
+    chipset = FakeChipset()
+    shadow = ChipsetShadow(chipset)
+
+    first_frames, first_bytes = poll(shadow)
+    chipset.commands.clear()
+    frames, bytes_ = poll(shadow)
+
+    assert [cmd_code for cmd_code, _ in chipset.commands] == [0x32, 0x42, 0x4A]
+    assert frames < first_frames and bytes_ < first_bytes
+    assert metrics.get("chipset.frames_per_poll").count >= 2
+
+
+def test_shadow_rewrites_registers_after_unknown_command():
+    chipset = FakeChipset()
+    shadow = ChipsetShadow(chipset)
+    poll(shadow)
+
+    # Firmware may change any register while exchanging data with a target
+    chipset.command(0x40, b"\x01\x00", timeout=1.0)
+    chipset.commands.clear()
+    shadow.write_register("CIU_BitFraming", 0x00)
+
+    assert chipset.commands == [(0x08, b"\x63\x3d\x00")]
+
+
+def test_shadow_resends_configuration_changed_by_nfcpy():
+    chipset = FakeChipset()
+    shadow = ChipsetShadow(chipset)
+    poll(shadow)
+
+    # nfcpy sets response timeout on its own when exchanging data with a tag
+    chipset.rf_configuration(0x02, bytearray([10, 11, 12]))
+    chipset.commands.clear()
+    shadow.rf_configuration(0x05, [0xFF, 0x01, 0x00])
+    shadow.rf_configuration(0x02, [0x0A, 0x0B, 0x08])
+
+    assert chipset.commands == [(0x32, b"\x02\x0a\x0b\x08")]
+
+
+def test_shadow_batches_changed_registers_into_one_frame():
+    chipset = FakeChipset()
+    shadow = ChipsetShadow(chipset)
+    shadow.write_register(("CIU_TxMode", 0x80), ("CIU_RxMode", 0x80))
+    chipset.commands.clear()
+
+    shadow.write_register(
+        ("CIU_TxMode", 0x80), ("CIU_RxMode", 0x00), ("CIU_BitFraming", 0x00)
+    )
+
+    assert chipset.commands == [(0x08, b"\x63\x03\x00\x63\x3d\x00")]
+
+
+class ScriptedChipset(FakeChipset):
+    """Answers chipset commands with scripted responses, raising the exceptions among them"""
+
+    CMD = {0x60: "InAutoPoll"}
+
+    def __init__(self, responses):
+        super().__init__()
+        self.responses = list(responses)
+
+    def command(self, cmd_code, cmd_data, timeout):
+        self.commands.append((cmd_code, bytes(cmd_data)))
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return bytearray(response)
+
+
+def test_auto_poller_returns_found_type_a_target():
+    target_data = bytes.fromhex("01 0400 20 04 08aabbcc")
+    chipset = ScriptedChipset([bytes([0x01, 0x00, len(target_data)]) + target_data])
+
+    target = AutoPoller(chipset, poll_count=3, period=2).poll()
+
+    assert chipset.commands == [(0x60, b"\x03\x02\x00")]
+    assert target.brty == "106A"
+    assert target.sens_res == b"\x00\x04"
+    assert target.sel_res == b"\x20"
+    assert target.sdd_res == bytes.fromhex("08aabbcc")
+
+
+@pytest.mark.parametrize(
+    "response",
+    [b"\x00", IOError(errno.ETIMEDOUT, "Timeout")],
+)
+def test_auto_poller_returns_none_when_nothing_found(response):
+    assert AutoPoller(ScriptedChipset([response])).poll() is None
+
+
+def test_auto_poller_rejects_targets_of_other_types():
+    target_data = bytes.fromhex("01 0400 08 04 08aabbcc")
+    chipset = ScriptedChipset([bytes([0x01, 0x10, len(target_data)]) + target_data])
+
+    with pytest.raises(ValueError):
+        AutoPoller(chipset).poll()
+
+
+def test_auto_poller_is_only_supported_by_chipsets_with_in_auto_poll():
+    assert AutoPoller.is_supported(ScriptedChipset([]))
+    assert not AutoPoller.is_supported(FakeChipset())
+
+
+class FakeDevice:
+    def __init__(self, chipset):
+        self.chipset = chipset
+        self.muted = 0
+
+    def mute(self):
+        self.muted += 1
+
+
+class ScriptedFrontend(AutoPollingFrontendMixin):
+    """Frontend whose regular poll returns `found`, recording options it was called with"""
+
+    def __init__(self, chipset, found=None, auto_poll=True):
+        self.auto_poll = auto_poll
+        self.chipset_shadow = None
+        self.device = FakeDevice(chipset)
+        self.lock = threading.Lock()
+        self.target = None
+        self.found = found
+        self.polls = []
+
+    def _sense(self, *targets, **options):
+        self.polls.append(options)
+        return self.found
+
+
+def auto_poll_response(sel_res=0x20):
+    target_data = bytes([0x01, 0x04, 0x00, sel_res, 0x04, 0x08, 0xAA, 0xBB, 0xCC])
+    return bytes([0x01, 0x00, len(target_data)]) + target_data
+
+
+def test_frontend_auto_polls_after_broadcast_miss():
+    frontend = ScriptedFrontend(ScriptedChipset([auto_poll_response()]))
+
+    target = frontend.sense(RemoteTarget("106A"), broadcast=b"\x6a\x02")
+
+    assert frontend.polls == [{"broadcast": b"\x6a\x02"}]
+    assert frontend.device.chipset.commands == [(0x60, b"\x02\x01\x00")]
+    # Activation continues from the target the frontend has selected
+    assert frontend.target is target
+    assert target.sdd_res == bytes.fromhex("08aabbcc")
+
+
+def test_frontend_doesnt_auto_poll_if_regular_poll_found_target():
+    found = RemoteTarget("106A", sdd_res=b"\x01\x02\x03\x04")
+    frontend = ScriptedFrontend(ScriptedChipset([]), found=found)
+
+    assert frontend.sense(RemoteTarget("106A"), broadcast=b"\x6a\x02") is found
+    assert frontend.device.chipset.commands == []
+
+
+@pytest.mark.parametrize(
+    "chipset, auto_poll, options",
+    [
+        (ScriptedChipset([]), True, {}),
+        (ScriptedChipset([]), False, {"broadcast": b"\x6a\x02"}),
+        # Chipsets other than PN532 don't have InAutoPoll
+        (FakeChipset(), True, {"broadcast": b"\x6a\x02"}),
+    ],
+)
+def test_frontend_uses_regular_poll_only(chipset, auto_poll, options):
+    frontend = ScriptedFrontend(chipset, auto_poll=auto_poll)
+
+    assert frontend.sense(RemoteTarget("106A"), **options) is None
+    assert len(frontend.polls) == 1
+    assert chipset.commands == []
+
+
+@pytest.mark.parametrize(
+    "response",
+    [
+        auto_poll_response()[:3] + b"\x01",
+        b"\x01\x10\x03\x01\x04\x00",
+        IOError(errno.EIO, "Garbled frame"),
+    ],
+)
+def test_frontend_falls_back_to_regular_poll_on_auto_poll_error(response, caplog):
+    frontend = ScriptedFrontend(ScriptedChipset([response]))
+
+    assert frontend.sense(RemoteTarget("106A"), broadcast=b"\x6a\x02") is None
+    assert frontend.device.muted == 1
+    assert frontend.target is None
+    assert "Auto poll failed" in caplog.text
+
+
+class FakeSerialTransport(FakeTransport):
+    TYPE = "TTY"
+
+    def __init__(self):
+        super().__init__()
+        self.baudrate = 115200
+
+
+class FakeLimitedSerialTransport(FakeSerialTransport):
+    """Serial port that can't be set to speeds above `max_baudrate`"""
+
+    def __init__(self, max_baudrate):
+        self.max_baudrate = max_baudrate
+        super().__init__()
+
+    @property
+    def baudrate(self):
+        return self._baudrate
+
+    @baudrate.setter
+    def baudrate(self, value):
+        if value > self.max_baudrate:
+            raise IOError(errno.EINVAL, f"Unsupported baudrate {value}")
+        self._baudrate = value
+
+
+class FakeUARTChipset(FakeChipset):
+    """PN532 whose UART link only works at speeds up to `max_working_baudrate`"""
+
+    def __init__(self, max_working_baudrate, transport=None):
+        super().__init__()
+        self.transport = transport or FakeSerialTransport()
+        self.max_working_baudrate = max_working_baudrate
+        self.baudrate = 115200
+
+    def set_serial_baudrate(self, baudrate):
+        if self.transport.baudrate != self.baudrate:
+            raise IOError(errno.EIO, "Garbled frame")
+        self.commands.append((0x10, bytes([baudrate // 100_000])))
+        self.baudrate = baudrate
+
+    def diagnose(self, test, test_data=None):
+        if self.transport.baudrate != self.baudrate:
+            raise IOError(errno.ETIMEDOUT, "No response")
+        return self.baudrate <= self.max_working_baudrate
+
+
+def test_negotiate_baudrate_switches_to_configured_speed():
+    chipset = FakeUARTChipset(max_working_baudrate=921600)
+
+    assert negotiate_baudrate(chipset, 921600) == 921600
+    assert chipset.baudrate == chipset.transport.baudrate == 921600
+
+
+def test_negotiate_baudrate_falls_back_to_lower_speed():
+    chipset = FakeUARTChipset(max_working_baudrate=460800)
+
+    assert negotiate_baudrate(chipset, 1288000) == 460800
+    assert chipset.baudrate == chipset.transport.baudrate == 460800
+
+
+def test_negotiate_baudrate_keeps_default_speed_if_none_works():
+    chipset = FakeUARTChipset(max_working_baudrate=115200)
+
+    assert negotiate_baudrate(chipset, 921600) == 115200
+    assert chipset.baudrate == chipset.transport.baudrate == 115200
+
+
+def test_negotiate_baudrate_rejects_unsupported_speed():
+    with pytest.raises(ValueError):
+        negotiate_baudrate(FakeUARTChipset(max_working_baudrate=921600), 1_000_000)
+
+
+def test_negotiate_baudrate_raises_if_port_cant_follow_the_chip():
+    chipset = FakeUARTChipset(
+        max_working_baudrate=921600,
+        transport=FakeLimitedSerialTransport(max_baudrate=115200),
+    )
+
+    # Chip has switched but the port is left at the default speed
+    with pytest.raises(IOError):
+        negotiate_baudrate(chipset, 921600)
+    assert chipset.baudrate == 921600
+    assert chipset.transport.baudrate == 115200
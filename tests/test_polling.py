@@ -0,0 +1,72 @@
+import pytest
+
+from tests.helpers import SimulatedClock
+from util.polling import PollingScheduler
+
+
+def simulate(scheduler_params, taps, duration, poll_duration=0.03, transaction=1.0):
+    """Runs a polling loop against a simulated clock.
+
+    Returns mean time from device entering the field to it being found,
+    (None if no device was found) and share of time spent polling
+    """
+    clock = SimulatedClock()
+    scheduler = PollingScheduler(clock=clock, sleep=clock.sleep, **scheduler_params)
+    pending, latencies, polling_time = sorted(taps), [], 0.0
+    while clock.now < duration:
+        start = clock.now
+        clock.sleep(poll_duration)
+        polling_time += poll_duration
+        if pending and pending[0] <= start:
+            latencies.append(clock.now - pending.pop(0))
+            scheduler.notify_activity()
+            clock.sleep(transaction)
+            continue
+        scheduler.wait(start)
+    latency = sum(latencies) / len(latencies) if latencies else None
+    return latency, polling_time / clock.now
+
+
+FIXED = dict(min_interval=0.15, max_interval=0.15)
+ADAPTIVE = dict(min_interval=0.02, max_interval=0.15, burst=10)
+# Taps following each other, like several people entering one after another
+BURST_TAPS = [5.013, 7.077, 9.131, 60.0, 62.047, 65.101]
+
+
+def test_adaptive_polling_reduces_latency_of_repeated_taps():
+    fixed_latency, _ = simulate(FIXED, BURST_TAPS, duration=120)
+    adaptive_latency, _ = simulate(ADAPTIVE, BURST_TAPS, duration=120)
+
+    assert adaptive_latency < fixed_latency * 0.75
+
+
+def test_adaptive_polling_reduces_idle_duty_cycle():
+    night = dict(ADAPTIVE, max_interval=1.0)
+
+    _, fixed_duty_cycle = simulate(FIXED, [], duration=3600 * 8)
+    _, adaptive_duty_cycle = simulate(night, [], duration=3600 * 8)
+
+    assert fixed_duty_cycle == pytest.approx(0.2)
+    assert adaptive_duty_cycle < 0.05
+
+
+@pytest.mark.parametrize("duty_cycle", [0.25, 0.5])
+def test_polling_respects_duty_cycle_budget(duty_cycle):
+    params = dict(min_interval=0.0, max_interval=0.0, duty_cycle=duty_cycle)
+
+    _, measured = simulate(params, [], duration=60, poll_duration=0.05)
+
+    assert measured == pytest.approx(duty_cycle, rel=0.05)
+
+
+def test_polling_backs_off_step_by_step_until_max_interval(clock):
+    scheduler = PollingScheduler(
+        min_interval=0.02, max_interval=0.5, burst=1, backoff=2, clock=clock
+    )
+    clock.now = 2
+
+    delays = [scheduler.get_delay(clock.now, clock.now) for _ in range(7)]
+
+    assert delays == pytest.approx([0.04, 0.08, 0.16, 0.32, 0.5, 0.5, 0.5])
+    scheduler.notify_activity()
+    assert scheduler.get_delay(clock.now, clock.now) == pytest.approx(0.02)
@@ -0,0 +1,67 @@
+import pytest
+
+from util.metrics import metrics
+from util.presence import PresenceDetector
+
+
+@pytest.fixture()
+def detector(clock):
+    return PresenceDetector(
+        check_interval=0.1, cooldown=2, max_cooldown=6, clock=clock, sleep=clock.sleep
+    )
+
+
+def test_served_device_is_ready_soon_after_leaving(clock, detector):
+    metrics.reset("presence.")
+    leaves_at = 1.23
+
+    detector.served(b"\x01" * 4, 0.0, is_present=lambda: clock.now < leaves_at)
+
+    assert leaves_at <= clock.now < leaves_at + 0.1
+    time_to_next_ready = metrics.get("presence.time_to_next_ready")
+    assert time_to_next_ready.count == 1
+    assert time_to_next_ready.maximum < leaves_at + 0.1
+
+
+def test_only_served_device_is_suppressed(clock, detector):
+    detector.served(b"\x01" * 4, clock.now)
+
+    assert detector.is_suppressed(b"\x01" * 4)
+    assert not detector.is_suppressed(b"\x02" * 4)
+    assert not detector.is_suppressed(b"")
+
+    clock.sleep(2.5)
+    assert not detector.is_suppressed(b"\x01" * 4)
+
+
+def test_device_seen_during_cooldown_stays_suppressed(clock, detector):
+    detector.served(b"\x01" * 4, clock.now)
+
+    for _ in range(5):
+        clock.sleep(1.5)
+        assert detector.is_suppressed(b"\x01" * 4)
+
+
+def test_cooldown_grows_for_device_served_again_soon(clock, detector):
+    uid = b"\x01" * 4
+    detector.served(uid, clock.now)
+    clock.sleep(2.5)
+    assert not detector.is_suppressed(uid)
+
+    detector.served(uid, clock.now)
+    clock.sleep(3)
+    assert detector.is_suppressed(uid)
+    clock.sleep(4.5)
+    assert not detector.is_suppressed(uid)
+
+    detector.served(uid, clock.now)
+    clock.sleep(5)
+    assert detector.is_suppressed(uid)
+    clock.sleep(6.5)
+    assert not detector.is_suppressed(uid)
+
+    # Cooldown goes back to normal for a device that has been away long enough
+    clock.sleep(20)
+    detector.served(uid, clock.now)
+    clock.sleep(2.5)
+    assert not detector.is_suppressed(uid)
@@ -0,0 +1,129 @@
+import hashlib
+import logging
+import os
+
+import pytest
+from cryptography.hazmat.primitives.asymmetric import ec
+
+from entity import ReaderIdentity
+from repository import Repository
+from util.crypto import get_ec_key_public_points
+
+
+def baseline_identity(private_key, unique_identifier):
+    """Reader identity values as they were derived on every tap"""
+    group_identifier = (
+        hashlib.sha256("key-identifier".encode() + private_key)
+    ).digest()[:8]
+    key = ec.derive_private_key(int.from_bytes(private_key, "big"), ec.SECP256R1())
+    public_key_x, public_key_y = get_ec_key_public_points(key.public_key())
+    return (
+        group_identifier,
+        group_identifier + unique_identifier,
+        public_key_x,
+        public_key_y,
+    )
+
+
+def identity_values(identity):
+    # Key objects are compared by reference, their public points are compared instead
+    return (
+        identity.private_key,
+        identity.unique_identifier,
+        identity.group_identifier,
+        identity.identifier,
+        identity.public_key_x,
+        identity.public_key_y,
+    )
+
+
+def generate_private_key():
+    return (
+        ec.generate_private_key(ec.SECP256R1()).private_numbers().private_value
+    ).to_bytes(32, "big")
+
+
+def test_reader_identity_matches_baseline_derivation():
+    private_key, unique_identifier = generate_private_key(), os.urandom(8)
+
+    identity = ReaderIdentity.from_private_key(private_key, unique_identifier)
+
+    group_identifier, identifier, public_key_x, public_key_y = baseline_identity(
+        private_key, unique_identifier
+    )
+    assert identity.group_identifier == group_identifier
+    assert identity.identifier == identifier
+    assert (identity.public_key_x, identity.public_key_y) == (
+        public_key_x,
+        public_key_y,
+    )
+    assert (
+        identity.key.private_numbers()
+        == ec.derive_private_key(
+            int.from_bytes(private_key, "big"), ec.SECP256R1()
+        ).private_numbers()
+    )
+
+
+def test_reader_identity_of_unconfigured_reader_has_no_key():
+    identity = ReaderIdentity.from_private_key(bytes(32), bytes(8))
+
+    assert identity.key is None
+    assert identity.public_key_x is None and identity.public_key_y is None
+    assert (
+        identity.group_identifier
+        == hashlib.sha256(b"key-identifier" + bytes(32)).digest()[:8]
+    )
+
+
+@pytest.fixture()
+def repository(tmp_path):
+    repository = Repository(str(tmp_path / "homekey.json"))
+    repository.set_reader_private_key(generate_private_key())
+    repository.set_reader_identifier(os.urandom(8))
+    return repository
+
+
+def test_repository_keeps_reader_identity_on_reload(repository):
+    identity = repository.get_reader_identity()
+
+    repository._load_state_from_file()
+
+    assert repository.get_reader_identity() is identity
+    reloaded = Repository(repository.storage_file_path).get_reader_identity()
+    assert identity_values(reloaded) == identity_values(identity)
+
+
+def test_repository_rebuilds_reader_identity_when_key_changes(repository):
+    identity = repository.get_reader_identity()
+    private_key = generate_private_key()
+
+    repository.set_reader_private_key(private_key)
+
+    rebuilt = repository.get_reader_identity()
+    assert rebuilt is not identity
+    assert identity_values(rebuilt) == identity_values(
+        ReaderIdentity.from_private_key(private_key, repository.get_reader_identifier())
+    )
+    assert repository.get_reader_group_identifier() == (
+        baseline_identity(private_key, repository.get_reader_identifier())[0]
+    )
+
+
+def test_repository_rebuilds_reader_identity_when_identifier_changes(repository):
+    identity = repository.get_reader_identity()
+    unique_identifier = os.urandom(8)
+
+    repository.set_reader_identifier(unique_identifier)
+
+    rebuilt = repository.get_reader_identity()
+    assert rebuilt.identifier == identity.group_identifier + unique_identifier
+    assert rebuilt.key is not identity.key
+
+
+def test_repository_reports_invalid_reader_key(tmp_path, caplog):
+    with caplog.at_level(logging.WARNING):
+        repository = Repository(str(tmp_path / "homekey.json"))
+
+    assert repository.get_reader_identity().key is None
+    assert "not a valid SECP256R1 key" in caplog.text
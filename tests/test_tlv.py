@@ -0,0 +1,99 @@
+import pytest
+
+from entity import (
+    ControlPointRequest,
+    DeviceCredentialRequest,
+    KeyState,
+    KeyType,
+    Operation,
+)
+from util.generic import get_tlv_tag
+from util.structable import pack
+from util.tlv import BERTLV as TLV
+
+
+def test_unpack_array_parses_nested_constructed_tags():
+    data = (
+        TLV(
+            0x7F49,
+            value=[
+                TLV(
+                    0xA1,
+                    value=[TLV(0x80, value=b"\x01\x02"), TLV(0x81, value=b"x" * 200)],
+                ),
+                TLV(0x5C, value=b"\x02\x00"),
+            ],
+        ).pack()
+        + TLV(0x9D, value=b"\xaa" * 16).pack()
+    )
+
+    tlv_array = TLV.unpack_array(data)
+
+    assert [bytes(tlv.tag.data) for tlv in tlv_array] == [b"\x7f\x49", b"\x9d"]
+    assert get_tlv_tag(tlv_array, 0x9D) == b"\xaa" * 16
+    (inner,) = tlv_array[0][[0xA1]]
+    assert bytes(get_tlv_tag(inner.value, 0x81)) == b"x" * 200
+    assert tlv_array[0][[0x5C]][0].value == b"\x02\x00"
+    assert b"".join(tlv.pack() for tlv in tlv_array) == data
+
+
+def test_unpack_keeps_values_as_views_into_buffer():
+    data = bytearray(TLV(0x53, value=b"\x00" * 300).pack())
+
+    tlv = TLV.unpack(data)
+    data[-1] = 0xFF
+
+    assert isinstance(tlv.value, memoryview)
+    assert tlv.value[-1] == 0xFF
+
+
+def test_unpack_fails_on_truncated_value():
+    with pytest.raises(ValueError):
+        TLV.unpack(TLV(0x53, value=b"\x00" * 300).pack()[:-1])
+
+
+def test_tlv_list_looks_up_repeated_and_missing_tags():
+    tlv_array = TLV.unpack_array(
+        TLV(0x5C, value=b"\x02\x00").pack()
+        + TLV(0x7F49, value=[TLV(0x86, value=b"\x04")]).pack()
+        + TLV(0x5C, value=b"\x01\x00").pack()
+    )
+
+    assert [tlv.value for tlv in tlv_array.get_all(0x5C)] == [b"\x02\x00", b"\x01\x00"]
+    assert tlv_array.get(b"\x7f\x49").get(0x86) == b"\x04"
+    assert tlv_array.get(0x9D) is None
+    with pytest.raises(KeyError, match="missing cryptogram"):
+        tlv_array.require(0x9D, "missing cryptogram", error=KeyError)
+
+    tlv_array.append(TLV(0x9D, value=b"\x01"))
+    assert tlv_array.require(0x9D) == b"\x01"
+
+
+def test_tlv8_object_round_trip_with_nested_object():
+    request = ControlPointRequest(
+        operation=Operation.ADD,
+        device_credential_request=DeviceCredentialRequest(
+            key_type=KeyType.SECP256R1,
+            credential_public_key=b"\x04" * 65,
+            issuer_key_identifier=b"\x01" * 8,
+            key_state=KeyState.ACTIVE,
+        ),
+    )
+
+    unpacked = ControlPointRequest.unpack(request.pack())
+
+    assert unpacked.operation is Operation.ADD
+    assert unpacked.reader_key_request is None
+    assert unpacked.device_credential_request.key_type is KeyType.SECP256R1
+    assert unpacked.device_credential_request.credential_public_key == b"\x04" * 65
+    assert unpacked.device_credential_request.key_identifier is None
+    assert unpacked.pack() == request.pack()
+
+
+def test_pack_flattens_nested_data_and_tlvs():
+    tlv = TLV(0xA1, value=[TLV(0x80, value=b"\x01"), (0x5E, [b"\x02", "a"])])
+
+    assert int(tlv.length) == 6
+    assert pack((b"\x00", [tlv, KeyType.SECP256R1], memoryview(b"\xff"))) == (
+        b"\x00" + b"\xa1\x06\x80\x01\x01\x5e\x02a" + b"\x02" + b"\xff"
+    )
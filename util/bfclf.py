@@ -48,7 +48,8 @@ from nfc.tag.tt4 import Type4Tag
 
 from util.generic import chunked
 # Modified code BEGIN
-from util.nfc import with_crc16a
+from util.nfc import with_crc16a_cached
+from util.pn53x import AutoPollingFrontendMixin, ChipsetShadow, negotiate_baudrate
 
 
 # Monkey patch pn532 init function to disable baudrate renegotiation
@@ -273,17 +274,40 @@ activate = activate
 # Modified code END
 
 
-class BroadcastFrameContactlessFrontend(ContactlessFrontend):
+class BroadcastFrameContactlessFrontend(
+    AutoPollingFrontendMixin, ContactlessFrontend
+):
     # Modified code BEGIN
-    def __init__(self, path=None, *, broadcast_enabled=False):
+    def __init__(
+        self, path=None, *, broadcast_enabled=False, auto_poll=False, baudrate=None
+    ):
         self.path = path
         self.broadcast_enabled = broadcast_enabled
+        self.auto_poll = auto_poll
+        # UART speed to switch PN532 to after it has been opened at the default speed
+        self.baudrate = baudrate
         # We send None so that we can try activating the reader later in a loop instead of throwing an exception right away
+        self.chipset_shadow = None
         super().__init__(None)
 
+    def open(self, path):
+        opened = super().open(path)
+        if opened and self.baudrate and isinstance(
+            self.device.chipset, nfc.clf.pn53x.Chipset
+        ):
+            negotiate_baudrate(self.device.chipset, self.baudrate)
+        return opened
+
+    def get_chipset_shadow(self):
+        """Returns shadow of the current PN53x chipset, creating it after device was (re)opened"""
+        chipset = self.device.chipset
+        if self.chipset_shadow is None or self.chipset_shadow.chipset is not chipset:
+            self.chipset_shadow = ChipsetShadow(chipset)
+        return self.chipset_shadow
+
     # Modified code END
 
-    def sense(self, *targets, **options):
+    def _sense(self, *targets, **options):
         def sense_tta(target):
             if target.sel_req and len(target.sel_req) not in (4, 7, 10):
                 raise ValueError("sel_req must be 4, 7, or 10 byte")
@@ -345,14 +369,16 @@ class BroadcastFrameContactlessFrontend(ContactlessFrontend):
                     f"Broadcast frames are not supported with chipset {self.device} for target {target}"
                 )
 
+            # Values are the same on every poll, so shadow only sends the ones that were changed since
+            chipset = self.get_chipset_shadow()
             # Turn off detection retries at it might break broadcast frame sequence
-            self.device.chipset.rf_configuration(0x05, [0xFF, 0x01, 0x00])
+            chipset.rf_configuration(0x05, [0xFF, 0x01, 0x00])
             # Set a 12 ms response timeout. Normally, WUPA takes 1.6-4.4 ms, so this timeout is more than sufficient
-            self.device.chipset.rf_configuration(0x02, [0x0A, 0x0B, 0x08])
+            chipset.rf_configuration(0x02, [0x0A, 0x0B, 0x08])
 
             if target.brty.endswith("A"):
-                self.device.chipset.write_register("CIU_BitFraming", 0x00)
-                broadcast = with_crc16a(broadcast)
+                chipset.write_register("CIU_BitFraming", 0x00)
+                broadcast = with_crc16a_cached(bytes(broadcast))
             try:
                 _ = self.device.chipset.in_communicate_thru(broadcast, timeout=0.25)
 
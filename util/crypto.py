@@ -1,3 +1,5 @@
+import hashlib
+import hmac
 from typing import Union
 
 from cryptography.hazmat.primitives import cmac
@@ -52,6 +54,40 @@ def aes_cmac(key: bytes, value: bytes):
     return cm.finalize()
 
 
+class PrecomputedHKDF:
+    """HKDF-SHA256 with the extract step done once.
+
+    Keeps an HMAC state keyed with the PRK, so that every expand
+    only has to hash the info, without re-deriving the PRK or re-keying HMAC
+    """
+
+    digest_size = hashlib.sha256().digest_size
+
+    def __init__(self, key_material: bytes, salt: bytes = None):
+        prk = hmac.new(
+            salt or bytes(self.digest_size), key_material, hashlib.sha256
+        ).digest()
+        self._hmac = hmac.new(prk, digestmod=hashlib.sha256)
+
+    def expand_block(self, info: bytes, index: int = 1, previous: bytes = b""):
+        """Returns block T(index) of the HKDF expand step"""
+        block = self._hmac.copy()
+        block.update(previous)
+        block.update(info)
+        block.update(bytes([index]))
+        return block.digest()
+
+    def expand(self, info: bytes, length: int):
+        result = b""
+        block = b""
+        index = 1
+        while len(result) < length:
+            block = self.expand_block(info, index, block)
+            result += block
+            index += 1
+        return result[:length]
+
+
 def pad_mode_3(message, pad_byte=0x80, *, block_size=8):
     return message + bytes(
         [pad_byte]
@@ -60,19 +96,11 @@ def pad_mode_3(message, pad_byte=0x80, *, block_size=8):
 
 
 def unpad_mode_3(message, pad_flag_byte=0x80, *, block_size=8):
-    result = bytes()
-    padding = True
-    for b in reversed(message):
-        if not padding:
-            result += bytes([b])
-        elif b in (0x00,):
-            pass
-            # Still padding
-        elif b in (pad_flag_byte,):
-            padding = False
-
-    if len(result) == 0:
+    if isinstance(message, memoryview):
+        message = message.tobytes()
+    index = message.rfind(bytes([pad_flag_byte]))
+    if index == -1:
         return message
-    if padding:
+    if message[index + 1 :].count(0x00) != len(message) - index - 1:
         raise ValueError("Message does not contain padding to remove")
-    return bytes(reversed(result))
+    return message[:index]
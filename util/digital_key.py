@@ -1,14 +1,17 @@
 from enum import IntEnum
-from typing import Tuple
+from typing import Dict, Tuple
+
+from cryptography.hazmat.primitives import cmac
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 
 from util.crypto import (
-    aes_cmac,
     decrypt_aes_cbc,
     encrypt_aes_cbc,
     pad_mode_3,
     unpad_mode_3,
 )
 from util.iso7816 import ISO7816Command, ISO7816Response, ISO7816Tag
+from util.structable import pack
 
 
 COMMAND_PCB = bytes.fromhex("000000000000000000000000000000")
@@ -56,23 +59,104 @@ def decrypt(ciphertext: bytes, pcb: bytes, kenc: bytes, counter: int, block_size
     return unpad_mode_3(padded_plaintext, block_size=block_size)
 
 
+class SecureMessagingSession:
+    """AES contexts for the keys of one secure channel, set up once and reused for every APDU.
+
+    ECB contexts are never finalized, so they keep the expanded key between calls.
+    CBC is chained over them by hand, and CMAC states keyed at creation are copied per MAC
+    """
+
+    # Longer payloads are encrypted with a dedicated CBC context,
+    # as chaining block by block in Python becomes slower than setting one up
+    CHAINING_THRESHOLD = 8 * 16
+
+    block_size = 16
+
+    def __init__(self, kenc: bytes, kmac: bytes, krmac: bytes):
+        self.kenc = kenc
+        cipher = Cipher(algorithms.AES(kenc), modes.ECB())
+        self._encryptor = cipher.encryptor()
+        self._decryptor = cipher.decryptor()
+        self._mac = cmac.CMAC(algorithms.AES(kmac))
+        self._rmac = cmac.CMAC(algorithms.AES(krmac))
+        self._icvs: Dict[Tuple[bytes, int], bytes] = dict()
+
+    def icv(self, pcb: bytes, counter: int) -> bytes:
+        counter %= 256
+        icv = self._icvs.get((pcb, counter))
+        if icv is None:
+            # CBC over a single block with zero IV is a plain block encryption
+            icv = self._icvs[(pcb, counter)] = self._encryptor.update(
+                pcb + bytes((counter,))
+            )
+        return icv
+
+    def encrypt(self, plaintext: bytes, pcb: bytes, counter: int) -> bytes:
+        if not len(plaintext):
+            return plaintext
+        icv = self.icv(pcb, counter)
+        size = len(plaintext)
+        # Padding is written straight into the buffer, trailing zeroes are already there
+        buffer = bytearray((size // self.block_size + 1) * self.block_size)
+        buffer[:size] = plaintext
+        buffer[size] = 0x80
+        if len(buffer) > self.CHAINING_THRESHOLD:
+            encryptor = Cipher(algorithms.AES(self.kenc), modes.CBC(icv)).encryptor()
+            return encryptor.update(buffer) + encryptor.finalize()
+
+        previous = int.from_bytes(icv, "big")
+        for index in range(0, len(buffer), self.block_size):
+            end = index + self.block_size
+            block = int.from_bytes(buffer[index:end], "big") ^ previous
+            buffer[index:end] = self._encryptor.update(block.to_bytes(16, "big"))
+            previous = int.from_bytes(buffer[index:end], "big")
+        return bytes(buffer)
+
+    def decrypt(self, ciphertext: bytes, pcb: bytes, counter: int) -> bytes:
+        if not len(ciphertext):
+            return ciphertext
+        if len(ciphertext) % self.block_size:
+            raise ValueError(
+                "The length of the provided data is not a multiple of the block length."
+            )
+        icv = self.icv(pcb, counter)
+        # Every block is decrypted at once, then XORed with the previous ciphertext block
+        decrypted = self._decryptor.update(ciphertext)
+        chain = icv + ciphertext[: -self.block_size]
+        padded_plaintext = (
+            int.from_bytes(decrypted, "big") ^ int.from_bytes(chain, "big")
+        ).to_bytes(len(ciphertext), "big")
+        return unpad_mode_3(padded_plaintext, block_size=self.block_size)
+
+    def mac(self, mac_chaining_value: bytes, data: bytes) -> bytes:
+        return self._calculate_mac(self._mac, mac_chaining_value, data)
+
+    def rmac(self, mac_chaining_value: bytes, data: bytes) -> bytes:
+        return self._calculate_mac(self._rmac, mac_chaining_value, data)
+
+    @staticmethod
+    def _calculate_mac(state: cmac.CMAC, mac_chaining_value: bytes, data: bytes):
+        state = state.copy()
+        state.update(mac_chaining_value)
+        state.update(data)
+        return state.finalize()
+
+
 class DigitalKeySecureContext:
     def __init__(self, tag: ISO7816Tag, kenc, kmac, krmac):
         self.tag = tag
         self.kenc = kenc
         self.kmac = kmac
         self.krmac = krmac
+        self.session = SecureMessagingSession(kenc, kmac, krmac)
         self.counter = 0
         self.mac_chaining_value = INITIAL_MAC_CHAINING_VALUE
 
     def encrypt_command(self, command: ISO7816Command) -> Tuple[ISO7816Command, bytes]:
-        ciphertext = encrypt(
-            plaintext=command.data,
-            pcb=COMMAND_PCB,
-            kenc=self.kenc,
-            counter=self.counter,
+        ciphertext = self.session.encrypt(
+            pack(command.data), pcb=COMMAND_PCB, counter=self.counter
         )
-        calculated_rmac = aes_cmac(self.kmac, self.mac_chaining_value + ciphertext)
+        calculated_rmac = self.session.mac(self.mac_chaining_value, ciphertext)
         data = ciphertext + calculated_rmac[:8]
         return (
             ISO7816Command(
@@ -89,13 +173,10 @@ class DigitalKeySecureContext:
     def encrypt_response(
         self, response: ISO7816Response
     ) -> Tuple[ISO7816Response, int]:
-        ciphertext = encrypt(
-            plaintext=response.data,
-            pcb=RESPONSE_PCB,
-            kenc=self.kenc,
-            counter=self.counter,
+        ciphertext = self.session.encrypt(
+            pack(response.data), pcb=RESPONSE_PCB, counter=self.counter
         )
-        calculated_rmac = aes_cmac(self.krmac, self.mac_chaining_value + ciphertext)
+        calculated_rmac = self.session.rmac(self.mac_chaining_value, ciphertext)
         data = ciphertext + calculated_rmac[:8]
         return (
             ISO7816Response(sw1=response.sw1, sw2=response.sw2, data=data),
@@ -104,12 +185,12 @@ class DigitalKeySecureContext:
 
     def decrypt_command(self, command: ISO7816Command) -> Tuple[ISO7816Command, bytes]:
         ciphertext, mac = command.data[:-8], command.data[-8:]
-        calculated_mac = aes_cmac(self.kmac, self.mac_chaining_value + ciphertext)
+        calculated_mac = self.session.mac(self.mac_chaining_value, ciphertext)
         assert (
             mac == calculated_mac[:8]
         ), f"MAC Does mac={mac.hex()} calculated_mac={calculated_mac[:8].hex()}"
-        plaintext = decrypt(
-            ciphertext=ciphertext, pcb=COMMAND_PCB, kenc=self.kenc, counter=self.counter
+        plaintext = self.session.decrypt(
+            ciphertext, pcb=COMMAND_PCB, counter=self.counter
         )
         return (
             ISO7816Command(
@@ -127,15 +208,12 @@ class DigitalKeySecureContext:
         self, response: ISO7816Response
     ) -> Tuple[ISO7816Response, int]:
         ciphertext, rmac = response.data[:-8], response.data[-8:]
-        calculated_rmac = aes_cmac(self.krmac, self.mac_chaining_value + ciphertext)
+        calculated_rmac = self.session.rmac(self.mac_chaining_value, ciphertext)
         assert (
             rmac == calculated_rmac[:8]
         ), f"RMAC Does rmac={rmac.hex()} calculated_rmac={calculated_rmac[:8].hex()}"
-        plaintext = decrypt(
-            ciphertext=ciphertext,
-            pcb=RESPONSE_PCB,
-            kenc=self.kenc,
-            counter=self.counter,
+        plaintext = self.session.decrypt(
+            ciphertext, pcb=RESPONSE_PCB, counter=self.counter
         )
         return (
             ISO7816Response(sw1=response.sw1, sw2=response.sw2, data=plaintext),
@@ -166,4 +244,5 @@ __all__ = (
     "DigitalKeyTransactionType",
     "DigitalKeyTransactionFlags",
     "DigitalKeySecureContext",
+    "SecureMessagingSession",
 )
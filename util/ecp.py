@@ -1,3 +1,4 @@
+from functools import lru_cache
 from typing import Tuple
 
 from util.structable import PackableData, Packable, pack
@@ -82,3 +83,13 @@ class ECPV2(ECP):
                 payload,
             )
         )
+
+
+@lru_cache(maxsize=4)
+def get_home_frame(identifier: bytes, express: bool = True) -> bytes:
+    """Returns packed home ECP frame.
+
+    Frame is sent on every polling iteration, so it is cached by its inputs
+    and rebuilt only when reader key (and so its identifier) or express mode change
+    """
+    return ECP.home(identifier=bytes(identifier), flag_2=int(express)).pack()
@@ -1,3 +1,6 @@
+from dataclasses import dataclass
+from typing import Any, Dict
+
 import cbor2
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.ciphers.aead import AESGCM
@@ -28,6 +31,8 @@ class ISO18013SecureContext:
             salt=salt,
             info=READER_CONTEXT,
         ).derive(shared_secret)
+        self._reader_aead = AESGCM(self.reader_key)
+        self._reader_iv_prefix = bytes(4) + READER_MODE
 
         self.endpoint_counter = 1
         self.endpoint_key = HKDF(
@@ -36,21 +41,21 @@ class ISO18013SecureContext:
             salt=salt,
             info=ENDPOINT_CONTEXT,
         ).derive(shared_secret)
+        self._endpoint_aead = AESGCM(self.endpoint_key)
+        self._endpoint_iv_prefix = bytes(4) + ENDPOINT_MODE
 
     @property
     def reader_iv(self):
-        return bytes([0x00] * 4) + READER_MODE + self.reader_counter.to_bytes(4, "big")
+        return self._reader_iv_prefix + self.reader_counter.to_bytes(4, "big")
 
     @property
     def endpoint_iv(self):
-        return (
-            bytes([0x00] * 4) + ENDPOINT_MODE + self.endpoint_counter.to_bytes(4, "big")
-        )
+        return self._endpoint_iv_prefix + self.endpoint_counter.to_bytes(4, "big")
 
     def encrypt_message_to_endpoint(self, message: bytes):
         ciphertext = cbor2.dumps(
             {
-                "data": AESGCM(self.reader_key).encrypt(
+                "data": self._reader_aead.encrypt(
                     nonce=self.reader_iv, associated_data=None, data=message
                 )
             }
@@ -61,11 +66,45 @@ class ISO18013SecureContext:
     def decrypt_message_from_endpoint(self, message: bytes):
         cbor = cbor2.loads(message)
         cbor_ciphertext = cbor["data"]
-        cbor_plaintext = AESGCM(self.endpoint_key).decrypt(
+        cbor_plaintext = self._endpoint_aead.decrypt(
             nonce=self.endpoint_iv, data=cbor_ciphertext, associated_data=None
         )
         self.endpoint_counter += 1
         return cbor_plaintext
 
 
-__all__ = "ISO18013SecureContext"
+@dataclass
+class IssuerAuth:
+    """Parts of an attestation document needed to verify it and enroll its device key"""
+
+    protected_headers: bytes
+    issuer_id: bytes
+    # Encoded mobile security object, signed by the issuer
+    payload: bytes
+    signature: bytes
+    device_key: Dict[int, Any]
+
+
+def parse_issuer_auth(attestation_package: bytes) -> IssuerAuth:
+    """Extracts issuer authentication of the first document in the package.
+
+    Package is decoded by cbor2 in one pass, only the mobile security object,
+    which is embedded as encoded bytes, requires to be decoded separately
+    """
+    document = cbor2.loads(attestation_package)["documents"][0]
+    protected_headers, unprotected_headers, payload, signature = document[
+        "issuerSigned"
+    ]["issuerAuth"]
+    mobile_security_object = cbor2.loads(payload)
+    if isinstance(mobile_security_object, cbor2.CBORTag):
+        mobile_security_object = cbor2.loads(mobile_security_object.value)
+    return IssuerAuth(
+        protected_headers=protected_headers,
+        issuer_id=unprotected_headers[4],
+        payload=payload,
+        signature=signature,
+        device_key=mobile_security_object["deviceKeyInfo"]["deviceKey"],
+    )
+
+
+__all__ = ("ISO18013SecureContext", "IssuerAuth", "parse_issuer_auth")
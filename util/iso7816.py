@@ -1,6 +1,9 @@
+import time
 from enum import Enum, IntEnum
-from typing import Any, Union
+from functools import lru_cache
+from typing import Any, Optional, Union
 
+from util.metrics import metrics
 from util.structable import Packable, Unpackable, pack
 
 #
@@ -48,6 +51,14 @@ class ISO7816Class(int):
 
 
 class ISO7816Command(Packable):
+    """APDU command.
+
+    Packed form is computed once and reused until any attribute is reassigned,
+    so commands that are sent repeatedly or prepared ahead of time are not packed again.
+    Data should not be modified in place after the command has been packed.
+    Le of 0 means maximum response size: 256 bytes in short form, 65536 in extended one
+    """
+
     cla: Union[int, ISO7816Class]
     ins: Union[int, ISO7816Instruction]
     p1: int
@@ -55,8 +66,21 @@ class ISO7816Command(Packable):
     lc: int
     data: bytes
     le: int
-
-    def __init__(self, *, cla=0x00, ins=0x00, p1=0x00, p2=0x00, data=None, le=None):
+    # Forces extended length encoding of Lc and Le
+    extended: bool
+    _packed: Optional[bytes] = None
+
+    def __init__(
+        self,
+        *,
+        cla=0x00,
+        ins=0x00,
+        p1=0x00,
+        p2=0x00,
+        data=None,
+        le=None,
+        extended=False,
+    ):
         super().__init__()
         self.cla = cla
         self.ins = ins
@@ -64,17 +88,24 @@ class ISO7816Command(Packable):
         self.p2 = p2
         self.data = data if data is not None else b""
         self.le = le
+        self.extended = extended
+
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        if name != "_packed":
+            object.__setattr__(self, "_packed", None)
 
     @staticmethod
     def unpack(data: bytearray):
+        data = data if isinstance(data, memoryview) else memoryview(data)
         cla, ins, p1, p2 = data[:4]
         data_le = data[4:]
         if len(data_le):
             data_length = data_le[0]
             data = data_le[1 : 1 + data_length]
-            le = None if len(data_le) == data_length else data_le[-1]
+            le = None if len(data_le) <= 1 + data_length else data_le[-1]
         else:
-            data = bytearray()
+            data = b""
             le = None
         return ISO7816Command(cla=cla, ins=ins, p1=p1, p2=p2, data=data, le=le)
 
@@ -82,22 +113,38 @@ class ISO7816Command(Packable):
     def lc(self):
         return len(pack(self.data))
 
-    def pack(self) -> bytearray:
-        force_extended_length = False
+    def pack(self) -> bytes:
+        if self._packed is None:
+            self._packed = self._pack()
+        return self._packed
 
-        le = (self.le,) if self.le is not None else ()
+    def _pack(self) -> bytes:
+        data = self.data
+        if not isinstance(data, (bytes, bytearray, memoryview)):
+            data = pack(data)
+        lc = len(data)
 
-        if 256 <= self.lc <= 65_535 or force_extended_length:
-            lc_data = pack((0x00, self.lc.to_bytes(2, "big"), self.data))
-        elif 0 < self.lc < 256:
-            lc_data = pack((self.lc, self.data))
-        elif self.lc == 0:
-            lc_data = ()
-        else:
+        if lc > 65_535:
             raise ValueError(
-                f"Length of an APDU should be in range [0, 65535], actual = {self.lc}"
+                f"Length of an APDU should be in range [0, 65535], actual = {lc}"
             )
-        return bytes([self.cla, self.ins, self.p1, self.p2, *lc_data, *le])
+        le = self.le
+        extended = self.extended or lc > 255 or (le is not None and le > 256)
+
+        header = (self.cla, self.ins, self.p1, self.p2)
+        if lc and extended:
+            header += (0x00, lc >> 8, lc & 0xFF)
+        elif lc:
+            header += (lc,)
+        if le is None:
+            return bytes(header) + data
+
+        if extended:
+            le = le % 65_536
+            trailer = (le >> 8, le & 0xFF) if lc else (0x00, le >> 8, le & 0xFF)
+        else:
+            trailer = (le % 256,)
+        return b"".join((bytes(header), data, bytes(trailer)))
 
     def __repr__(self):
         return (
@@ -136,23 +183,29 @@ class ISO7816StatusGroup(IntEnum):
     ERROR_UNKNOWN = 0x6F
 
 
+_STATUS_GROUPS = {group.value: group for group in ISO7816StatusGroup}
+
+
 class ISO7816Response(Unpackable, Packable):
     sw1: Union[int, ISO7816StatusGroup]
     sw2: int
-    data: bytearray
+    data: Union[bytearray, memoryview]
 
     def __init__(self, *, sw1=0x00, sw2=0x00, data=None):
         try:
-            self.sw1 = ISO7816StatusGroup(sw1)
-        except (TypeError, ValueError):
+            self.sw1 = _STATUS_GROUPS.get(sw1, sw1)
+        except TypeError:
             self.sw1 = sw1
         self.sw2 = sw2
-        self.data = data or bytearray()
+        self.data = data if data is not None else bytearray()
 
     @classmethod
     def unpack(cls, data: Union[bytes, bytearray]) -> "ISO7816Response":
-        *data, sw1, sw2 = data
-        return ISO7816Response(sw1=sw1, sw2=sw2, data=bytearray(data))
+        """Parses a response. Data is a memoryview slice of `data`, not a copy"""
+        data = data if isinstance(data, memoryview) else memoryview(data)
+        if len(data) < 2:
+            raise ValueError(f"Response is too short to contain status {len(data)}")
+        return ISO7816Response(sw1=data[-2], sw2=data[-1], data=data[:-2])
 
     @property
     def sw(self):
@@ -184,19 +237,95 @@ class ISO7816:
         )
 
     @classmethod
+    @lru_cache(maxsize=16)
     def select_aid(
         cls, aid: Union[bytes, ISO7816Application], p1=0x04, p2=0x00, le=0x00
     ):
+        # Same command object is returned for the same arguments so that it's only packed once
         return cls.select_file(data=aid, p1=p1, p2=p2, le=0x00)
 
 
 class ISO7816Tag:
-    def __init__(self, implementation: Any) -> None:
+    """Sends APDUs to a card, counting exchanges and time spent on them.
+
+    Time of each exchange is observed as `apdu.<INS>.ms` metric.
+
+    If `extended_length` is set, commands sent via `transceive_chained` request
+    the whole response at once using extended Le.
+    If the card rejects an extended command, it's resent in short form,
+    and short form is used for the rest of the session
+    """
+
+    round_trips: int
+    # Seconds spent waiting for responses
+    transceive_time: float
+    extended_length: bool
+    max_response_size: int
+
+    def __init__(
+        self, implementation: Any, extended_length=False, max_response_size=65_536
+    ) -> None:
         self._implementation = implementation
+        self.extended_length = extended_length
+        self.max_response_size = max_response_size
+        self.round_trips = 0
+        self.transceive_time = 0.0
 
     def transceive(self, data: Union[bytes, ISO7816Command]) -> ISO7816Response:
-        return ISO7816Response.unpack(
-            self._implementation.transceive(
-                bytes(data.pack()) if isinstance(data, ISO7816Command) else bytes(data)
+        if isinstance(data, ISO7816Command):
+            data = data.pack()
+        elif not isinstance(data, bytes):
+            data = bytes(data)
+        self.round_trips += 1
+        started = time.perf_counter()
+        response = self._implementation.transceive(data)
+        elapsed = time.perf_counter() - started
+        self.transceive_time += elapsed
+        if len(data) > 1:
+            metrics.observe(f"apdu.{data[1]:02x}.ms", elapsed * 1000)
+        return ISO7816Response.unpack(response)
+
+    def transceive_chained(
+        self, command: ISO7816Command, max_size: Optional[int] = None
+    ) -> ISO7816Response:
+        """Sends a command, collecting response parts announced with 0x61XX by GET RESPONSE"""
+        max_size = max_size or self.max_response_size
+        response = None
+        if self.extended_length and command.le is not None:
+            response = self.transceive(
+                ISO7816Command(
+                    cla=command.cla,
+                    ins=command.ins,
+                    p1=command.p1,
+                    p2=command.p2,
+                    data=command.data,
+                    le=command.le,
+                    extended=True,
+                )
             )
-        )
+            if response.sw1 == ISO7816StatusGroup.ERROR_FORMAT_WRONG_COMMAND_LENGTH:
+                self.extended_length = False
+                response = None
+        if response is None:
+            response = self.transceive(command)
+
+        if response.sw1 != ISO7816StatusGroup.OK_MORE_DATA_LEFT:
+            return response
+
+        data = bytearray(response.data)
+        while response.sw1 == ISO7816StatusGroup.OK_MORE_DATA_LEFT:
+            response = self.transceive(
+                ISO7816Command(
+                    cla=0x00,
+                    ins=ISO7816Instruction.GET_RESPONSE,
+                    p1=0x00,
+                    p2=0x00,
+                    le=response.sw2,
+                )
+            )
+            data += response.data
+            if len(data) > max_size:
+                raise ValueError(
+                    f"Chained response exceeds maximum size of {max_size} bytes"
+                )
+        return ISO7816Response(sw1=response.sw1, sw2=response.sw2, data=data)
@@ -0,0 +1,83 @@
+from threading import Lock
+from typing import Dict, Union
+
+
+class Statistic:
+    """Running count/total/min/max of observed values"""
+
+    count: int
+    total: float
+    minimum: float
+    maximum: float
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.minimum = float("inf")
+        self.maximum = float("-inf")
+
+    def observe(self, value: float):
+        self.count += 1
+        self.total += value
+        self.minimum = min(self.minimum, value)
+        self.maximum = max(self.maximum, value)
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "mean": self.mean,
+            "min": self.minimum if self.count else 0,
+            "max": self.maximum if self.count else 0,
+        }
+
+    def __repr__(self) -> str:
+        return f"Statistic(count={self.count}, mean={self.mean:.3f}, min={self.minimum}, max={self.maximum})"
+
+
+class Metrics:
+    """Named counters and statistics shared between the reader components"""
+
+    _values: Dict[str, Union[int, Statistic]]
+
+    def __init__(self):
+        self._values = dict()
+        self._lock = Lock()
+
+    def increment(self, name: str, value: int = 1):
+        with self._lock:
+            self._values[name] = self._values.get(name, 0) + value
+
+    def observe(self, name: str, value: float):
+        with self._lock:
+            statistic = self._values.get(name)
+            if statistic is None:
+                statistic = self._values[name] = Statistic()
+            statistic.observe(value)
+
+    def get(self, name: str, default=None):
+        return self._values.get(name, default)
+
+    def reset(self, prefix: str = ""):
+        with self._lock:
+            for name in [n for n in self._values if n.startswith(prefix)]:
+                del self._values[name]
+
+    def to_dict(self, prefix: str = ""):
+        with self._lock:
+            return {
+                name: value.to_dict() if isinstance(value, Statistic) else value
+                for name, value in sorted(self._values.items())
+                if name.startswith(prefix)
+            }
+
+    def __repr__(self) -> str:
+        return f"Metrics({self.to_dict()})"
+
+
+metrics = Metrics()
+
+__all__ = ("Metrics", "Statistic", "metrics")
@@ -1,7 +1,6 @@
 from enum import IntEnum
-from typing import Collection, Union
+from typing import Collection, Iterator, Optional, Union
 
-from util.generic import bits
 from util.structable import Packable, Unpackable, pack, represent
 
 
@@ -10,6 +9,14 @@ from util.structable import Packable, Unpackable, pack, represent
 #
 
 
+NDEF_MB = 0b10000000  # Message begin
+NDEF_ME = 0b01000000  # Message end
+NDEF_CF = 0b00100000  # Chunk flag
+NDEF_SR = 0b00010000  # Short record
+NDEF_IL = 0b00001000  # ID length present
+NDEF_TNF = 0b00000111  # Type name format
+
+
 class NDEFRecordType(IntEnum):
     EMPTY = 0
     WELL_KNOWN = 1
@@ -37,6 +44,21 @@ class NDEFRecord:
         return f"NDEFRecord(tnf={represent(self.tnf)}, type={represent(self.type)}, id={represent(self.id)}, payload={represent(self.payload)})"
 
 
+def _pack_record(result: bytearray, flags: int, tnf, type_, id_, payload):
+    short = len(payload) <= 255
+    result.append(flags | (NDEF_SR * short) | (NDEF_IL * (len(id_) > 0)) | tnf)
+    result.append(len(type_))
+    if short:
+        result.append(len(payload))
+    else:
+        result += len(payload).to_bytes(4, byteorder="big")
+    if len(id_):
+        result.append(len(id_))
+    result += type_
+    result += id_
+    result += payload
+
+
 class NDEFMessage(Packable, Unpackable):
     records: Collection["NDEFRecord"]
 
@@ -45,76 +67,111 @@ class NDEFMessage(Packable, Unpackable):
 
     @classmethod
     def unpack(cls, data: bytes):
+        return NDEFMessage(list(cls.iter_records(data)))
+
+    @classmethod
+    def iter_records(cls, data: bytes) -> Iterator[NDEFRecord]:
+        """Lazily yields records of a message, joining chunked records together.
+
+        Payloads of unchunked records are memoryview slices of `data`
+        """
+        data = data if isinstance(data, memoryview) else memoryview(data)
         index = 0
-        records = []
+        first = True
+        chunked = None
         while index < len(data) - 1:
-            first = data[index]
+            header = data[index]
             index += 1
 
-            mb, me, ch, sr, il, *tnf = bits(first)
-            tnf = NDEFRecordType(int("".join(str(b) for b in tnf), 2))
+            assert bool(header & NDEF_MB) == first
+            first = False
 
             type_length = data[index]
             index += 1
 
-            assert mb == (len(records) == 0)
-
-            if sr:
+            if header & NDEF_SR:
                 payload_length = data[index]
                 index += 1
             else:
                 payload_length = int.from_bytes(data[index : index + 4], "big")
                 index += 4
 
-            if il:
+            if header & NDEF_IL:
                 id_length = data[index]
                 index += 1
             else:
                 id_length = 0
 
-            type_ = data[index : index + type_length]
+            type_ = bytes(data[index : index + type_length])
             index += type_length
 
-            id_ = data[index : index + id_length]
+            id_ = bytes(data[index : index + id_length])
             index += id_length
 
             payload = data[index : index + payload_length]
             index += payload_length
 
-            records.append(NDEFRecord(id=id_, tnf=tnf, type=type_, payload=payload))
-        return NDEFMessage(records)
+            tnf = NDEFRecordType(header & NDEF_TNF)
+            if chunked is not None:
+                # Middle and terminating chunks only carry the payload
+                if tnf != NDEFRecordType.UNCHANGED:
+                    raise ValueError(f"Unexpected TNF {tnf!r} of a record chunk")
+                chunked.payload += payload
+                if not header & NDEF_CF:
+                    chunked.payload = bytes(chunked.payload)
+                    yield chunked
+                    chunked = None
+            elif header & NDEF_CF:
+                chunked = NDEFRecord(
+                    id=id_, tnf=tnf, type=type_, payload=bytearray(payload)
+                )
+            else:
+                yield NDEFRecord(id=id_, tnf=tnf, type=type_, payload=payload)
+
+            if header & NDEF_ME:
+                break
+
+        if chunked is not None:
+            raise ValueError("Message ended in the middle of a chunked record")
 
-    def pack(self) -> bytes:
-        result = b""
+    def pack(self, chunk_size: Optional[int] = None) -> bytes:
+        """Packs the message, splitting payloads longer than `chunk_size` into chunked records"""
+        result = bytearray()
+        count = len(self.records)
         for index, record in enumerate(self.records):
             payload = pack(record.payload)
-
-            mb = 0b10000000 * (index == 0)
-            me = 0b01000000 * (index == len(self.records) - 1)  # Message end
-            ch = 0b00100000 * 0  # Chunk flag
-            sr = 0b00010000 * (len(payload) <= 255)  # Short record
-            il = 0b00001000 * (len(record.id) > 0)  # ID length present
-            tnf = record.tnf  # Record type
-
-            header = mb + me + ch + sr + il + tnf
-
-            id_length = [len(record.id)] if len(record.id) else []
-
-            payload_length = [
-                len(payload).to_bytes(4, byteorder="big") if not sr else len(payload)
-            ]
-
-            record_data = [
-                header,
-                len(record.type),
-                payload_length,
-                id_length,
-                record.type,
-                record.id,
-                payload,
-            ]
-            result += pack(record_data)
-        return result
+            flags = NDEF_MB * (index == 0)
+            end_flag = NDEF_ME * (index == count - 1)
+
+            if chunk_size is None or len(payload) <= chunk_size:
+                _pack_record(
+                    result,
+                    flags | end_flag,
+                    record.tnf,
+                    record.type,
+                    record.id,
+                    payload,
+                )
+                continue
+
+            chunks = range(0, len(payload), chunk_size)
+            for offset in chunks:
+                chunk = payload[offset : offset + chunk_size]
+                last = offset == chunks[-1]
+                if offset == 0:
+                    tnf, type_, id_ = record.tnf, record.type, record.id
+                else:
+                    tnf, type_, id_ = NDEFRecordType.UNCHANGED, b"", b""
+                    flags = 0
+                _pack_record(
+                    result,
+                    flags | (end_flag if last else NDEF_CF),
+                    tnf,
+                    type_,
+                    id_,
+                    chunk,
+                )
+        return bytes(result)
 
     def find(self, filter, *, selection="first", default=None):
         if selection == "first":
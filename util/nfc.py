@@ -1,14 +1,36 @@
+from functools import lru_cache
+
+
+def _crc16a_table():
+    table = []
+    for index in range(256):
+        w_crc = index
+        for _ in range(8):
+            w_crc = (w_crc >> 1) ^ 0x8408 if w_crc & 1 else w_crc >> 1
+        table.append(w_crc)
+    return tuple(table)
+
+
+# CRC_A is a reflected CRC-16/CCITT, so the table is indexed by the low byte of the register
+CRC16A_TABLE = _crc16a_table()
+
+
 def crc16a(data):
     w_crc = 0x6363
+    table = CRC16A_TABLE
     for byte in data:
-        byte = byte ^ (w_crc & 0x00FF)
-        byte = (byte ^ (byte << 4)) & 0xFF
-        w_crc = ((w_crc >> 8) ^ (byte << 8) ^ (byte << 3) ^ (byte >> 4)) & 0xFFFF
+        w_crc = (w_crc >> 8) ^ table[(w_crc ^ byte) & 0xFF]
     return bytearray([w_crc & 0xFF, (w_crc >> 8) & 0xFF])
 
 
 def with_crc16(data):
-    return bytes([*data, *crc16a(data)])
+    return bytes(data) + crc16a(data)
 
 
 with_crc16a = with_crc16
+
+
+@lru_cache(maxsize=8)
+def with_crc16a_cached(data: bytes) -> bytes:
+    """with_crc16a for frames that are sent over and over again, such as polling ECP frames"""
+    return with_crc16a(data)
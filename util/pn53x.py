@@ -0,0 +1,382 @@
+import errno
+import logging
+import time
+from typing import Dict, FrozenSet, Optional, Tuple
+
+from nfc.clf import RemoteTarget
+
+from util.metrics import metrics
+
+log = logging.getLogger()
+
+READ_REGISTER = 0x06
+WRITE_REGISTER = 0x08
+POWER_DOWN = 0x16
+RF_CONFIGURATION = 0x32
+IN_COMMUNICATE_THRU = 0x42
+IN_LIST_PASSIVE_TARGET = 0x4A
+IN_AUTO_POLL = 0x60
+
+# Generic passive 106 kbps Type A target, activated up to anticollision the same way
+# as with InListPassiveTarget, so that nfcpy can continue with RATS on its own.
+# Type 0x10 only stands for Mifare cards, with 0x20 (ISO14443-4A) chip sends RATS itself
+AUTO_POLL_TYPE_A = 0x00
+# Period of InAutoPoll is set in units of 150 ms
+AUTO_POLL_PERIOD_UNIT = 0.15
+
+# UART speeds supported by PN532 SetSerialBaudrate
+PN532_BAUDRATES = (9600, 19200, 38400, 57600, 115200, 230400, 460800, 921600, 1288000)
+DEFAULT_BAUDRATE = 115200
+
+# Item that switches RF field on and off, doesn't affect other configuration
+RF_CONFIGURATION_FIELD = 0x01
+
+# Registers that hold the state of the last exchange rather than configuration
+_TRANSCEIVE_REGISTERS = frozenset(
+    (
+        "CIU_Command",
+        "CIU_CommIRq",
+        "CIU_DivIRq",
+        "CIU_Error",
+        "CIU_Status1",
+        "CIU_Status2",
+        "CIU_FIFOData",
+        "CIU_FIFOLevel",
+        "CIU_Control",
+        "CIU_Coll",
+        "CIU_TCounterHi",
+        "CIU_TCounterLo",
+    )
+)
+# Firmware sets up 106 kbps Type A framing to activate a target by itself.
+# Short and bit oriented frames of anticollision end with whole byte SELECT,
+# so BitFraming is back to its previous value afterwards
+_ACTIVATION_REGISTERS = _TRANSCEIVE_REGISTERS | frozenset(
+    (
+        "CIU_Mode",
+        "CIU_TxMode",
+        "CIU_RxMode",
+        "CIU_TxAuto",
+        "CIU_ManualRCV",
+        "CIU_MifNFC",
+        "CIU_TMode",
+        "CIU_TPrescaler",
+        "CIU_TReloadHi",
+        "CIU_TReloadLo",
+    )
+)
+# CIU registers the firmware changes while executing a command.
+# Commands that are not listed here are assumed to change any register
+CLOBBERED_REGISTERS: Dict[int, FrozenSet[str]] = {
+    READ_REGISTER: frozenset(),
+    # Field, analog settings and timeouts
+    RF_CONFIGURATION: frozenset(
+        (
+            "CIU_TxControl",
+            "CIU_TxAuto",
+            "CIU_RFCfg",
+            "CIU_GsNOn",
+            "CIU_GsNOff",
+            "CIU_CWGsP",
+            "CIU_ModGsP",
+            "CIU_RxThreshold",
+            "CIU_Demod",
+            "CIU_TMode",
+            "CIU_TPrescaler",
+            "CIU_TReloadHi",
+            "CIU_TReloadLo",
+        )
+    ),
+    # Frame is sent with framing set up by the host
+    IN_COMMUNICATE_THRU: _TRANSCEIVE_REGISTERS,
+    IN_LIST_PASSIVE_TARGET: _ACTIVATION_REGISTERS,
+    IN_AUTO_POLL: _ACTIVATION_REGISTERS,
+}
+
+
+class ChipsetShadow:
+    """Remembers RF configuration items and register values written to a PN53x chipset.
+
+    Chipset commands are intercepted so that writes done by nfcpy itself are also
+    accounted for. RF configuration items are firmware settings that stay the same
+    until changed or the chip is powered down, while a CIU register value is only trusted
+    until a command during which the firmware changes that register, see CLOBBERED_REGISTERS.
+
+    Frames and bytes exchanged over the transport are counted per poll
+    """
+
+    _rf_configuration: Dict[int, bytes]
+    _registers: Dict[int, int]
+
+    def __init__(self, chipset):
+        self.chipset = chipset
+        self._rf_configuration = dict()
+        self._registers = dict()
+        self.frames = 0
+        self.bytes = 0
+
+        # Instance attributes take precedence over methods,
+        # so every command sent by the chipset goes through the shadow
+        self._command = chipset.command
+        chipset.command = self._tracked_command
+        transport = chipset.transport
+        self._transport_read, self._transport_write = transport.read, transport.write
+        transport.read, transport.write = self._counted_read, self._counted_write
+
+    def _tracked_command(self, cmd_code, cmd_data, timeout):
+        if cmd_code == RF_CONFIGURATION and len(cmd_data):
+            self._rf_configuration.pop(cmd_data[0], None)
+        elif cmd_code == WRITE_REGISTER:
+            # Writes may have side effects, so only remember values written via shadow
+            for offset in range(0, len(cmd_data) - 2, 3):
+                self._registers.pop(
+                    int.from_bytes(cmd_data[offset : offset + 2], "big"), None
+                )
+        elif cmd_code == POWER_DOWN:
+            self.invalidate()
+        elif cmd_code in CLOBBERED_REGISTERS:
+            for name in CLOBBERED_REGISTERS[cmd_code]:
+                self._registers.pop(self.chipset.REGBYNAME[name], None)
+        else:
+            self._registers.clear()
+
+        response = self._command(cmd_code, cmd_data, timeout)
+
+        if cmd_code == RF_CONFIGURATION and len(cmd_data):
+            if cmd_data[0] != RF_CONFIGURATION_FIELD:
+                self._rf_configuration[cmd_data[0]] = bytes(cmd_data[1:])
+        return response
+
+    def _counted_read(self, *args, **kwargs):
+        frame = self._transport_read(*args, **kwargs)
+        if frame:
+            self.frames += 1
+            self.bytes += len(frame)
+        return frame
+
+    def _counted_write(self, frame, *args, **kwargs):
+        self.frames += 1
+        self.bytes += len(frame)
+        return self._transport_write(frame, *args, **kwargs)
+
+    def rf_configuration(self, cfg_item: int, cfg_data):
+        """Sends RFConfiguration command unless the item already has this value"""
+        if self._rf_configuration.get(cfg_item) == bytes(cfg_data):
+            metrics.increment("chipset.skipped_writes")
+            return
+        self.chipset.rf_configuration(cfg_item, cfg_data)
+
+    def write_register(self, *args):
+        """Writes registers that don't have the requested value in a single WriteRegister frame.
+
+        Accepts the same arguments as nfcpy Chipset.write_register
+        """
+        if len(args) == 2 and isinstance(args[1], int):
+            args = [args]
+        registers = [
+            (self.chipset.REGBYNAME[reg] if isinstance(reg, str) else reg, value)
+            for reg, value in args
+        ]
+        changed = [
+            (reg, value)
+            for reg, value in registers
+            if self._registers.get(reg) != value
+        ]
+        if len(changed) < len(registers):
+            metrics.increment("chipset.skipped_writes", len(registers) - len(changed))
+        if not changed:
+            return
+        self.chipset.write_register(*changed)
+        self._registers.update(changed)
+
+    def invalidate(self):
+        self._rf_configuration.clear()
+        self._registers.clear()
+
+    def start_poll(self):
+        self.frames, self.bytes = 0, 0
+
+    def end_poll(self) -> Tuple[int, int]:
+        """Records frames and bytes exchanged since the previous poll, returns them"""
+        frames, bytes_ = self.frames, self.bytes
+        self.frames, self.bytes = 0, 0
+        metrics.observe("chipset.frames_per_poll", frames)
+        metrics.observe("chipset.bytes_per_poll", bytes_)
+        return frames, bytes_
+
+
+class AutoPoller:
+    """Lets a PN532 poll for a Type A target on its own.
+
+    A single InAutoPoll command makes the chip poll `poll_count` times every
+    `period` * 150 ms, answering only when a target is found or polling is over,
+    so host neither wakes up nor exchanges frames between polls
+    """
+
+    def __init__(self, chipset, poll_count=2, period=1):
+        assert 0x01 <= poll_count <= 0xFE
+        assert 0x01 <= period <= 0x0F
+        self.chipset = chipset
+        self.poll_count = poll_count
+        self.period = period
+
+    @staticmethod
+    def is_supported(chipset) -> bool:
+        return IN_AUTO_POLL in getattr(chipset, "CMD", {})
+
+    @property
+    def timeout(self) -> float:
+        # Each poll also takes some time on top of the period, leave a margin for it
+        return self.poll_count * self.period * AUTO_POLL_PERIOD_UNIT * 1.5 + 0.1
+
+    def poll(self) -> Optional[RemoteTarget]:
+        """Returns found target, or None if none appeared until polling was over"""
+        try:
+            data = self.chipset.command(
+                IN_AUTO_POLL,
+                bytearray([self.poll_count, self.period, AUTO_POLL_TYPE_A]),
+                timeout=self.timeout,
+            )
+        except IOError as e:
+            # Chip has been sent an ACK to abort polling
+            if e.errno != errno.ETIMEDOUT:
+                raise
+            return None
+        if not data or data[0] == 0:
+            return None
+        target_type, length = data[1], data[2]
+        if target_type != AUTO_POLL_TYPE_A or length < 5 or len(data) < 3 + length:
+            raise ValueError(f"Unexpected InAutoPoll response {bytes(data).hex()}")
+        # Target data is the same as of InListPassiveTarget: Tg, SENS_RES, SEL_RES, UID
+        target_data = data[4 : 3 + length]
+        uid_length = target_data[3]
+        if len(target_data) < 4 + uid_length:
+            raise ValueError(f"Truncated InAutoPoll response {bytes(data).hex()}")
+        return RemoteTarget(
+            "106A",
+            sens_res=target_data[1::-1],
+            sel_res=target_data[2:3],
+            sdd_res=target_data[4 : 4 + uid_length],
+        )
+
+
+class AutoPollingFrontendMixin:
+    """Lets a ContactlessFrontend fall back to InAutoPoll after a poll with a broadcast found nothing.
+
+    Mixed into a frontend that provides `auto_poll`, `chipset_shadow`, `device`, `lock`,
+    `target` and `_sense`, so that the decision can be tested without USB transport
+    """
+
+    def sense(self, *targets, **options):
+        if self.chipset_shadow is not None:
+            self.chipset_shadow.start_poll()
+        try:
+            target = self._sense(*targets, **options)
+            if target is None and self._can_auto_poll(targets, options):
+                target = self._sense_auto_poll()
+            return target
+        finally:
+            if self.chipset_shadow is not None:
+                self.chipset_shadow.end_poll()
+
+    def _can_auto_poll(self, targets, options):
+        # Only worth it in between broadcasts, as without ECP express mode devices don't answer
+        return bool(
+            self.auto_poll
+            and options.get("broadcast")
+            and len(targets) == 1
+            and targets[0].brty == "106A"
+            and targets[0].sel_req is None
+            and self.device is not None
+            and AutoPoller.is_supported(self.device.chipset)
+        )
+
+    def _sense_auto_poll(self):
+        """Lets the chip poll on its own after host has sent an ECP broadcast"""
+        with self.lock:
+            chipset = self.device.chipset
+            try:
+                target = AutoPoller(chipset).poll()
+            except (IOError, ValueError) as e:
+                # Regular polling goes on with the next sense
+                log.warning(f"Auto poll failed: {e!r}")
+                target = None
+            if target is None:
+                self.device.mute()
+                return None
+            if target.sel_res[0] & 0x60 == 0x00:
+                # Same as nfcpy does for Type 2 Tags found with InListPassiveTarget
+                rxmode = chipset.read_register("CIU_RxMode")
+                chipset.write_register("CIU_RxMode", rxmode & 0x7F)
+            log.debug("found {0} with auto poll".format(target))
+            self.target = target
+            return target
+
+
+def _check_link(chipset) -> bool:
+    try:
+        # Chip echoes the longest possible frame back, which catches framing errors
+        return bool(chipset.diagnose("line"))
+    except IOError:
+        return False
+
+
+def _restore_default_baudrate(chipset, candidate: int):
+    """Returns chip and port to the default speed after switching to `candidate` failed"""
+    try:
+        chipset.set_serial_baudrate(DEFAULT_BAUDRATE)
+    except IOError:
+        # Command could have been garbled, chip may still be at the higher speed
+        pass
+    chipset.transport.baudrate = DEFAULT_BAUDRATE
+    time.sleep(0.01)
+    if not _check_link(chipset):
+        raise IOError(errno.EIO, f"Lost PN532 link after trying {candidate} baud")
+
+
+def negotiate_baudrate(chipset, baudrate: int) -> int:
+    """Switches PN532 and the serial port to a higher UART speed.
+
+    Link is verified with a Diagnose echo of the longest frame after each switch.
+    If it fails, chip and port are returned to the default speed and the next lower
+    supported speed is tried. Returns speed in use afterwards. Raises IOError if
+    the link could not be restored at the default speed
+    """
+    transport = chipset.transport
+    if getattr(transport, "TYPE", None) != "TTY" or not hasattr(
+        chipset, "set_serial_baudrate"
+    ):
+        return DEFAULT_BAUDRATE
+    if baudrate not in PN532_BAUDRATES:
+        raise ValueError(f"PN532 doesn't support baudrate {baudrate}")
+
+    for candidate in (
+        rate
+        for rate in reversed(PN532_BAUDRATES)
+        if DEFAULT_BAUDRATE < rate <= baudrate
+    ):
+        try:
+            chipset.set_serial_baudrate(candidate)
+            transport.baudrate = candidate
+            # Give the chip time to switch before talking at the new speed
+            time.sleep(0.01)
+        except IOError as e:
+            # Chip may have switched even if the port could not follow
+            log.warning(f"Could not switch PN532 to {candidate} baud: {e!r}")
+            _restore_default_baudrate(chipset, candidate)
+            continue
+        if _check_link(chipset):
+            log.info(f"PN532 UART speed is {candidate} baud")
+            metrics.increment(f"baudrate.{candidate}")
+            return candidate
+        log.warning(f"PN532 link check at {candidate} baud failed, reverting")
+        _restore_default_baudrate(chipset, candidate)
+    return DEFAULT_BAUDRATE
+
+
+__all__ = (
+    "AutoPoller",
+    "AutoPollingFrontendMixin",
+    "ChipsetShadow",
+    "negotiate_baudrate",
+)
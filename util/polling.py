@@ -0,0 +1,67 @@
+import threading
+import time
+from typing import Callable, Optional
+
+from util.metrics import metrics
+
+
+class PollingScheduler:
+    """Decides how long to wait between NFC polls.
+
+    After activity (a device found in the field, a lock command over HAP) reader polls
+    every `min_interval` seconds for `burst` seconds, so that the next tap is noticed quickly.
+    Once idle, interval grows by `backoff` times after every empty poll up to `max_interval`.
+    Interval is never shorter than needed to keep the share of time spent polling
+    within `duty_cycle`, regardless of how long a single poll takes
+    """
+
+    def __init__(
+        self,
+        min_interval=0.02,
+        max_interval=0.15,
+        burst=10.0,
+        backoff=1.5,
+        duty_cycle=0.5,
+        clock: Callable[[], float] = time.monotonic,
+        sleep: Optional[Callable[[float], object]] = None,
+    ):
+        if not 0 < duty_cycle <= 1:
+            raise ValueError(f"Duty cycle {duty_cycle} should be within (0, 1]")
+        self.min_interval = min(min_interval, max_interval)
+        self.max_interval = max_interval
+        self.burst = burst
+        self.backoff = max(backoff, 1)
+        self.duty_cycle = duty_cycle
+        self.clock = clock
+        self._wakeup = threading.Event()
+        self.sleep = sleep or self._wakeup.wait
+        self._interval = self.min_interval
+        # Start in burst mode as reader is usually (re)started by a person standing nearby
+        self._burst_until = clock() + burst
+
+    def notify_activity(self):
+        """Switches to fast polling, interrupting the current wait"""
+        self._burst_until = self.clock() + self.burst
+        self._interval = self.min_interval
+        self._wakeup.set()
+
+    def get_delay(self, poll_started: float, poll_finished: float) -> float:
+        """Returns time to wait after a poll that found nothing, moves backoff one step"""
+        if poll_finished < self._burst_until:
+            interval = self._interval = self.min_interval
+        else:
+            interval = self._interval = min(
+                self.max_interval, self._interval * self.backoff
+            )
+        interval = max(interval, (poll_finished - poll_started) / self.duty_cycle)
+        metrics.observe("polling.interval", interval)
+        return max(0, poll_started + interval - poll_finished)
+
+    def wait(self, poll_started: float):
+        self._wakeup.clear()
+        delay = self.get_delay(poll_started, self.clock())
+        if delay > 0:
+            self.sleep(delay)
+
+
+__all__ = ("PollingScheduler",)
@@ -0,0 +1,83 @@
+import logging
+import threading
+from collections import deque
+from typing import Callable, Deque, Generic, TypeVar
+
+from util.metrics import metrics
+
+log = logging.getLogger()
+
+T = TypeVar("T")
+
+
+class PrefilledPool(Generic[T]):
+    """Keeps up to `size` items made by `factory` ready ahead of time.
+
+    Items are produced on a background thread whenever the pool is not full.
+    Every item is handed out only once. If the pool is empty, `take` makes an item in place
+    """
+
+    def __init__(
+        self, factory: Callable[[], T], size=2, *, name="pool", error_delay=1
+    ):
+        self.name = name
+        self.size = size
+        self.error_delay = error_delay
+        self._factory = factory
+        self._items: Deque[T] = deque()
+        self._generation = 0
+        self._running = True
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(name=name, target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._running and len(self._items) >= self.size:
+                    self._condition.wait()
+                if not self._running:
+                    return
+                factory, generation = self._factory, self._generation
+            try:
+                item = factory()
+            except Exception:
+                log.exception(f"Could not prefill {self.name}")
+                with self._condition:
+                    self._condition.wait(self.error_delay)
+                continue
+            with self._condition:
+                # Drop items made by the factory that was replaced while we were busy
+                if generation == self._generation and len(self._items) < self.size:
+                    self._items.append(item)
+
+    def take(self) -> T:
+        with self._condition:
+            item = self._items.popleft() if self._items else None
+            factory = self._factory
+            self._condition.notify()
+        if item is None:
+            metrics.increment(f"{self.name}.misses")
+            return factory()
+        metrics.increment(f"{self.name}.hits")
+        return item
+
+    def reset(self, factory: Callable[[], T]):
+        """Discards all prepared items and starts making new ones with another factory"""
+        with self._condition:
+            self._factory = factory
+            self._generation += 1
+            self._items.clear()
+            self._condition.notify()
+
+    def stop(self):
+        with self._condition:
+            self._running = False
+            self._items.clear()
+            self._condition.notify()
+
+    def __len__(self):
+        return len(self._items)
+
+
+__all__ = ("PrefilledPool",)
@@ -0,0 +1,77 @@
+import time
+from typing import Callable, Dict, Tuple
+
+from util.metrics import metrics
+
+
+class PresenceDetector:
+    """Tracks devices leaving the field after a transaction.
+
+    Presence is checked every `check_interval` seconds, so the reader is ready as soon as
+    the device is gone. Instead of pausing polling for everyone, a device that was just
+    served is ignored for `cooldown` seconds after it left, which lets a different device
+    be served right away. A device that is served again shortly after its cooldown has ended
+    gets a twice as long cooldown, up to `max_cooldown`
+    """
+
+    # UID -> (ignored until, cooldown)
+    _suppressed: Dict[bytes, Tuple[float, float]]
+
+    def __init__(
+        self,
+        check_interval=0.1,
+        cooldown=2.0,
+        max_cooldown=10.0,
+        clock: Callable[[], float] = time.monotonic,
+        sleep: Callable[[float], object] = time.sleep,
+    ):
+        self.check_interval = check_interval
+        self.cooldown = cooldown
+        self.max_cooldown = max(cooldown, max_cooldown)
+        self.clock = clock
+        self.sleep = sleep
+        self._suppressed = dict()
+
+    def wait_for_removal(self, is_present: Callable[[], bool]) -> float:
+        """Blocks until `is_present` returns False, returns the moment device left"""
+        while is_present():
+            self.sleep(self.check_interval)
+        return self.clock()
+
+    def served(self, uid: bytes, transaction_finished: float, is_present=None):
+        """Waits for a served device to leave the field and starts its cooldown"""
+        if is_present is not None:
+            self.wait_for_removal(is_present)
+        now = self.clock()
+        metrics.observe("presence.time_to_next_ready", now - transaction_finished)
+        if not uid:
+            return
+        uid = bytes(uid)
+        cooldown = self.cooldown
+        previous = self._suppressed.get(uid)
+        if previous is not None and now < previous[0] + previous[1]:
+            cooldown = min(self.max_cooldown, previous[1] * 2)
+        # Forget devices that are long gone so that random UIDs don't pile up
+        self._suppressed = {
+            key: value
+            for key, value in self._suppressed.items()
+            if now < value[0] + value[1]
+        }
+        self._suppressed[uid] = (now + cooldown, cooldown)
+
+    def is_suppressed(self, uid: bytes) -> bool:
+        """Returns True if device has been served recently, prolonging its cooldown"""
+        entry = self._suppressed.get(bytes(uid or b""))
+        if entry is None:
+            return False
+        now = self.clock()
+        until, cooldown = entry
+        if now >= until:
+            return False
+        # Device stays in or keeps coming back to the field, so keep ignoring it
+        self._suppressed[bytes(uid)] = (now + cooldown, cooldown)
+        metrics.increment("presence.suppressed")
+        return True
+
+
+__all__ = ("PresenceDetector",)
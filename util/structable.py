@@ -27,6 +27,13 @@ class Packable:
     def pack(self) -> Union[bytearray, bytes]:
         raise NotImplementedError()
 
+    def pack_chunks(self, chunks: list):
+        """Appends packed representation to `chunks`, possibly split into several parts.
+
+        Can be overridden to let `pack` avoid building intermediate bytes of nested objects
+        """
+        chunks.append(self.pack())
+
 
 class Unpackable:
     @classmethod
@@ -53,20 +60,41 @@ def pack(data: PackableData, *, byteorder="big", signed=False) -> bytes:
     elif isinstance(data, Enum):
         return pack(data.value, byteorder=byteorder, signed=signed)
     elif isinstance(data, Iterable):
-        return b"".join(
-            pack(element, byteorder=byteorder, signed=signed) for element in data
-        )
+        # Nested data is flattened into a single list of parts first,
+        # join then sizes the result once and copies every part into it
+        chunks = []
+        pack_chunks(data, chunks, byteorder=byteorder, signed=signed)
+        return b"".join(chunks)
     elif isinstance(data, int):
         return int_to_bytes(data, byteorder=byteorder, signed=signed)
     raise TypeError(f"Cannot pack data {type(data)} {data}")
 
 
+def pack_chunks(data: PackableData, chunks: list, *, byteorder="big", signed=False):
+    """Appends parts of packed `data` to `chunks` without joining them"""
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        chunks.append(data)
+    elif isinstance(data, Packable):
+        data.pack_chunks(chunks)
+    elif isinstance(data, str):
+        chunks.append(data.encode())
+    elif isinstance(data, Enum):
+        pack_chunks(data.value, chunks, byteorder=byteorder, signed=signed)
+    elif isinstance(data, Iterable):
+        for element in data:
+            pack_chunks(element, chunks, byteorder=byteorder, signed=signed)
+    elif isinstance(data, int):
+        chunks.append(int_to_bytes(data, byteorder=byteorder, signed=signed))
+    else:
+        raise TypeError(f"Cannot pack data {type(data)} {data}")
+
+
 def represent(data: PackableData):
     if isinstance(data, Packable):
         return f"{data}"
-    elif isinstance(data, (bytes, bytearray)):
+    elif isinstance(data, (bytes, bytearray, memoryview)):
         if isprintable(data):
-            return f"{data}"
+            return f"{bytes(data)}"
         return f"0x{data.hex()}"
     elif isinstance(data, str):
         return f'"{data}"'
@@ -1,10 +1,53 @@
 from enum import Enum, IntEnum
-from typing import Collection, List, Union, Dict
+from typing import Any, Callable, Collection, List, Optional, Tuple, Union, Dict
 
 from util.generic import int_to_bytes
 from util.structable import PackableData, Packable, Unpackable, pack, represent
 
 
+def get_type_converter(target) -> Callable[[bytes], Any]:
+    """Returns a function that casts raw bytes into an instance of `target`.
+
+    The decision on how to cast is made once, so the converter can be reused for every value.
+    Values that cannot be cast are returned as is
+    """
+    if not isinstance(target, type):
+        return _identity
+    if issubclass(target, IntEnum):
+
+        def convert(value):
+            return target(int.from_bytes(value, "big"))
+
+    elif issubclass(target, Enum):
+
+        def convert(value):
+            return target(bytes(value))
+
+    elif issubclass(target, Unpackable):
+        convert = target.unpack
+    elif target == bytes or target == memoryview or target == bytearray:
+        convert = bytes
+    elif target == int:
+
+        def convert(value):
+            return int.from_bytes(value, "big")
+
+    else:
+        return _identity
+
+    def converter(value):
+        try:
+            return convert(value)
+        except Exception:
+            return value
+
+    return converter
+
+
+def _identity(value):
+    return value
+
+
 def try_cast_type(value: bytes, type):
     if isinstance(value, Packable):
         value = value.pack()
@@ -14,22 +57,7 @@ def try_cast_type(value: bytes, type):
         and not isinstance(value, bytearray)
     ):
         return value
-
-    try:
-        if issubclass(type, IntEnum):
-            return type(int.from_bytes(value, "big"))
-        elif issubclass(type, Enum):
-            return type(value)
-        elif issubclass(type, Unpackable):
-            return type.unpack(value)
-        elif type == bytes or type == memoryview or type == bytearray:
-            return bytes(value)
-        elif type == int:
-            return int.from_bytes(value, "big")
-        else:
-            return value
-    except (TypeError, ValueError, Exception):
-        return value
+    return get_type_converter(type)(value)
 
 
 def unpack_optional_tlv(value):
@@ -65,7 +93,76 @@ class TLV:
             return f"UNKNOWN TYPE {type(self.value)}"
 
 
+def get_tag_key(tag: Union[int, bytes, bytearray, Collection[int], "BERTLVTag"]):
+    if isinstance(tag, int):
+        return tag
+    if isinstance(tag, BERTLVTag):
+        tag = tag.data
+    return int.from_bytes(bytes(tag), "big")
+
+
+def _invalidating_index(name):
+    method = getattr(list, name)
+
+    def wrapper(self, *args, **kwargs):
+        self._index = None
+        return method(self, *args, **kwargs)
+
+    wrapper.__name__ = name
+    return wrapper
+
+
 class TLVList(list):
+    """List of TLVs that can also be looked up by tag.
+
+    Tags are indexed on the first lookup, and the index is dropped whenever the list changes.
+    Tags can be given as an int (0x5C, 0x7F49) or as bytes
+    """
+
+    _index: Optional[Dict[int, List[TLV]]] = None
+
+    def _get_index(self) -> Dict[int, List[TLV]]:
+        if self._index is None:
+            index = dict()
+            for tlv in self:
+                index.setdefault(get_tag_key(tlv.tag), []).append(tlv)
+            self._index = index
+        return self._index
+
+    def get_all(self, tag) -> List[TLV]:
+        """Returns all TLVs with given tag, in order of appearance"""
+        return self._get_index().get(get_tag_key(tag), [])
+
+    def get(self, tag, default=None):
+        """Returns value of the first TLV with given tag, or `default` if there is none"""
+        tlvs = self._get_index().get(get_tag_key(tag))
+        return tlvs[0].value if tlvs else default
+
+    def require(self, tag, message=None, error=ValueError):
+        """Returns value of the first TLV with given tag, raising `error` if there is none"""
+        tlvs = self._get_index().get(get_tag_key(tag))
+        if not tlvs:
+            raise error(message or f"Missing required tag {get_tag_key(tag):02x}")
+        return tlvs[0].value
+
+    def __contains__(self, tag) -> bool:
+        if isinstance(tag, TLV):
+            return list.__contains__(self, tag)
+        return get_tag_key(tag) in self._get_index()
+
+    append = _invalidating_index("append")
+    extend = _invalidating_index("extend")
+    insert = _invalidating_index("insert")
+    pop = _invalidating_index("pop")
+    remove = _invalidating_index("remove")
+    clear = _invalidating_index("clear")
+    sort = _invalidating_index("sort")
+    reverse = _invalidating_index("reverse")
+    __setitem__ = _invalidating_index("__setitem__")
+    __delitem__ = _invalidating_index("__delitem__")
+    __iadd__ = _invalidating_index("__iadd__")
+    __imul__ = _invalidating_index("__imul__")
+
     def __repr__(self) -> str:
         result = "["
         for el in self:
@@ -111,24 +208,17 @@ class BERTLVTag(Packable, Unpackable):
 
     @classmethod
     def unpack(cls, data: bytes):
-        return cls._unpack_tag(data)
+        return cls.unpack_from(data)[0]
 
     @classmethod
-    def _unpack_tag(cls, data: bytes):
-        result = []
-        index = 0
-        tag = data[index]
-
-        index += 1
-        result.append(tag)
-        tag_number = tag & 0b00011111
-        tag_extension_left = tag_number & 0b00011111 == 0b00011111
+    def unpack_from(cls, data: bytes, offset=0) -> Tuple["BERTLVTag", int]:
+        """Returns a tag starting at `offset` along with the offset right after it"""
+        end = offset + 1
+        tag_extension_left = data[offset] & 0b00011111 == 0b00011111
         while tag_extension_left:
-            tag_extension = data[index]
-            result.append(tag_extension)
-            tag_extension_left = bool(tag_extension & 0b10000000)
-            index += 1
-        return BERTLVTag(result)
+            tag_extension_left = bool(data[end] & 0b10000000)
+            end += 1
+        return BERTLVTag(bytes(data[offset:end])), end
 
     def pack(self) -> bytes:
         return self.data
@@ -138,7 +228,9 @@ class BERTLVLength(Packable, Unpackable):
     data: bytes
 
     def __init__(self, data):
+        self._value = None
         if isinstance(data, int):
+            self._value = data
             if data <= 127:
                 self.data = int_to_bytes(data)
             else:
@@ -163,6 +255,11 @@ class BERTLVLength(Packable, Unpackable):
 
     @property
     def value(self):
+        if self._value is None:
+            self._value = self._decode()
+        return self._value
+
+    def _decode(self):
         data = self.data
         index = 0
         length_base_data = data[index]
@@ -185,34 +282,35 @@ class BERTLVLength(Packable, Unpackable):
 
     @classmethod
     def unpack(cls, data: bytes):
-        return cls._unpack_length(data)
+        return cls.unpack_from(data)[0]
 
     @classmethod
-    def _unpack_length(cls, data: bytes):
-        index = 0
-        result = []
-        length_base_data = data[index]
-        result.append(data[index])
-        index += 1
+    def unpack_from(cls, data: bytes, offset=0) -> Tuple["BERTLVLength", int]:
+        """Returns a length starting at `offset` along with the offset right after it"""
+        length_base_data = data[offset]
+        end = offset + 1
 
         length_form_is_simple = bool(~length_base_data & 0b10000000)
         if length_form_is_simple:
-            return BERTLVLength(data=result)
+            value = length_base_data
         else:
             length_length = length_base_data & 0b01111111
-
             if length_length:
                 # Definite form
-                result.extend(data[index : index + length_length])
-                index += length_length
-                if len(result) != length_length + 1:
+                end += length_length
+                if end > len(data):
                     raise ValueError("Bad format")
+                value = int.from_bytes(data[offset + 1 : end], "big")
             else:
                 # Indefinite form
-                while not bytes(result).endswith(b"\x00\x00"):
-                    result.append(data[index])
-                    index += 1
-            return BERTLVLength(result)
+                while end - offset < 3 or bytes(data[end - 2 : end]) != b"\x00\x00":
+                    if end >= len(data):
+                        raise ValueError("Bad format")
+                    end += 1
+                value = int.from_bytes(data[offset + 1 : end], "big")
+        length = BERTLVLength(bytes(data[offset:end]))
+        length._value = value
+        return length, end
 
     def pack(self):
         return self.data
@@ -221,20 +319,50 @@ class BERTLVLength(Packable, Unpackable):
         return f"{self.pack().hex()}"
 
 
+_NOT_PARSED = object()
+
+
 class BERTLV(TLV, Packable, Unpackable):
+    """BER-TLV element.
+
+    Parsed elements reference the buffer they were parsed from instead of copying it:
+    primitive values are memoryview slices of it, and children of constructed
+    elements are parsed on first access to `value`.
+    Encoded value is kept once computed, so modifying `value` in place
+    is not reflected in `length` or `pack`, assign a new value instead
+    """
+
     tag: BERTLVTag
     length: BERTLVLength
     value: PackableData
+    _encoded_value: Optional[Union[bytes, memoryview]]
 
     def __init__(self, tag, length=None, value: PackableData = b""):
         tag = BERTLVTag(tag) if isinstance(tag, int) else tag
-        length = length or len(pack(value))
-        length = BERTLVLength(length) if isinstance(length, int) else length
-
         self.tag = tag
         self.value = value
+
+        length = length or len(self.encoded_value)
+        length = BERTLVLength(length) if isinstance(length, int) else length
         self.length = length
 
+    @property
+    def value(self) -> PackableData:
+        if self._value is _NOT_PARSED:
+            self._value = self.unpack_array(self._encoded_value)
+        return self._value
+
+    @value.setter
+    def value(self, value: PackableData):
+        self._value = value
+        self._encoded_value = None
+
+    @property
+    def encoded_value(self) -> Union[bytes, memoryview]:
+        if self._encoded_value is None:
+            self._encoded_value = pack(self._value)
+        return self._encoded_value
+
     def __getitem__(self, key: Union[int, bytes, bytearray, Collection[int]]):
         if (
             isinstance(key, bytes)
@@ -243,6 +371,8 @@ class BERTLV(TLV, Packable, Unpackable):
             or isinstance(key, tuple)
         ):
             if self.tag.is_constructed:
+                if isinstance(self.value, TLVList):
+                    return list(self.value.get_all(key))
                 return list(
                     tlv for tlv in self.value if bytes(tlv.tag.data) == bytes(key)
                 )
@@ -254,37 +384,42 @@ class BERTLV(TLV, Packable, Unpackable):
             return self.value[key]
 
     def pack(self):
-        return pack((self.tag, self.length, self.value))
+        return b"".join((self.tag.data, self.length.data, self.encoded_value))
+
+    def pack_chunks(self, chunks: list):
+        chunks.append(self.tag.data)
+        chunks.append(self.length.data)
+        chunks.append(self.encoded_value)
 
     @classmethod
     def unpack_array(cls, data: bytes):
-        result = []
+        data = data if isinstance(data, memoryview) else memoryview(data)
+        result = TLVList()
         index = 0
         while index < len(data) - 1:
-            _tlv = BERTLV.unpack(data[index:])
-            index += len(_tlv.pack())
+            _tlv, index = cls.unpack_from(data, index)
             result.append(_tlv)
-        return TLVList(result)
+        return result
 
     @classmethod
     def unpack(cls, data: bytes):
-        return cls._unpack_tlv(data)
+        return cls.unpack_from(data)[0]
 
     @classmethod
-    def _unpack_tlv(cls, data: bytes):
-        index = 0
-        data = memoryview(data)
-        tag = BERTLVTag.unpack(data[index:])
-        index += len(tag.data)
-        length = BERTLVLength.unpack(data[index:])
-        index += len(length.data)
-        data = memoryview(data)[index : index + length.value]
-        if len(data) != length.value:
+    def unpack_from(cls, data: bytes, offset=0) -> Tuple["BERTLV", int]:
+        """Returns a TLV starting at `offset` along with the offset right after it"""
+        data = data if isinstance(data, memoryview) else memoryview(data)
+        tag, index = BERTLVTag.unpack_from(data, offset)
+        length, index = BERTLVLength.unpack_from(data, index)
+        end = index + length.value
+        if end > len(data):
             raise ValueError("Tag length does not match data size")
-        if tag.is_constructed:
-            return BERTLV(tag, length, cls.unpack_array(data[index:]))
-        else:
-            return BERTLV(tag, length, bytes(data))
+        tlv = cls.__new__(cls)
+        tlv.tag = tag
+        tlv.length = length
+        tlv._encoded_value = data[index:end]
+        tlv._value = _NOT_PARSED if tag.is_constructed else tlv._encoded_value
+        return tlv, end
 
 
 class TLV8(TLV, Packable, Unpackable):
@@ -344,6 +479,7 @@ class TLV8ObjectMeta(type):
             self.type = type
             self.optional = optional
             self.default = default
+            self.convert = get_type_converter(type)
 
     def __new__(cls, name, bases, attrs):
         _tlv8_fields = dict()
@@ -358,8 +494,54 @@ class TLV8ObjectMeta(type):
                 )
         new_class = super().__new__(cls, name, bases, attrs)
         new_class._tlv8_fields = _tlv8_fields
+        new_class._tlv8_unpack = staticmethod(
+            TLV8ObjectMeta._build_unpacker(_tlv8_fields)
+        )
+        new_class._tlv8_pack = TLV8ObjectMeta._build_packer(_tlv8_fields)
         return new_class
 
+    @staticmethod
+    def _build_unpacker(fields: Dict[str, "TLV8ObjectMeta._TLV8Field"]):
+        # Tag -> (field name, converter), first occurrence of a tag wins
+        dispatch = dict()
+        for name, field in fields.items():
+            dispatch.setdefault(field.index, (name, field.convert))
+
+        def unpack_fields(data) -> Dict[str, Any]:
+            data = data if isinstance(data, memoryview) else memoryview(data)
+            result = dict.fromkeys(fields)
+            seen = set()
+            index, size = 0, len(data)
+            while index < size:
+                tag, length = data[index], data[index + 1]
+                index += 2
+                entry = dispatch.get(tag)
+                if entry is not None and tag not in seen:
+                    seen.add(tag)
+                    name, convert = entry
+                    result[name] = convert(data[index : index + length])
+                index += length
+            return result
+
+        return unpack_fields
+
+    @staticmethod
+    def _build_packer(fields: Dict[str, "TLV8ObjectMeta._TLV8Field"]):
+        layout = tuple((name, field.index) for name, field in fields.items())
+
+        def pack_fields(self) -> bytes:
+            result = bytearray()
+            for name, tag in layout:
+                value = getattr(self, name)
+                if value is not None:
+                    data = pack(value)
+                    result.append(tag)
+                    result.append(len(data))
+                    result += data
+            return bytes(result)
+
+        return pack_fields
+
 
 class TLV8Object(Packable, Unpackable, metaclass=TLV8ObjectMeta):
     _tlv8_fields: Dict[str, TLV8Field]
@@ -374,25 +556,10 @@ class TLV8Object(Packable, Unpackable, metaclass=TLV8ObjectMeta):
 
     @classmethod
     def unpack(cls, data) -> "TLV8Object":
-        tlv_array = TLV8.unpack_array(data)
-        result = {
-            name: try_cast_type(
-                unpack_optional_tlv(
-                    next((tlv for tlv in tlv_array if tlv.tag == field.index), None)
-                ),
-                type=field.type,
-            )
-            for name, field in cls._tlv8_fields.items()
-        }
-        return cls(**result)
+        return cls(**cls._tlv8_unpack(data))
 
     def pack(self) -> bytes:
-        result = []
-        for name, field in self._tlv8_fields.items():
-            value = getattr(self, name)
-            if value is not None:
-                result.append(TLV8(field.index, value))
-        return b"".join(tlv.pack() for tlv in result)
+        return self._tlv8_pack()
 
     def __repr__(self) -> str:
         data = {